@@ -1,11 +1,28 @@
+import time
+
+_IMPORT_STARTED = time.perf_counter()
+
+import asyncio
+import atexit
+import collections
+import contextvars
 import azure.functions as func
 import datetime
+import glob
+import hmac
 import json
 import logging
+import math
 import os
 import re
+import sys
+import tempfile
+import threading
 import uuid
+import weakref
 from typing import Optional, Any, Dict
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
 from azure.data.tables import TableServiceClient, UpdateMode
 
 try:
@@ -13,26 +30,212 @@ try:
 except ImportError:
     ZoneInfo = None
 
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-import traceback
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 
+# The email stack (smtplib, email.mime, traceback, the ACS SDK) is imported
+# inside AlertDispatcher so device POSTs on a cold worker do not pay for it.
+
+# Cold-start profiling. Set STARTUP_PROFILE=true to log the import and
+# first-request breakdown; it is also returned by the warmup endpoint.
+STARTUP_PROFILE = os.getenv("STARTUP_PROFILE", "").strip().lower() in ("1", "true", "yes")
+_startup_timings: Dict[str, Any] = {"importsSeconds": round(time.perf_counter() - _IMPORT_STARTED, 4)}
+
 app = func.FunctionApp()
 
-# Storage Configuration
+# Storage Configuration. The service client is built on first use rather than
+# at import so the worker can start accepting the request sooner. Every table
+# client shares one pooled HTTP session and a retry policy tuned for Table
+# throttling (503 ServerBusy / 429 with exponential backoff).
 conn_str = os.getenv("STORAGE_CONNECTION_STRING") or os.getenv("AzureWebJobsStorage")
-try:
-    table_service = TableServiceClient.from_connection_string(conn_str) if conn_str else None
-except Exception as ex:
-    logging.error("Failed to initialize TableServiceClient: %s", ex)
-    table_service = None
+TABLE_POOL_MAXSIZE = int(os.getenv("TABLE_POOL_MAXSIZE", "32"))
+TABLE_CONNECT_TIMEOUT = float(os.getenv("TABLE_CONNECT_TIMEOUT", "5"))
+TABLE_READ_TIMEOUT = float(os.getenv("TABLE_READ_TIMEOUT", "30"))
+TABLE_RETRY_TOTAL = int(os.getenv("TABLE_RETRY_TOTAL", "6"))
+TABLE_RETRY_BACKOFF = float(os.getenv("TABLE_RETRY_BACKOFF", "0.5"))
+TABLE_RETRY_BACKOFF_MAX = int(os.getenv("TABLE_RETRY_BACKOFF_MAX", "30"))
+
+_table_service = None
+_table_session = None
+_table_clients: Dict[str, Any] = {}
+_table_service_lock = threading.Lock()
+_transport_stats: Dict[str, int] = {"responses": 0, "throttled": 0}
+_recent_throttles: "collections.deque[float]" = collections.deque(maxlen=1000)
+
+# Per-request storage accounting. safe_function opens an account for each
+# call, the response hook below adds pages and bytes, and the history paths
+# add entities scanned under a code-path tag. The last DIAGNOSTICS_WINDOW
+# accounts are aggregated by GET /diagnostics.
+DIAGNOSTICS_WINDOW = max(1, int(os.getenv("DIAGNOSTICS_WINDOW", "500")))
+_query_account: contextvars.ContextVar = contextvars.ContextVar("query_account", default=None)
+_recent_accounts: collections.deque = collections.deque(maxlen=DIAGNOSTICS_WINDOW)
+
+
+def _count_table_response(response) -> None:
+    # raw_response_hook runs once per attempt, so retries are counted too.
+    _transport_stats["responses"] += 1
+    throttled = response.http_response.status_code in (429, 503)
+    if throttled:
+        _transport_stats["throttled"] += 1
+        _recent_throttles.append(time.monotonic())
+    account = _query_account.get()
+    if account is not None:
+        account["pages"] += 1
+        account["throttled"] += int(throttled)
+        try:
+            account["bytes"] += int(response.http_response.headers.get("Content-Length") or 0)
+        except (TypeError, ValueError):
+            pass
+
+
+def build_table_transport():
+    import requests
+    from azure.core.pipeline.transport import RequestsTransport
+
+    global _table_session
+    _table_session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=TABLE_POOL_MAXSIZE)
+    _table_session.mount("https://", adapter)
+    _table_session.mount("http://", adapter)
+    return RequestsTransport(
+        session=_table_session,
+        session_owner=False,
+        connection_timeout=TABLE_CONNECT_TIMEOUT,
+        read_timeout=TABLE_READ_TIMEOUT,
+    )
+
+
+def get_table_service():
+    global _table_service
+    if _table_service is None and conn_str:
+        with _table_service_lock:
+            if _table_service is None:
+                started = time.perf_counter()
+                try:
+                    _table_service = TableServiceClient.from_connection_string(
+                        conn_str,
+                        transport=build_table_transport(),
+                        retry_total=TABLE_RETRY_TOTAL,
+                        retry_backoff_factor=TABLE_RETRY_BACKOFF,
+                        retry_backoff_max=TABLE_RETRY_BACKOFF_MAX,
+                        retry_on_status_codes=[429, 503],
+                        raw_response_hook=_count_table_response,
+                    )
+                except Exception as ex:
+                    logging.error("Failed to initialize TableServiceClient: %s", ex)
+                    return None
+                _startup_timings.setdefault("tableServiceInitSeconds", round(time.perf_counter() - started, 4))
+    return _table_service
+
 
 def get_table_client(table_name: str):
+    """Return the shared client for `table_name`; one client per table per instance."""
+    client = _table_clients.get(table_name)
+    if client is not None:
+        return client
+    table_service = get_table_service()
     if not table_service:
         return None
-    return table_service.get_table_client(table_name)
+    with _table_service_lock:
+        client = _table_clients.get(table_name)
+        if client is None:
+            client = table_service.get_table_client(table_name)
+            _table_clients[table_name] = client
+    return client
+
+
+def table_transport_stats() -> Dict[str, Any]:
+    """Connection reuse for the shared table transport: HTTP requests sent
+    versus TCP connections opened by the urllib3 pools."""
+    requests_sent = 0
+    connections = 0
+    if _table_session is not None:
+        for adapter in _table_session.adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                requests_sent += pool.num_requests
+                connections += pool.num_connections
+    return {
+        **_transport_stats,
+        "clients": sorted(_table_clients),
+        "requests": requests_sent,
+        "connections": connections,
+        "connectionReuse": round(1 - connections / requests_sent, 4) if requests_sent else None,
+    }
+
+
+_ensured_tables: set = set()
+
+
+def ensure_table_client(table_name: str):
+    """Return a client for `table_name`, creating the table once per process."""
+    client = get_table_client(table_name)
+    if not client or table_name in _ensured_tables:
+        return client
+    try:
+        get_table_service().create_table_if_not_exists(table_name)
+    except Exception as ex:
+        logging.warning("Unable to ensure table %s exists: %s", table_name, ex)
+    _ensured_tables.add(table_name)
+    return client
+
+# Async (aio) Table clients for the ingest and history handlers. aio clients
+# are bound to the event loop that created them, so they are cached per loop.
+# Set ASYNC_STORAGE=false (or leave aiohttp uninstalled) to run the sync
+# storage path on a worker thread instead.
+ASYNC_STORAGE = os.getenv("ASYNC_STORAGE", "true").strip().lower() in ("1", "true", "yes")
+HISTORY_QUERY_CONCURRENCY = max(1, int(os.getenv("HISTORY_QUERY_CONCURRENCY", "8")))
+_aio_table_services: Dict[int, Any] = {}
+_aio_table_clients: Dict[tuple, Any] = {}
+
+
+def get_async_table_client(table_name: str):
+    if not ASYNC_STORAGE or not conn_str:
+        return None
+    loop_id = id(asyncio.get_running_loop())
+    client = _aio_table_clients.get((loop_id, table_name))
+    if client is not None:
+        return client
+
+    service = _aio_table_services.get(loop_id)
+    if service is None:
+        try:
+            import aiohttp  # noqa: F401  (required by the aio transport)
+            from azure.data.tables.aio import TableServiceClient as AsyncTableServiceClient
+            service = AsyncTableServiceClient.from_connection_string(
+                conn_str,
+                retry_total=TABLE_RETRY_TOTAL,
+                retry_backoff_factor=TABLE_RETRY_BACKOFF,
+                retry_backoff_max=TABLE_RETRY_BACKOFF_MAX,
+                retry_on_status_codes=[429, 503],
+                raw_response_hook=_count_table_response,
+            )
+        except Exception as ex:
+            logging.warning("Async table storage unavailable, using sync path: %s", ex)
+            return None
+        _aio_table_services[loop_id] = service
+
+    client = service.get_table_client(table_name)
+    _aio_table_clients[(loop_id, table_name)] = client
+    return client
+
+
+async def query_entities_async(client, query_filter: str, semaphore: Optional[asyncio.Semaphore] = None, **kwargs) -> list:
+    """Drain an aio query into a list, optionally bounded by `semaphore`.
+    Query failures are logged and yield no rows, matching the sync path."""
+    async def drain():
+        return [e async for e in client.query_entities(query_filter=query_filter, **kwargs)]
+
+    try:
+        if semaphore is None:
+            return await drain()
+        async with semaphore:
+            return await drain()
+    except Exception as ex:
+        logging.debug("Async query failed (%s): %s", query_filter, ex)
+        return []
+
 
 def now_iso() -> str:
     return datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0).isoformat().replace("+00:00", "Z")
@@ -113,18 +316,281 @@ def sanitize_timestamp(value):
     return None if not value else str(value)
 
 
-def json_response(payload: dict, status: int = 200) -> func.HttpResponse:
-    return func.HttpResponse(json.dumps(payload), status_code=status, mimetype="application/json")
+def json_response(payload: dict, status: int = 200, headers: Optional[dict] = None) -> func.HttpResponse:
+    return func.HttpResponse(json.dumps(payload), status_code=status, mimetype="application/json", headers=headers)
+
+
+def record_first_request(handler_name: str, started: float) -> None:
+    if "firstRequest" in _startup_timings:
+        return
+    _startup_timings["firstRequest"] = {
+        "function": handler_name,
+        "sinceModuleLoadedSeconds": round(started - _MODULE_LOADED, 4),
+        "handlerSeconds": round(time.perf_counter() - started, 4),
+    }
+    if STARTUP_PROFILE:
+        logging.info("Startup profile: %s", json.dumps(_startup_timings))
+
+
+def begin_query_account(handler_name: str, req: func.HttpRequest):
+    account = {
+        "function": handler_name,
+        "params": dict(req.params),
+        "paths": [],
+        "queries": 0,
+        "pages": 0,
+        "throttled": 0,
+        "bytes": 0,
+        "scanned": 0,
+        "returned": None,
+    }
+    return account, _query_account.set(account)
+
+
+def finish_query_account(account: dict, token, started: float) -> None:
+    _query_account.reset(token)
+    account["wallMs"] = round((time.perf_counter() - started) * 1000, 1)
+    if account["pages"] or account["paths"]:
+        _recent_accounts.append(account)
+
+
+def account_scan(path: str, scanned: int, queries: int = 1) -> None:
+    """Charge `scanned` entities from `queries` storage queries to the current
+    request under `path` (rollup, rollupMiss, raw, fullTable, chunks, ...)."""
+    account = _query_account.get()
+    if account is None:
+        return
+    if path not in account["paths"]:
+        account["paths"].append(path)
+    account["queries"] += queries
+    account["scanned"] += scanned
+
+
+def account_returned(count: int) -> None:
+    account = _query_account.get()
+    if account is not None:
+        account["returned"] = count
+
+
+def diagnostics_summary() -> Dict[str, Any]:
+    """Rolling per-function, per-path aggregates over the recent accounts."""
+    accounts = list(_recent_accounts)
+    groups: Dict[str, Dict[str, Any]] = {}
+    for a in accounts:
+        key = f"{a['function']}:{'+'.join(a['paths']) or 'other'}"
+        g = groups.setdefault(key, {"requests": 0, "queries": 0, "pages": 0, "throttled": 0, "bytes": 0, "scanned": 0, "returned": 0, "wall": []})
+        g["requests"] += 1
+        for field in ("queries", "pages", "throttled", "bytes", "scanned"):
+            g[field] += a[field]
+        g["returned"] += a["returned"] or 0
+        g["wall"].append(a["wallMs"])
+
+    for g in groups.values():
+        wall = sorted(g.pop("wall"))
+        g["avgWallMs"] = round(sum(wall) / len(wall), 1)
+        g["p95WallMs"] = wall[min(len(wall) - 1, int(len(wall) * 0.95))]
+        g["maxWallMs"] = wall[-1]
+        g["scannedPerReturned"] = round(g["scanned"] / g["returned"], 2) if g["returned"] else None
+
+    return {
+        "window": DIAGNOSTICS_WINDOW,
+        "requests": len(accounts),
+        "byPath": dict(sorted(groups.items(), key=lambda kv: -kv[1]["scanned"])),
+        "slowest": sorted(accounts, key=lambda a: -a["wallMs"])[:10],
+    }
+
+
+# On-demand request profiling. With PROFILING_ENABLED=true and PROFILE_SECRET
+# set, a request carrying `X-Profile: <secret>` runs under a sampling profiler
+# and the hot frames are returned in the JSON body (and logged). At most one
+# profile runs per instance, at most once per PROFILE_MIN_GAP_SECONDS.
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "").strip().lower() in ("1", "true", "yes")
+PROFILE_SECRET = os.getenv("PROFILE_SECRET", "")
+PROFILE_HEADER = "X-Profile"
+PROFILE_INTERVAL_SECONDS = max(0.001, float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000)
+PROFILE_MIN_GAP_SECONDS = float(os.getenv("PROFILE_MIN_GAP_SECONDS", "60"))
+PROFILE_TOP_FRAMES = 25
+_profile_lock = threading.Lock()
+_profile_state: Dict[str, Any] = {"active": False, "lastStarted": float("-inf")}
+# The profiler of the request whose context this is; inherited by the tasks
+# it creates and by its asyncio.to_thread calls.
+_profile_owner: contextvars.ContextVar = contextvars.ContextVar("profile_owner", default=None)
+
+
+class SamplingProfiler:
+    """Samples the profiled request's stacks on a timer thread and counts frames.
+    Other requests running at the same time are left out: a sync handler is
+    sampled on its own thread; an async handler on the event loop only while
+    one of its tasks is running, and in the to_thread workers that carry its
+    context."""
+
+    def __init__(self, interval: float = PROFILE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.samples = 0
+        self.self_counts: collections.Counter = collections.Counter()
+        self.inclusive_counts: collections.Counter = collections.Counter()
+        self.stack_counts: collections.Counter = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+        self._started = 0.0
+        self._elapsed = 0.0
+        self._owner_token = None
+        self._handler_thread: Optional[int] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._tasks: "weakref.WeakSet[asyncio.Task]" = weakref.WeakSet()
+        self._previous_task_factory = None
+
+    def start(self) -> "SamplingProfiler":
+        """Start sampling the calling request; call from the handler's own context."""
+        self._owner_token = _profile_owner.set(self)
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._handler_thread = threading.get_ident()
+        if self._loop is not None:
+            self._handler_thread = threading.get_ident()
+            self._tasks.add(asyncio.current_task())
+            # Tasks created from the request's context belong to the request.
+            self._previous_task_factory = self._loop.get_task_factory()
+            self._loop.set_task_factory(self._task_factory)
+        self._started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        self._elapsed = time.perf_counter() - self._started
+        if self._loop is not None and self._loop.get_task_factory() == self._task_factory:
+            self._loop.set_task_factory(self._previous_task_factory)
+        _profile_owner.reset(self._owner_token)
+        with _profile_lock:
+            _profile_state["active"] = False
+
+    def _task_factory(self, loop, coro, **kwargs):
+        if self._previous_task_factory is not None:
+            task = self._previous_task_factory(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        if _profile_owner.get() is self:
+            self._tasks.add(task)
+        return task
+
+    def _owns(self, thread_id: int, frame) -> bool:
+        if thread_id == self._handler_thread:
+            if self._loop is None:
+                return True
+            return asyncio.current_task(self._loop) in self._tasks
+        # A to_thread worker runs functools.partial(context.run, fn) inside
+        # concurrent.futures' _WorkItem.run; check whose context that is.
+        while frame is not None:
+            if frame.f_code.co_name == "run" and frame.f_code.co_filename.endswith(os.path.join("concurrent", "futures", "thread.py")):
+                item = frame.f_locals.get("self")
+                context = getattr(getattr(getattr(item, "fn", None), "func", None), "__self__", None)
+                return isinstance(context, contextvars.Context) and context.get(_profile_owner) is self
+            frame = frame.f_back
+        return False
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me or not self._owns(thread_id, frame):
+                    continue
+                stack = []
+                while frame is not None and len(stack) < 64:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.samples += 1
+                self.self_counts[stack[0]] += 1
+                self.inclusive_counts.update(set(stack))
+                self.stack_counts[";".join(reversed(stack))] += 1
+
+    def summary(self) -> Dict[str, Any]:
+        def top(counter, n):
+            return [{"frame": k, "samples": v, "pct": round(100 * v / self.samples, 1)} for k, v in counter.most_common(n)]
+
+        return {
+            "scope": "request",
+            "samples": self.samples,
+            "intervalMs": round(self.interval * 1000, 2),
+            "wallMs": round(self._elapsed * 1000, 1),
+            "self": top(self.self_counts, PROFILE_TOP_FRAMES) if self.samples else [],
+            "inclusive": top(self.inclusive_counts, PROFILE_TOP_FRAMES) if self.samples else [],
+            # Collapsed stacks, ready for flamegraph.pl / speedscope.
+            "stacks": dict(self.stack_counts.most_common(PROFILE_TOP_FRAMES)),
+        }
+
+
+def start_request_profiler(req: func.HttpRequest) -> Optional[SamplingProfiler]:
+    if not PROFILING_ENABLED or not PROFILE_SECRET:
+        return None
+    supplied = req.headers.get(PROFILE_HEADER)
+    if not supplied or not hmac.compare_digest(supplied.encode(), PROFILE_SECRET.encode()):
+        return None
+    with _profile_lock:
+        now = time.monotonic()
+        if _profile_state["active"] or now - _profile_state["lastStarted"] < PROFILE_MIN_GAP_SECONDS:
+            logging.info("Profile request skipped: rate limited")
+            return None
+        _profile_state["active"] = True
+        _profile_state["lastStarted"] = now
+    return SamplingProfiler().start()
+
+
+def attach_profile(response: func.HttpResponse, profiler: Optional[SamplingProfiler], handler_name: str) -> func.HttpResponse:
+    if profiler is None:
+        return response
+    profiler.stop()
+    profile = profiler.summary()
+    logging.info("Request profile for %s: %s", handler_name, json.dumps(profile))
+    try:
+        payload = json.loads(response.get_body())
+    except ValueError:
+        return response
+    if not isinstance(payload, dict):
+        return response
+    payload["profile"] = profile
+    return func.HttpResponse(json.dumps(payload), status_code=response.status_code, headers=dict(response.headers), mimetype="application/json")
 
 
 def safe_function(handler):
+    if asyncio.iscoroutinefunction(handler):
+        @wraps(handler)
+        async def async_wrapper(req: func.HttpRequest):
+            started = time.perf_counter()
+            account, token = begin_query_account(handler.__name__, req)
+            profiler = start_request_profiler(req)
+            try:
+                return attach_profile(await handler(req), profiler, handler.__name__)
+            except Exception as ex:
+                logging.exception("Unhandled exception in function %s", handler.__name__)
+                return json_response({"error": "Internal server error", "details": str(ex)}, status=500)
+            finally:
+                if profiler:
+                    profiler.stop()
+                finish_query_account(account, token, started)
+                record_first_request(handler.__name__, started)
+        return async_wrapper
+
     @wraps(handler)
     def wrapper(req: func.HttpRequest):
+        started = time.perf_counter()
+        account, token = begin_query_account(handler.__name__, req)
+        profiler = start_request_profiler(req)
         try:
-            return handler(req)
+            return attach_profile(handler(req), profiler, handler.__name__)
         except Exception as ex:
             logging.exception("Unhandled exception in function %s", handler.__name__)
             return json_response({"error": "Internal server error", "details": str(ex)}, status=500)
+        finally:
+            if profiler:
+                profiler.stop()
+            finish_query_account(account, token, started)
+            record_first_request(handler.__name__, started)
     return wrapper
 
 
@@ -140,24 +606,86 @@ def generate_device_id() -> str:
     return f"dev_{uuid.uuid4().hex[:16]}"
 
 
-def persist_device(device_id: str, ip_address: str, port: int, device_type: str, last_seen: Optional[str] = None) -> dict:
-    now = now_iso()
-    client = get_table_client("Devices")
-    
-    # Try to get existing
-    existing = None
-    if client:
+LIVENESS_TABLE_NAME = "DeviceLiveness"
+LIVENESS_PARTITION = "Deadline"
+DEVICE_OFFLINE_SECONDS = int(os.getenv("DEVICE_OFFLINE_SECONDS", "600"))
+ALERT_REPEAT_SECONDS = int(os.getenv("ALERT_REPEAT_SECONDS", "86400"))
+# Deadlines are rounded up to this many seconds so most ingests land in the
+# same index row and do not need to re-key it.
+LIVENESS_BUCKET_SECONDS = max(1, int(os.getenv("LIVENESS_BUCKET_SECONDS", "300")))
+TABLE_BATCH_SIZE = 100  # Table Storage limit for one entity group transaction
+
+
+def submit_batched(client, operations: list, batch_size: int = TABLE_BATCH_SIZE, failed: Optional[list] = None) -> int:
+    """Submit (op, entity[, kwargs]) tuples as entity group transactions.
+    All operations must target one partition. If a transaction is rejected
+    (e.g. deleting an entity that is already gone) its operations are retried
+    one by one so a single conflict does not drop the rest of the chunk.
+    (operation, error) pairs that still fail are appended to `failed` when given.
+    Returns the number of operations applied."""
+    applied = 0
+    for i in range(0, len(operations), batch_size):
+        chunk = operations[i:i + batch_size]
         try:
-            existing = client.get_entity(partition_key="Device", row_key=ip_address.replace(".", "_"))
-        except:
-            pass
+            client.submit_transaction(chunk)
+            applied += len(chunk)
+            continue
+        except Exception as ex:
+            logging.debug("Transaction of %d operations rejected, applying individually: %s", len(chunk), ex)
+        for op in chunk:
+            action, entity = op[0], op[1]
+            kwargs = dict(op[2]) if len(op) > 2 else {}
+            try:
+                if action == "create":
+                    client.create_entity(entity=entity)
+                elif action == "upsert":
+                    client.upsert_entity(entity=entity, **kwargs)
+                elif action == "update":
+                    client.update_entity(entity=entity, **kwargs)
+                elif action == "delete":
+                    client.delete_entity(partition_key=entity["PartitionKey"], row_key=entity["RowKey"], **kwargs)
+                applied += 1
+            except Exception as ex:
+                logging.warning("Table %s %s failed for %s/%s: %s", action, client.table_name, entity.get("PartitionKey"), entity.get("RowKey"), ex)
+                if failed is not None:
+                    failed.append((op, ex))
+    return applied
+
+
+def liveness_row_key(device_key: str, deadline: datetime.datetime) -> str:
+    epoch = int(deadline.timestamp())
+    bucket = -(-epoch // LIVENESS_BUCKET_SECONDS) * LIVENESS_BUCKET_SECONDS
+    return f"{bucket:010d}_{device_key}"
+
+
+def offline_deadline_key(device_key: str, last_seen) -> Optional[str]:
+    parsed = parse_timestamp_utc(last_seen)
+    if not parsed:
+        return None
+    return liveness_row_key(device_key, parsed + datetime.timedelta(seconds=DEVICE_OFFLINE_SECONDS))
+
+
+def liveness_move_ops(device_key: str, old_key: Optional[str], new_key: str, last_seen: Optional[str]) -> list:
+    ops: list = [("upsert", {
+        "PartitionKey": LIVENESS_PARTITION,
+        "RowKey": new_key,
+        "device": device_key,
+        "lastSeen": last_seen,
+    }, {"mode": UpdateMode.REPLACE})]
+    if old_key and old_key != new_key:
+        ops.append(("delete", {"PartitionKey": LIVENESS_PARTITION, "RowKey": old_key}))
+    return ops
+
 
+def build_device_info(existing, device_id: str, ip_address: str, port: int, device_type: str, last_seen: Optional[str] = None) -> dict:
+    now = now_iso()
     registered_at = existing["registeredAt"] if existing else now
     last_seen_value = last_seen or now
-    
-    device_info = {
+    device_key = ip_address.replace(".", "_")
+
+    return {
         "PartitionKey": "Device",
-        "RowKey": ip_address.replace(".", "_"),
+        "RowKey": device_key,
         "id": device_id,
         "ip": ip_address,
         "port": port,
@@ -165,31 +693,134 @@ def persist_device(device_id: str, ip_address: str, port: int, device_type: str,
         "registeredAt": registered_at,
         "lastSeen": last_seen_value,
         "status": "active",
+        "livenessKey": offline_deadline_key(device_key, last_seen_value),
     }
+
+
+def persist_device(device_id: str, ip_address: str, port: int, device_type: str, last_seen: Optional[str] = None) -> dict:
+    client = get_table_client("Devices")
+    
+    # Try to get existing
+    existing = None
+    if client:
+        try:
+            existing = client.get_entity(partition_key="Device", row_key=ip_address.replace(".", "_"))
+        except:
+            pass
+
+    device_info = build_device_info(existing, device_id, ip_address, port, device_type, last_seen)
+    previous_liveness_key = existing.get("livenessKey") if existing else None
+    liveness_key = device_info["livenessKey"]
     
     if client:
         client.upsert_entity(mode=UpdateMode.REPLACE, entity=device_info)
+        if not existing:
+            _device_list_cache["keys"] = None
+
+    # Only touch the liveness index when the deadline bucket actually moves.
+    if client and liveness_key and liveness_key != previous_liveness_key:
+        index = ensure_table_client(LIVENESS_TABLE_NAME)
+        if index:
+            submit_batched(index, liveness_move_ops(device_info["RowKey"], previous_liveness_key, liveness_key, device_info["lastSeen"]))
     
     return device_info
 
 
+DEVICE_LIST_CACHE_SECONDS = float(os.getenv("DEVICE_LIST_CACHE_SECONDS", "60"))
+_device_list_cache: Dict[str, Any] = {"keys": None, "loadedAt": 0.0}
+
+
 def list_device_partition_keys() -> list:
     """Return a list of RowKey values for all devices (partition keys used in SensorData).
     RowKey in Devices table stores the IP with dots replaced by underscores.
+    The list is cached per instance for DEVICE_LIST_CACHE_SECONDS.
     """
+    cached = _device_list_cache["keys"]
+    if cached is not None and time.monotonic() - _device_list_cache["loadedAt"] < DEVICE_LIST_CACHE_SECONDS:
+        return list(cached)
+
     client = get_table_client("Devices")
     if not client:
         return []
     try:
-        devices = list(client.query_entities(query_filter="PartitionKey eq 'Device'"))
+        devices = list(client.query_entities(query_filter="PartitionKey eq 'Device'", select=["RowKey"]))
         keys = [d.get("RowKey") for d in devices if d.get("RowKey")]
-        return keys
+        _device_list_cache.update(keys=keys, loadedAt=time.monotonic())
+        return list(keys)
     except Exception as e:
         logging.error("Failed to list device partitions: %s", e)
         return []
 
 
-def store_sensor_entry(payload: dict) -> dict:
+# Time-sharded raw partitions. SENSOR_PARTITION_SCHEME=month (or week) writes
+# SensorData rows to "<device>|2024-05" ("<device>|2024-W19") partitions picked
+# by the RowKey time, spreading a device's history over many partitions; reads
+# plan the shards a time range covers and query them in parallel. "device",
+# the default, keeps one partition per device. SENSOR_LEGACY_PARTITION_READS
+# also reads the old per-device partition while scripts/migrate_partitions.py
+# moves it into shards. Unbounded ranges start at SENSOR_SHARD_START.
+SENSOR_PARTITION_SCHEME = os.getenv("SENSOR_PARTITION_SCHEME", "device").strip().lower()
+SENSOR_LEGACY_PARTITION_READS = os.getenv("SENSOR_LEGACY_PARTITION_READS", "").strip().lower() in ("1", "true", "yes")
+SENSOR_SHARD_START = os.getenv("SENSOR_SHARD_START", "2024-01-01T00:00:00Z")
+
+
+def sensor_shard(moment: datetime.datetime) -> str:
+    if SENSOR_PARTITION_SCHEME == "week":
+        year, week, _ = moment.isocalendar()
+        return f"{year}-W{week:02d}"
+    return f"{moment.year}-{moment.month:02d}"
+
+
+def sensor_partition_key(device_key: str, epoch: int) -> str:
+    """SensorData PartitionKey for a reading of `device_key` at `epoch`."""
+    if SENSOR_PARTITION_SCHEME not in ("month", "week"):
+        return device_key
+    return f"{device_key}|{sensor_shard(datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc))}"
+
+
+def sensor_shard_keys(device_key: str, since: Optional[datetime.datetime], until: Optional[datetime.datetime]) -> list:
+    """Every shard partition of `device_key` that can hold RowKeys in [since, until].
+    An open end runs to a day past now to allow for device clock skew."""
+    start = since or parse_timestamp_utc(SENSOR_SHARD_START)
+    end = until or datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
+    if SENSOR_PARTITION_SCHEME == "week":
+        cursor = (start - datetime.timedelta(days=start.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+        step = lambda d: d + datetime.timedelta(days=7)
+    else:
+        cursor = start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        step = lambda d: (d + datetime.timedelta(days=32)).replace(day=1)
+    keys = []
+    while cursor <= end:
+        keys.append(f"{device_key}|{sensor_shard(cursor)}")
+        cursor = step(cursor)
+    return keys
+
+
+def raw_partition_filters(device_key: str, since: Optional[datetime.datetime], until: Optional[datetime.datetime] = None, time_filter: Optional[str] = None) -> list:
+    """Query filters that together read `device_key`'s raw rows for a time range:
+    one per partition under the active scheme. `time_filter` defaults to the
+    RowKey lower bound for `since`."""
+    time_filter = raw_time_filter(since) if time_filter is None else time_filter
+    suffix = f" and {time_filter}" if time_filter else ""
+    if SENSOR_PARTITION_SCHEME not in ("month", "week"):
+        return [f"PartitionKey eq '{device_key}'{suffix}"]
+    filters = [f"PartitionKey eq '{pk}'{suffix}" for pk in sensor_shard_keys(device_key, since, until)]
+    if SENSOR_LEGACY_PARTITION_READS:
+        # The legacy partition holds the oldest rows, so it goes first.
+        filters.insert(0, f"PartitionKey eq '{device_key}'{suffix}")
+    return filters
+
+
+def group_by_partition(entities: list) -> list:
+    groups: Dict[str, list] = {}
+    for e in entities:
+        groups.setdefault(e["PartitionKey"], []).append(e)
+    return list(groups.values())
+
+
+def build_sensor_entry(payload: dict) -> tuple:
+    """Normalize an ingest payload into a SensorData entity.
+    Returns (entry, device_ts_provided)."""
     # Prefer device-provided timestamp when valid; otherwise use server time.
     device_ts_raw = payload.get("timestamp")
     parsed_dt = None
@@ -255,7 +886,7 @@ def store_sensor_entry(payload: dict) -> dict:
     )
     
     entry = {
-        "PartitionKey": device_ip.replace(".", "_"),
+        "PartitionKey": sensor_partition_key(device_ip.replace(".", "_"), int(now.timestamp())),
         "RowKey": f"{int(now.timestamp()):010d}_{uuid.uuid4().hex[:8]}",
         "deviceIp": device_ip,
         "deviceId": payload.get("deviceId"),
@@ -275,13 +906,532 @@ def store_sensor_entry(payload: dict) -> dict:
     }
 
     logging.info("Sensor entry to store: %s", json.dumps(entry, default=str))
-    
-    client = get_table_client("SensorData")
+    return entry, bool(parsed_dt)
+
+
+# Chunked raw storage. With SENSOR_STORAGE_MODE=dual every device-hour of
+# readings is also packed into one SensorChunks entity (PartitionKey = device,
+# RowKey = hour start epoch), and history reads come from the chunks. Each
+# metric is a binary column: a presence bitmap followed by zigzag varint
+# deltas of the value quantized by CHUNK_SCALES; timestamps are varint deltas
+# from the hour start. Chunks make reads cheaper, not writes: every flush is a
+# get_entity plus a conditional update on top of the SensorData insert. A
+# chunks-only mode is not supported, because the rollup backfill/verify
+# scripts and the raw retention timer read SensorData; "chunks" runs as "dual".
+SENSOR_STORAGE_MODE = os.getenv("SENSOR_STORAGE_MODE", "rows").strip().lower()
+if SENSOR_STORAGE_MODE == "chunks":
+    logging.warning("SENSOR_STORAGE_MODE=chunks is not supported (rollups and retention read SensorData); using dual")
+    SENSOR_STORAGE_MODE = "dual"
+CHUNK_TABLE_NAME = "SensorChunks"
+CHUNK_SECONDS = 3600
+CHUNK_SCALES = {"moisture": 100, "temperature": 100, "humidity": 100, "battery": 1000, "ph": 100, "light": 1}
+# Readings are buffered per device-hour and merged into the chunk once this
+# many are pending or the oldest is CHUNK_FLUSH_SECONDS old; a background
+# timer flushes stale buffers when no further reading arrives, and exit
+# flushes everything. A failed merge goes to the spill journal. Buffered
+# readings are still lost if the instance dies, so the default writes through.
+CHUNK_BUFFER_MAX_READINGS = max(1, int(os.getenv("CHUNK_BUFFER_MAX_READINGS", "1")))
+CHUNK_FLUSH_SECONDS = float(os.getenv("CHUNK_FLUSH_SECONDS", "60"))
+
+_chunk_buffer: Dict[tuple, list] = {}
+_chunk_buffer_since: Dict[tuple, float] = {}
+_chunk_buffer_lock = threading.Lock()
+_chunk_flush_timer: Optional[threading.Timer] = None
+
+
+def chunk_writes_enabled() -> bool:
+    return SENSOR_STORAGE_MODE in ("chunks", "dual")
+
+
+def row_writes_enabled() -> bool:
+    return SENSOR_STORAGE_MODE != "chunks"
+
+
+def _put_varint(out: bytearray, value: int) -> None:
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _get_varint(data: bytes, pos: int) -> tuple:
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def encode_chunk(chunk_start: int, readings: list) -> Dict[str, Any]:
+    """Encode readings ({"ts": epoch seconds, <metric>: float|None}) into chunk columns."""
+    readings = sorted(readings, key=lambda r: r["ts"])
+    columns: Dict[str, Any] = {"n": len(readings)}
+
+    ts_col = bytearray()
+    prev = chunk_start
+    for r in readings:
+        _put_varint(ts_col, r["ts"] - prev)
+        prev = r["ts"]
+    columns["ts"] = bytes(ts_col)
+
+    for field, scale in CHUNK_SCALES.items():
+        bitmap = bytearray((len(readings) + 7) // 8)
+        values = bytearray()
+        prev_q = 0
+        for i, r in enumerate(readings):
+            value = r.get(field)
+            if value is None:
+                continue
+            bitmap[i >> 3] |= 1 << (i & 7)
+            q = int(round(value * scale))
+            delta = q - prev_q
+            _put_varint(values, (delta << 1) ^ (delta >> 63))
+            prev_q = q
+        columns[field] = bytes(bitmap + values) if values else None
+    return columns
+
+
+def decode_chunk(entity) -> list:
+    """Inverse of encode_chunk; returns readings sorted by time."""
+    n = int(entity.get("n") or 0)
+    if not n:
+        return []
+    chunk_start = int(entity["RowKey"])
+    ts_col = bytes(entity.get("ts") or b"")
+    readings = []
+    pos = 0
+    prev = chunk_start
+    for _ in range(n):
+        delta, pos = _get_varint(ts_col, pos)
+        prev += delta
+        readings.append({"ts": prev})
+
+    bitmap_len = (n + 7) // 8
+    for field, scale in CHUNK_SCALES.items():
+        column = entity.get(field)
+        if not column:
+            continue
+        column = bytes(column)
+        pos = bitmap_len
+        prev_q = 0
+        for i in range(n):
+            if column[i >> 3] & (1 << (i & 7)):
+                raw_delta, pos = _get_varint(column, pos)
+                prev_q += (raw_delta >> 1) ^ -(raw_delta & 1)
+                readings[i][field] = prev_q / scale if scale != 1 else prev_q
+    return readings
+
+
+def chunk_rows(entity, since: Optional[datetime.datetime] = None, until: Optional[datetime.datetime] = None) -> list:
+    """Expand a chunk entity into SensorData-shaped rows for shape_raw_history."""
+    since_ts = int(since.timestamp()) if since else None
+    until_ts = int(until.timestamp()) if until else None
+    rows = []
+    for r in decode_chunk(entity):
+        ts = r["ts"]
+        if (since_ts is not None and ts < since_ts) or (until_ts is not None and ts > until_ts):
+            continue
+        row = {field: r.get(field) for field in CHUNK_SCALES}
+        row["timestamp"] = datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).isoformat().replace("+00:00", "Z")
+        row["deviceIp"] = entity.get("deviceIp")
+        row["deviceId"] = entity.get("deviceId")
+        rows.append(row)
+    return rows
+
+
+def chunk_query_filter(partition_key: Optional[str], since: Optional[datetime.datetime], until: Optional[datetime.datetime] = None) -> str:
+    parts = [f"PartitionKey eq '{partition_key}'"] if partition_key else []
+    if since:
+        parts.append(f"RowKey ge '{int(since.timestamp()) // CHUNK_SECONDS * CHUNK_SECONDS:010d}'")
+    if until:
+        parts.append(f"RowKey le '{int(until.timestamp()):010d}'")
+    return " and ".join(parts)
+
+
+def merge_into_chunk(client, partition_key: str, chunk_start: int, readings: list, device_ip: str, device_id: Optional[str]) -> None:
+    """Read-modify-write one chunk, retrying when another writer got there first."""
+    row_key = f"{chunk_start:010d}"
+    for _ in range(5):
+        existing = None
+        try:
+            existing = client.get_entity(partition_key=partition_key, row_key=row_key)
+        except ResourceNotFoundError:
+            pass
+        # One reading per device-second, so replaying a merge that did land
+        # (e.g. from the spill journal) replaces rather than duplicates it.
+        merged = list({r["ts"]: r for r in (decode_chunk(existing) if existing else []) + readings}.values())
+        entity = {
+            "PartitionKey": partition_key,
+            "RowKey": row_key,
+            "deviceIp": device_ip,
+            "deviceId": device_id or (existing.get("deviceId") if existing else None),
+            **encode_chunk(chunk_start, merged),
+        }
+        try:
+            if existing:
+                client.update_entity(mode=UpdateMode.REPLACE, entity=entity, etag=existing.metadata.get("etag"), match_condition=MatchConditions.IfNotModified)
+            else:
+                client.create_entity(entity=entity)
+            return
+        except (ResourceModifiedError, ResourceExistsError):
+            continue
+    raise RuntimeError(f"Gave up merging chunk {partition_key}/{row_key} after repeated conflicts")
+
+
+def flush_chunk_buffers(force: bool = False) -> int:
+    """Write out buffered device-hours that are full, stale, or all of them when `force`."""
+    now = time.monotonic()
+    with _chunk_buffer_lock:
+        due = [key for key, readings in _chunk_buffer.items()
+               if force or len(readings) >= CHUNK_BUFFER_MAX_READINGS or now - _chunk_buffer_since[key] >= CHUNK_FLUSH_SECONDS]
+        batches = [(key, _chunk_buffer.pop(key)) for key in due]
+        for key in due:
+            _chunk_buffer_since.pop(key, None)
+
+    client = ensure_table_client(CHUNK_TABLE_NAME)
+    if not client:
+        return 0
+    written = 0
+    for (partition_key, chunk_start), readings in batches:
+        device_ip = readings[-1]["deviceIp"]
+        device_id = readings[-1].get("deviceId")
+        try:
+            merge_into_chunk(client, partition_key, chunk_start, readings, device_ip, device_id)
+            written += len(readings)
+        except Exception as e:
+            logging.error("Failed to write sensor chunk %s/%s: %s", partition_key, chunk_start, e)
+            spill_failed_writes(CHUNK_TABLE_NAME, [{
+                "PartitionKey": partition_key,
+                "RowKey": f"{chunk_start:010d}",
+                "deviceIp": device_ip,
+                "deviceId": device_id,
+                "readings": readings,
+            }], e)
+    return written
+
+
+def schedule_chunk_flush() -> None:
+    """Arm the background flush while readings are buffered, so a device that
+    goes quiet still has its last device-hour written."""
+    global _chunk_flush_timer
+    with _chunk_buffer_lock:
+        if not _chunk_buffer or _chunk_flush_timer is not None:
+            return
+        _chunk_flush_timer = threading.Timer(CHUNK_FLUSH_SECONDS, _flush_chunks_on_timer)
+        _chunk_flush_timer.daemon = True
+        _chunk_flush_timer.start()
+
+
+def _flush_chunks_on_timer() -> None:
+    global _chunk_flush_timer
+    try:
+        flush_chunk_buffers()
+    except Exception as e:
+        logging.error("Background chunk flush failed: %s", e)
+    with _chunk_buffer_lock:
+        _chunk_flush_timer = None
+    schedule_chunk_flush()
+
+
+atexit.register(flush_chunk_buffers, True)
+
+
+def append_to_chunks(entries: list) -> None:
+    """Buffer SensorData entries into their device-hour chunks and flush what is due."""
+    with _chunk_buffer_lock:
+        for entry in entries:
+            ts = parse_timestamp_utc(entry.get("timestamp"))
+            if not ts:
+                continue
+            epoch = int(ts.timestamp())
+            key = (str(entry.get("deviceIp")).replace(".", "_"), epoch // CHUNK_SECONDS * CHUNK_SECONDS)
+            reading = {"ts": epoch, "deviceIp": entry.get("deviceIp"), "deviceId": entry.get("deviceId")}
+            for field in CHUNK_SCALES:
+                value = entry.get(field)
+                reading[field] = float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+            _chunk_buffer.setdefault(key, []).append(reading)
+            _chunk_buffer_since.setdefault(key, time.monotonic())
+    flush_chunk_buffers()
+    schedule_chunk_flush()
+
+
+def fetch_chunk_entities(partition_keys: list, since: Optional[datetime.datetime], until: Optional[datetime.datetime]) -> list:
+    client = get_table_client(CHUNK_TABLE_NAME)
+    if not client:
+        return []
+    rows = []
+    for pk in partition_keys or [None]:
+        q = chunk_query_filter(pk, since, until)
+        try:
+            for chunk in client.query_entities(query_filter=q):
+                rows.extend(chunk_rows(chunk, since, until))
+        except Exception as ex:
+            logging.debug("Chunk query failed (%s): %s", q, ex)
+    return rows
+
+
+# Spill journal. A SensorData write that fails (throttling, outage) is
+# appended to a local JSON-lines file instead of being dropped, and a
+# background thread replays it in entity group transactions once storage
+# accepts writes again. Replays are upserts, so a row that was in fact written
+# before its error is simply rewritten. Failed SensorChunks merges are
+# journaled as their readings and replayed through merge_into_chunk. Each
+# worker process owns its own journal (the pid is part of the file name), so
+# with FUNCTIONS_WORKER_PROCESS_COUNT > 1 no two processes append to or
+# rewrite the same file; journals left by processes that have exited are
+# adopted by the next process that loads its journal. A per-process timer
+# retries the drain every SPILL_RETRY_SECONDS while entries remain, so the
+# journal empties even when ingest pauses. Each journal is bounded by
+# SPILL_JOURNAL_MAX_ENTRIES (further failures are dropped and counted) and
+# lives in local temp storage, so it does not survive the instance itself.
+SPILL_JOURNAL_BASE = os.getenv("SPILL_JOURNAL_PATH") or os.path.join(tempfile.gettempdir(), "sensor-spill.jsonl")
+SPILL_JOURNAL_PATH = "{0}.{2}{1}".format(*os.path.splitext(SPILL_JOURNAL_BASE), os.getpid())
+SPILL_JOURNAL_MAX_ENTRIES = int(os.getenv("SPILL_JOURNAL_MAX_ENTRIES", "50000"))
+SPILL_RETRY_SECONDS = float(os.getenv("SPILL_RETRY_SECONDS", "30"))
+_spill_lock = threading.Lock()
+_spill_timer: Optional[threading.Timer] = None
+_spill_state: Dict[str, Any] = {
+    "depth": None, "oldest": None, "spilled": 0, "dropped": 0, "replayed": 0,
+    "lastAttempt": 0.0, "lastError": None, "draining": False,
+}
+
+
+def _read_spill_records(path: str) -> list:
+    records = []
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            for line in fh:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A torn last line from a crash mid-append.
+                    logging.warning("Skipping unreadable spill journal line in %s", path)
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _adopt_orphan_journals() -> None:
+    """Move the entries of journals whose process has exited into this one.
+    The rename is the claim, so only one live process adopts each file."""
+    if os.name != "posix":
+        return  # os.kill(pid, 0) would terminate the process on Windows.
+    root, ext = os.path.splitext(SPILL_JOURNAL_BASE)
+    candidates = [SPILL_JOURNAL_BASE, SPILL_JOURNAL_BASE + ".draining"]
+    candidates += glob.glob(glob.escape(root) + ".*" + glob.escape(ext)) + glob.glob(glob.escape(root) + ".*" + glob.escape(ext) + ".draining")
+    for path in candidates:
+        owner = path[len(root) + 1:].split(".", 1)[0] if path.startswith(root + ".") else ""
+        if owner.isdigit() and (int(owner) == os.getpid() or _process_alive(int(owner))):
+            continue
+        claimed = f"{SPILL_JOURNAL_PATH}.adopt"
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            continue  # Gone, or another process claimed it first.
+        records = _read_spill_records(claimed)
+        if records:
+            with open(SPILL_JOURNAL_PATH, "a", encoding="utf-8") as fh:
+                for record in records:
+                    fh.write(json.dumps(record, default=str) + "\n")
+                fh.flush()
+                os.fsync(fh.fileno())
+            logging.info("Adopted %d spilled writes from %s", len(records), path)
+        os.remove(claimed)
+
+
+def _load_spill_state() -> None:
+    # Caller holds _spill_lock. Counts whatever an earlier process left behind.
+    if _spill_state["depth"] is not None:
+        return
+    try:
+        _adopt_orphan_journals()
+    except Exception as ex:
+        logging.error("Adopting orphaned spill journals failed: %s", ex)
+    records = _read_spill_records(SPILL_JOURNAL_PATH + ".draining") + _read_spill_records(SPILL_JOURNAL_PATH)
+    _spill_state["depth"] = len(records)
+    _spill_state["oldest"] = min((r.get("spilledAt", 0) for r in records), default=None)
+
+
+def spill_failed_writes(table_name: str, entities: list, error: Exception) -> None:
+    """Journal entities whose write failed so the drain can replay them."""
+    if isinstance(error, ResourceExistsError) or not entities:
+        return  # Already stored.
+    now = time.time()
+    with _spill_lock:
+        _load_spill_state()
+        room = max(0, SPILL_JOURNAL_MAX_ENTRIES - _spill_state["depth"])
+        kept, dropped = entities[:room], len(entities) - min(room, len(entities))
+        if kept:
+            with open(SPILL_JOURNAL_PATH, "a", encoding="utf-8") as fh:
+                for entity in kept:
+                    fh.write(json.dumps({"table": table_name, "spilledAt": now, "entity": entity}, default=str) + "\n")
+                fh.flush()
+                os.fsync(fh.fileno())
+            _spill_state["depth"] += len(kept)
+            _spill_state["spilled"] += len(kept)
+            _spill_state["oldest"] = _spill_state["oldest"] or now
+        _spill_state["dropped"] += dropped
+    logging.warning("Spilled %d failed %s writes to %s (dropped %d, journal full): %s", len(kept), table_name, SPILL_JOURNAL_PATH, dropped, error)
+    arm_spill_drain_timer()
+
+
+def arm_spill_drain_timer() -> None:
+    """Retry the drain after SPILL_RETRY_SECONDS unless a retry is already pending."""
+    global _spill_timer
+    with _spill_lock:
+        if _spill_timer is not None:
+            return
+        _spill_timer = threading.Timer(SPILL_RETRY_SECONDS, _drain_spill_on_timer)
+        _spill_timer.daemon = True
+        _spill_timer.start()
+
+
+def _drain_spill_on_timer() -> None:
+    global _spill_timer
+    with _spill_lock:
+        _spill_timer = None
+        _spill_state["lastAttempt"] = 0.0
+    schedule_spill_drain()
+    with _spill_lock:
+        # A drain that starts now re-arms the timer itself when it finishes.
+        retry = bool(_spill_state["depth"]) and not _spill_state["draining"]
+    if retry:
+        arm_spill_drain_timer()
+
+
+def schedule_spill_drain() -> None:
+    """Start a background replay if entries are waiting and the last attempt is old enough."""
+    with _spill_lock:
+        _load_spill_state()
+        if not _spill_state["depth"] or _spill_state["draining"]:
+            return
+        if time.monotonic() - _spill_state["lastAttempt"] < SPILL_RETRY_SECONDS:
+            return
+        _spill_state["draining"] = True
+    threading.Thread(target=drain_spill_journal, name="spill-drain", daemon=True).start()
+
+
+def drain_spill_journal() -> int:
+    """Replay journaled writes per partition in transactions, stopping at the
+    first rejection. Returns the number replayed."""
+    draining = SPILL_JOURNAL_PATH + ".draining"
+    replayed = 0
+    error = None
+    try:
+        with _spill_lock:
+            # New failures keep appending to the journal while this batch replays.
+            if not os.path.exists(draining) and os.path.exists(SPILL_JOURNAL_PATH):
+                os.replace(SPILL_JOURNAL_PATH, draining)
+            records = _read_spill_records(draining)
+
+        groups: Dict[tuple, list] = {}
+        for record in records:
+            groups.setdefault((record["table"], record["entity"]["PartitionKey"]), []).append(record)
+        remaining = []
+        for (table_name, _), group in groups.items():
+            client = None if error else get_table_client(table_name)
+            if table_name == CHUNK_TABLE_NAME:
+                # Chunk records hold readings to merge, not whole entities.
+                for record in group:
+                    if error or client is None:
+                        remaining.append(record)
+                        continue
+                    entity = record["entity"]
+                    try:
+                        merge_into_chunk(client, entity["PartitionKey"], int(entity["RowKey"]), entity["readings"], entity.get("deviceIp"), entity.get("deviceId"))
+                        replayed += 1
+                    except Exception as ex:
+                        error = ex
+                        remaining.append(record)
+                continue
+            for i in range(0, len(group), TABLE_BATCH_SIZE):
+                chunk = group[i:i + TABLE_BATCH_SIZE]
+                if error or client is None:
+                    remaining.extend(chunk)
+                    continue
+                try:
+                    client.submit_transaction([("upsert", r["entity"], {"mode": UpdateMode.REPLACE}) for r in chunk])
+                    replayed += len(chunk)
+                except Exception as ex:
+                    error = ex
+                    remaining.extend(chunk)
+
+        with _spill_lock:
+            newer = _read_spill_records(SPILL_JOURNAL_PATH)
+            kept = sorted(remaining, key=lambda r: r.get("spilledAt", 0)) + newer
+            tmp = SPILL_JOURNAL_PATH + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as fh:
+                for record in kept:
+                    fh.write(json.dumps(record, default=str) + "\n")
+            os.replace(tmp, SPILL_JOURNAL_PATH)
+            if os.path.exists(draining):
+                os.remove(draining)
+            _spill_state["depth"] = len(kept)
+            _spill_state["oldest"] = min((r.get("spilledAt", 0) for r in kept), default=None)
+            _spill_state["replayed"] += replayed
+            _spill_state["lastError"] = str(error) if error else None
+    except Exception as ex:
+        logging.error("Spill journal drain failed: %s", ex)
+        _spill_state["lastError"] = str(ex)
+    finally:
+        _spill_state["lastAttempt"] = time.monotonic()
+        _spill_state["draining"] = False
+    if replayed or error:
+        logging.info("Spill journal replayed %d writes; %d left (%s)", replayed, _spill_state["depth"] or 0, error or "storage accepting writes")
+    if _spill_state["depth"]:
+        arm_spill_drain_timer()
+    return replayed
+
+
+def spill_journal_stats() -> Dict[str, Any]:
+    with _spill_lock:
+        _load_spill_state()
+        oldest = _spill_state["oldest"]
+        return {
+            "path": SPILL_JOURNAL_PATH,
+            "depth": _spill_state["depth"],
+            "maxEntries": SPILL_JOURNAL_MAX_ENTRIES,
+            "oldestAgeSeconds": round(time.time() - oldest, 1) if oldest else None,
+            "spilled": _spill_state["spilled"],
+            "dropped": _spill_state["dropped"],
+            "replayed": _spill_state["replayed"],
+            "draining": _spill_state["draining"],
+            "lastError": _spill_state["lastError"],
+        }
+
+
+# First check shortly after start-up picks up journals a previous process left.
+arm_spill_drain_timer()
+
+
+def store_sensor_entry(payload: dict) -> dict:
+    entry, device_ts_provided = build_sensor_entry(payload)
+    device_ip = entry["deviceIp"]
+    timestamp = entry["timestamp"]
+
+    client = get_table_client("SensorData") if row_writes_enabled() else None
     if client:
         try:
             client.create_entity(entity=entry)
         except Exception as e:
             logging.error("Failed to save sensor entry to Table Storage: %s", e)
+            spill_failed_writes("SensorData", [entry], e)
+    if chunk_writes_enabled():
+        append_to_chunks([entry])
 
     # Also update/ensure device entry exists (propagate lastSeen if device supplied timestamp)
     try:
@@ -295,42 +1445,255 @@ def store_sensor_entry(payload: dict) -> dict:
     except Exception as e:
         logging.error(f"Failed to auto-persist device: {e}")
         
-    logging.info("Sensor data recorded for %s (device_ts_provided=%s)", device_ip, bool(parsed_dt))
+    logging.info("Sensor data recorded for %s (device_ts_provided=%s)", device_ip, device_ts_provided)
+    return entry
+
+
+# Compact ingest format for microcontrollers (Content-Type: text/x-sensor-lines).
+# One header line names the device, then one line per reading with fields in
+# a fixed order; empty fields are missing values:
+#
+#   @192.168.1.33,dev_abc123
+#   1760000000,41.2,22.5,55.0,3.91,6.8,512
+#   -60,41.0,22.4,,3.91,,
+#
+# The timestamp is epoch seconds, a negative age in seconds relative to when
+# the body was received (for buffered readings without NTP), or empty for now.
+SENSOR_LINES_CONTENT_TYPE = "text/x-sensor-lines"
+SENSOR_LINE_FIELDS = ("moisture", "temperature", "humidity", "battery", "ph", "light")
+INGEST_MAX_READINGS = int(os.getenv("INGEST_MAX_READINGS", "500"))
+
+
+def parse_sensor_lines(body: bytes, received_at: Optional[float] = None) -> list:
+    """Decode a text/x-sensor-lines body into payload dicts for build_sensor_entry.
+    Raises ValueError on malformed input."""
+    received_at = time.time() if received_at is None else received_at
+    lines = body.decode("ascii").splitlines()
+    device = None
+    payloads = []
+    field_count = len(SENSOR_LINE_FIELDS)
+
+    def finite(raw_value: str, line_no: int) -> float:
+        value = float(raw_value)
+        if not math.isfinite(value):
+            raise ValueError(f"line {line_no}: {raw_value.strip()} is not a finite number")
+        return value
+
+    for line_no, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line or line[0] == "#":
+            continue
+        if line[0] == "@":
+            if device is not None:
+                raise ValueError(f"line {line_no}: only one @deviceIp header is allowed per body")
+            header = line[1:].split(",")
+            device = {"deviceIp": header[0].strip()}
+            if len(header) > 1 and header[1].strip():
+                device["deviceId"] = header[1].strip()
+            continue
+        if device is None or not device["deviceIp"]:
+            raise ValueError(f"line {line_no}: reading before @deviceIp header")
+
+        parts = line.split(",")
+        if len(parts) > field_count + 1:
+            raise ValueError(f"line {line_no}: expected at most {field_count + 1} fields")
+        payload = dict(device)
+        ts = parts[0]
+        if ts:
+            ts_value = finite(ts, line_no)
+            payload["timestamp"] = received_at + ts_value if ts_value <= 0 else ts_value
+        for name, raw_value in zip(SENSOR_LINE_FIELDS, parts[1:]):
+            if raw_value:
+                payload[name] = finite(raw_value, line_no)
+        payloads.append(payload)
+        if len(payloads) > INGEST_MAX_READINGS:
+            raise ValueError(f"more than {INGEST_MAX_READINGS} readings in one body")
+    return payloads
+
+
+def store_sensor_entries(payloads: list) -> list:
+    """Store several readings from one device: the SensorData rows go in
+    entity group transactions and the device row is updated once."""
+    built = [build_sensor_entry(p)[0] for p in payloads]
+    if not built:
+        return []
+    client = get_table_client("SensorData") if row_writes_enabled() else None
+    if client:
+        failed: list = []
+        for group in group_by_partition(built):
+            submit_batched(client, [("create", e) for e in group], failed=failed)
+        for op, ex in failed:
+            spill_failed_writes("SensorData", [op[1]], ex)
+    if chunk_writes_enabled():
+        append_to_chunks(built)
+
+    latest = max(built, key=lambda e: e["RowKey"])
+    try:
+        persist_device(
+            payloads[0].get("deviceId", "unknown"),
+            latest["deviceIp"],
+            payloads[0].get("port", 80),
+            payloads[0].get("deviceType", "soil_sensor"),
+            last_seen=latest["timestamp"]
+        )
+    except Exception as e:
+        logging.error(f"Failed to auto-persist device: {e}")
+    return built
+
+
+async def persist_device_async(device_id: str, ip_address: str, port: int, device_type: str, last_seen: Optional[str] = None) -> dict:
+    client = get_async_table_client("Devices")
+    if not client:
+        return await asyncio.to_thread(persist_device, device_id, ip_address, port, device_type, last_seen)
+
+    existing = None
+    try:
+        existing = await client.get_entity(partition_key="Device", row_key=ip_address.replace(".", "_"))
+    except Exception:
+        pass
+
+    device_info = build_device_info(existing, device_id, ip_address, port, device_type, last_seen)
+    previous_liveness_key = existing.get("livenessKey") if existing else None
+    liveness_key = device_info["livenessKey"]
+
+    await client.upsert_entity(mode=UpdateMode.REPLACE, entity=device_info)
+    if not existing:
+        _device_list_cache["keys"] = None
+
+    # Index moves are rare (once per LIVENESS_BUCKET_SECONDS) so reuse the sync batch helper.
+    if liveness_key and liveness_key != previous_liveness_key:
+        index = await asyncio.to_thread(ensure_table_client, LIVENESS_TABLE_NAME)
+        if index:
+            ops = liveness_move_ops(device_info["RowKey"], previous_liveness_key, liveness_key, device_info["lastSeen"])
+            await asyncio.to_thread(submit_batched, index, ops)
+
+    return device_info
+
+
+async def store_sensor_entry_async(payload: dict) -> dict:
+    """Async variant of store_sensor_entry: the SensorData write and the
+    Devices update run concurrently instead of one after the other."""
+    client = get_async_table_client("SensorData")
+    if not client:
+        return await asyncio.to_thread(store_sensor_entry, payload)
+
+    entry, device_ts_provided = build_sensor_entry(payload)
+    device_ip = entry["deviceIp"]
+
+    async def write_entry():
+        if chunk_writes_enabled():
+            await asyncio.to_thread(append_to_chunks, [entry])
+        if not row_writes_enabled():
+            return
+        try:
+            await client.create_entity(entity=entry)
+        except Exception as e:
+            logging.error("Failed to save sensor entry to Table Storage: %s", e)
+            # The journal append fsyncs, so keep it off the event loop.
+            await asyncio.to_thread(spill_failed_writes, "SensorData", [entry], e)
+
+    async def write_device():
+        try:
+            await persist_device_async(
+                payload.get("deviceId", "unknown"),
+                device_ip,
+                payload.get("port", 80),
+                payload.get("deviceType", "soil_sensor"),
+                last_seen=entry["timestamp"]
+            )
+        except Exception as e:
+            logging.error(f"Failed to auto-persist device: {e}")
+
+    await asyncio.gather(write_entry(), write_device())
+    logging.info("Sensor data recorded for %s (device_ts_provided=%s)", device_ip, device_ts_provided)
     return entry
 
 
+async def store_sensor_entries_async(payloads: list) -> list:
+    client = get_async_table_client("SensorData")
+    if not client:
+        return await asyncio.to_thread(store_sensor_entries, payloads)
+
+    built = [build_sensor_entry(p)[0] for p in payloads]
+    if not built:
+        return []
+    latest = max(built, key=lambda e: e["RowKey"])
+
+    async def write_entries():
+        if chunk_writes_enabled():
+            await asyncio.to_thread(append_to_chunks, built)
+        if not row_writes_enabled():
+            return
+        chunks = [group[i:i + TABLE_BATCH_SIZE] for group in group_by_partition(built) for i in range(0, len(group), TABLE_BATCH_SIZE)]
+        for chunk in chunks:
+            try:
+                await client.submit_transaction([("create", e) for e in chunk])
+            except Exception as e:
+                logging.warning("Sensor batch of %d rejected, writing individually: %s", len(chunk), e)
+                failed, error = [], e
+                for entry in chunk:
+                    try:
+                        await client.create_entity(entity=entry)
+                    except Exception as ex:
+                        logging.error("Failed to save sensor entry to Table Storage: %s", ex)
+                        if not isinstance(ex, ResourceExistsError):
+                            failed.append(entry)
+                            error = ex
+                if failed:
+                    # One journal append (and fsync) per chunk, off the event loop.
+                    await asyncio.to_thread(spill_failed_writes, "SensorData", failed, error)
+
+    async def write_device():
+        try:
+            await persist_device_async(
+                payloads[0].get("deviceId", "unknown"),
+                latest["deviceIp"],
+                payloads[0].get("port", 80),
+                payloads[0].get("deviceType", "soil_sensor"),
+                last_seen=latest["timestamp"]
+            )
+        except Exception as e:
+            logging.error(f"Failed to auto-persist device: {e}")
+
+    await asyncio.gather(write_entries(), write_device())
+    return built
+
+
 def fetch_latest_sensor_entry(device_ip: Optional[str] = None, device_id: Optional[str] = None) -> Optional[dict]:
     client = get_table_client("SensorData")
     if not client:
         return None
 
-    query = ""
-    if device_ip:
-        query = f"PartitionKey eq '{device_ip.replace('.', '_')}'"
-    
+    def query_recent(since_dt: datetime.datetime) -> list:
+        if not device_ip:
+            return list(client.query_entities(query_filter=raw_time_filter(since_dt)))
+        rows = []
+        for q in raw_partition_filters(device_ip.replace('.', '_'), since_dt):
+            rows.extend(client.query_entities(query_filter=q))
+        return rows
+
     # Tables don't support easy "latest" across all partitions.
     # We restrict the search to recent data (last hour) to avoid massive table scans.
     now = datetime.datetime.now(datetime.timezone.utc)
     since = now - datetime.timedelta(hours=1)
-    time_filter = f"RowKey ge '{int(since.timestamp()):010d}_0'"
-    
-    query = f"({query}) and {time_filter}" if query else time_filter
 
-    try:
-        # Get entities and sort them to find the true latest
-        entities = list(client.query_entities(query_filter=query))
-    except Exception as e:
-        logging.error(f"Table query error: {e}")
-        return None
+    if chunk_writes_enabled():
+        partition_keys = [device_ip.replace('.', '_')] if device_ip else list_device_partition_keys()
+        entities = fetch_chunk_entities(partition_keys, since, None)
+        if not entities:
+            entities = fetch_chunk_entities(partition_keys, now - datetime.timedelta(hours=24), None)
+    else:
+        try:
+            # Get entities and sort them to find the true latest
+            entities = query_recent(since)
+        except Exception as e:
+            logging.error(f"Table query error: {e}")
+            return None
         
-    if not entities:
+    if not entities and not chunk_writes_enabled():
         # Fall back to a wider search if no data in the last hour
-        since_24h = now - datetime.timedelta(hours=24)
-        query_24h = f"RowKey ge '{int(since_24h.timestamp()):010d}_0'"
-        if device_ip:
-            query_24h = f"PartitionKey eq '{device_ip.replace('.', '_')}' and {query_24h}"
         try:
-            entities = list(client.query_entities(query_filter=query_24h))
+            entities = query_recent(now - datetime.timedelta(hours=24))
         except:
             return None
 
@@ -374,20 +1737,42 @@ def fetch_latest_sensor_entry(device_ip: Optional[str] = None, device_id: Option
     return {**dict(latest), "device": dict(device) if device else None}
 
 
-def fetch_sensor_history(device_ip: Optional[str] = None, timescale: str = "1h", limit: Optional[int] = 100, raw: bool = False, start_timestamp: Optional[str] = None, end_timestamp: Optional[str] = None) -> list:
-    client = get_table_client("SensorData")
-    if not client:
-        return []
+ROLLUP_TABLE_NAME = "SensorHistoryRollups"
+ROLLUP_GRANULARITY = {"1d": "hour", "1m": "day", "1y": "month", "all": "month"}
+HISTORY_TARGET_POINTS = 60
 
-    filters = []
-    partition_keys = []
-    if device_ip:
-        partition_keys = [device_ip.replace('.', '_')]
-    else:
-        # No device specified: attempt to query each device partition separately for reliability
-        partition_keys = list_device_partition_keys()
+# Local-time rollups. Zones listed in ROLLUP_TIMEZONES also get day and month
+# tiers aligned to local midnight, stored under granularity names such as
+# "day@America~Chicago" ('/' is not allowed in table keys). Their timestamp is
+# the UTC instant the local bucket starts, so range filters and ordering work
+# exactly as for the UTC tiers; hours stay UTC.
+ROLLUP_TIMEZONES = [z.strip() for z in os.getenv("ROLLUP_TIMEZONES", "").split(",") if z.strip()]
 
-    # Time window filtering
+
+def local_granularity(granularity: str, tz: Optional[str]) -> str:
+    if not tz or granularity not in ("day", "month"):
+        return granularity
+    return f"{granularity}@{tz.replace('/', '~')}"
+
+
+def split_granularity(granularity: str) -> tuple:
+    """("day", ZoneInfo) for a local tier name, ("day", None) for a UTC one."""
+    base, _, zone = granularity.partition("@")
+    return base, ZoneInfo(zone.replace("~", "/")) if zone else None
+
+
+def resolve_history_timezone(value: Optional[str]) -> Optional[str]:
+    """Validate a tz= parameter. None means UTC; a zone must have local rollups."""
+    if not value or value.strip().upper() in ("UTC", "Z", "ETC/UTC"):
+        return None
+    value = value.strip()
+    if value not in ROLLUP_TIMEZONES or ZoneInfo is None:
+        raise ValueError(f"tz must be one of: {', '.join(['UTC'] + ROLLUP_TIMEZONES)}")
+    return value
+
+
+def history_window(timescale: str, start_timestamp: Optional[str] = None, end_timestamp: Optional[str] = None) -> tuple:
+    """Resolve (since, until) for a history request. Custom start/end win over the timescale."""
     now = datetime.datetime.now(datetime.timezone.utc)
     since = None
     until = None
@@ -413,142 +1798,93 @@ def fetch_sensor_history(device_ip: Optional[str] = None, timescale: str = "1h",
         elif timescale == "1y": since = now - datetime.timedelta(days=365)
         # "all" has no time filter
 
+    return since, until
+
+
+def raw_time_filter(since: Optional[datetime.datetime]) -> Optional[str]:
     if since:
-        time_filter = f"RowKey ge '{int(since.timestamp()):010d}_0'"
+        return f"RowKey ge '{int(since.timestamp()):010d}_0'"
+    return None
+
+
+def rollup_query_filter(granularity: str, since: Optional[datetime.datetime], device_ip: Optional[str] = None) -> str:
+    if device_ip:
+        q = f"PartitionKey eq '{device_ip.replace('.', '_')}|{granularity}'"
     else:
-        time_filter = None
+        q = f"granularity eq '{granularity}'"
+    if since:
+        since_str = since.replace(microsecond=0).isoformat().replace('+00:00', 'Z')
+        q = f"{q} and timestamp ge '{since_str}'"
+    return q
 
-    rollup_map = {"1d": "hour", "1m": "day", "1y": "month", "all": "month"}
 
-    def fetch_rollup_history() -> Optional[list]:
-        if raw or timescale not in rollup_map:
-            return None
+def shape_rollup_history(rollup_entities: list, limit: Optional[int], target_points: int = HISTORY_TARGET_POINTS, whole_range: bool = False) -> Optional[list]:
+    """Turn rollup entities into chart rows, downsampled to ~target_points.
+    With whole_range the buckets are sized so at most target_points cover the
+    full range and nothing is trimmed off either end.
+    Returns None when there are no rollups so callers fall back to raw rows."""
+    if not rollup_entities:
+        return None
 
-        granularity = rollup_map[timescale]
-        rollup_client = get_table_client("SensorHistoryRollups")
-        if not rollup_client:
-            return None
+    rows = []
+    for e in rollup_entities:
+        ts = e.get('timestamp') or e.get('RowKey')
+        if isinstance(ts, datetime.datetime):
+            ts = ts.replace(microsecond=0).isoformat().replace('+00:00', 'Z')
+        rows.append({
+            'timestamp': sanitize_timestamp(ts) if ts else None,
+            'moisture': e.get('moisture'),
+            'temperature': e.get('temperature'),
+            'humidity': e.get('humidity'),
+            'ph': e.get('ph'),
+            'light': e.get('light'),
+            'battery': e.get('battery'),
+            'deviceIp': e.get('deviceIp'),
+            'isRollup': True,
+        })
 
-        rollup_entities = []
-        if device_ip:
-            pk = f"{device_ip.replace('.', '_')}|{granularity}"
-            q = f"PartitionKey eq '{pk}'"
-            if since:
-                since_str = since.replace(microsecond=0).isoformat().replace('+00:00', 'Z')
-                q = f"{q} and timestamp ge '{since_str}'"
-            try:
-                rollup_entities = list(rollup_client.query_entities(query_filter=q))
-            except Exception as ex:
-                logging.debug("Rollup partition query failed for %s: %s", pk, ex)
-        else:
-            q = f"granularity eq '{granularity}'"
-            if since:
-                since_str = since.replace(microsecond=0).isoformat().replace('+00:00', 'Z')
-                q = f"{q} and timestamp ge '{since_str}'"
-            try:
-                rollup_entities = list(rollup_client.query_entities(query_filter=q))
-            except Exception as ex:
-                logging.debug("Rollup global query failed for granularity=%s: %s", granularity, ex)
+    rows_sorted = sorted([r for r in rows if r.get('timestamp')], key=lambda x: str(x.get('timestamp')))
 
-        if not rollup_entities:
-            return None
+    # Keep rollup responses consistent with raw-data aggregation by
+    # returning approximately `target_points` data points. This ensures
+    # backfilled rollups and on-the-fly aggregation produce similar
+    # point counts for the frontend charting logic.
+    # If there are few rollup rows, just return what's available (respect limit)
+    if len(rows_sorted) <= target_points:
+        return rows_sorted[-limit:] if limit else rows_sorted
 
-        rows = []
-        for e in rollup_entities:
-            ts = e.get('timestamp') or e.get('RowKey')
-            if isinstance(ts, datetime.datetime):
-                ts = ts.replace(microsecond=0).isoformat().replace('+00:00', 'Z')
-            rows.append({
-                'timestamp': sanitize_timestamp(ts) if ts else None,
-                'moisture': e.get('moisture'),
-                'temperature': e.get('temperature'),
-                'humidity': e.get('humidity'),
-                'ph': e.get('ph'),
-                'light': e.get('light'),
-                'battery': e.get('battery'),
-                'deviceIp': e.get('deviceIp'),
-                'isRollup': True,
-            })
-
-        rows_sorted = sorted([r for r in rows if r.get('timestamp')], key=lambda x: str(x.get('timestamp')))
-
-        # Keep rollup responses consistent with raw-data aggregation by
-        # returning approximately `target_points` data points. This ensures
-        # backfilled rollups and on-the-fly aggregation produce similar
-        # point counts for the frontend charting logic.
-        target_points = 60
-        # If there are few rollup rows, just return what's available (respect limit)
-        if len(rows_sorted) <= target_points:
-            return rows_sorted[-limit:] if limit else rows_sorted
-
-        # Aggregate rollup rows into ~target_points buckets
+    # Aggregate rollup rows into ~target_points buckets
+    if whole_range:
+        chunk_size = -(-len(rows_sorted) // target_points)
+    else:
         chunk_size = max(1, len(rows_sorted) // target_points)
-        aggregated = []
-        for i in range(0, len(rows_sorted), chunk_size):
-            chunk = rows_sorted[i:i + chunk_size]
-            if not chunk:
-                continue
+    aggregated = []
+    for i in range(0, len(rows_sorted), chunk_size):
+        chunk = rows_sorted[i:i + chunk_size]
+        if not chunk:
+            continue
 
-            def avg(key):
-                vals = [c[key] for c in chunk if c.get(key) is not None and isinstance(c[key], (int, float))]
-                return round(sum(vals) / len(vals), 2) if vals else None
+        def avg(key):
+            vals = [c[key] for c in chunk if c.get(key) is not None and isinstance(c[key], (int, float))]
+            return round(sum(vals) / len(vals), 2) if vals else None
 
-            aggregated.append({
-                'timestamp': chunk[-1]['timestamp'],
-                'moisture': avg('moisture'),
-                'temperature': avg('temperature'),
-                'humidity': avg('humidity'),
-                'battery': avg('battery'),
-                'ph': avg('ph'),
-                'light': avg('light'),
-                'deviceIp': chunk[0].get('deviceIp'),
-                'isAggregated': True,
-            })
+        aggregated.append({
+            'timestamp': chunk[-1]['timestamp'],
+            'moisture': avg('moisture'),
+            'temperature': avg('temperature'),
+            'humidity': avg('humidity'),
+            'battery': avg('battery'),
+            'ph': avg('ph'),
+            'light': avg('light'),
+            'deviceIp': chunk[0].get('deviceIp'),
+            'isAggregated': True,
+        })
 
-        return aggregated[:target_points] if not limit else aggregated[-limit:]
+    return aggregated[:target_points] if not limit else aggregated[-limit:]
 
-    # Use precomputed rollups first for the long-range views so we avoid
-    # scanning raw SensorData when the answer is already materialized.
-    if not start_timestamp and not end_timestamp and not raw:
-        rollup_history = fetch_rollup_history()
-        if rollup_history is not None:
-            return rollup_history
-
-    entities = []
-    # If we have explicit partition keys, query per-partition to avoid cross-partition query issues
-    try:
-        if partition_keys:
-            for pk in partition_keys:
-                parts = [f"PartitionKey eq '{pk}'"]
-                if time_filter:
-                    parts.append(time_filter)
-                q = " and ".join(parts)
-                try:
-                    part_entities = list(client.query_entities(query_filter=q))
-                    entities.extend(part_entities)
-                except Exception as ex:
-                    logging.debug("Partition query failed for %s: %s", pk, ex)
-            # If we found nothing but partition_keys was empty (or queries failed), fall back to full-table scan
-            if not entities and not device_ip:
-                # Fallback to previous behavior: time-only or full-table query
-                fallback_query = time_filter if time_filter else ""
-                entities = list(client.query_entities(query_filter=fallback_query))
-        else:
-            # No partition keys available: do the original query (time-only or full table)
-            fallback_query = time_filter if time_filter else ""
-            entities = list(client.query_entities(query_filter=fallback_query))
-    except Exception as e:
-        logging.error(f"Table query error: {e}")
-        return []
 
-    # Logging for diagnostics: how many entities and device IPs were returned
-    try:
-        logging.info("fetch_sensor_history: queried partitions=%s, total_entities=%d", partition_keys if partition_keys else [], len(entities))
-        distinct_ips = sorted({str(e.get('deviceIp')) for e in entities if e.get('deviceIp')})
-        logging.info("fetch_sensor_history: distinct deviceIps sample=%s", distinct_ips[:10])
-    except Exception:
-        pass
-        
+def shape_raw_history(entities: list, timescale: str, limit: Optional[int], raw: bool, until: Optional[datetime.datetime]) -> list:
+    """Normalize raw SensorData entities and downsample them for the chart."""
     # Sort chronological
     raw_history = sorted([dict(e) for e in entities], key=lambda x: str(x.get("timestamp", "")))
 
@@ -581,7 +1917,7 @@ def fetch_sensor_history(device_ip: Optional[str] = None, timescale: str = "1h",
         return raw_history[-limit:] if limit else raw_history
 
     # If we have too many points, aggregate them to ~60 points for the chart
-    target_points = 60
+    target_points = HISTORY_TARGET_POINTS
     if len(raw_history) <= target_points or timescale == "1h":
         return raw_history[-limit:] if (timescale == "all" and limit) else raw_history
 
@@ -611,27 +1947,753 @@ def fetch_sensor_history(device_ip: Optional[str] = None, timescale: str = "1h",
     return aggregated[:target_points + 5]
 
 
-_control_commands: dict = {} # Keep commands in-memory for now as they are transient
+def log_history_scan(path: str, partition_keys: list, entities: list, queries: int = 1) -> None:
+    account_scan(path, len(entities), queries)
+    # Logging for diagnostics: how many entities and device IPs were returned
+    try:
+        logging.info("fetch_sensor_history: queried partitions=%s, total_entities=%d", partition_keys if partition_keys else [], len(entities))
+        distinct_ips = sorted({str(e.get('deviceIp')) for e in entities if e.get('deviceIp')})
+        logging.info("fetch_sensor_history: distinct deviceIps sample=%s", distinct_ips[:10])
+    except Exception:
+        pass
+
+
+# Custom-range planning. A non-raw start/end request is served from the
+# coarsest rollup tier that still yields the requested number of points
+# (an explicit limit param, else HISTORY_TARGET_POINTS) over the range: whole buckets come from
+# rollups and only the partial buckets at either edge are read raw, each
+# folded into one point.
+ROLLUP_TIERS = (("month", 30 * 86400), ("day", 86400), ("hour", 3600))
+
+
+def floor_to_granularity(moment: datetime.datetime, granularity: str) -> datetime.datetime:
+    base, zone = split_granularity(granularity)
+    if zone is not None:
+        local = moment.astimezone(zone)
+        start = datetime.datetime(local.year, local.month, 1 if base == "month" else local.day, tzinfo=zone)
+        return start.astimezone(datetime.timezone.utc)
+    moment = moment.replace(minute=0, second=0, microsecond=0)
+    if base in ("day", "month"):
+        moment = moment.replace(hour=0)
+    if base == "month":
+        moment = moment.replace(day=1)
+    return moment
+
+
+def ceil_to_granularity(moment: datetime.datetime, granularity: str) -> datetime.datetime:
+    floored = floor_to_granularity(moment, granularity)
+    if floored == moment:
+        return floored
+    base, zone = split_granularity(granularity)
+    if zone is not None:
+        # Step in local dates so a 23- or 25-hour DST day still ends at midnight.
+        local = floored.astimezone(zone).date()
+        following = local + datetime.timedelta(days=1) if base == "day" else (local.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+        return datetime.datetime(following.year, following.month, following.day, tzinfo=zone).astimezone(datetime.timezone.utc)
+    if base == "hour":
+        return floored + datetime.timedelta(hours=1)
+    if base == "day":
+        return floored + datetime.timedelta(days=1)
+    return (floored + datetime.timedelta(days=32)).replace(day=1)
+
+
+def plan_range_queries(partition_keys: list, since: Optional[datetime.datetime], until: Optional[datetime.datetime], points: int, tz: Optional[str] = None) -> Optional[dict]:
+    """Choose a rollup tier for [since, until] and list the queries that serve it
+    as (role, table, filter, lo, hi). Returns None when raw rows are the better fit."""
+    if not since:
+        return None
+    until = until or datetime.datetime.now(datetime.timezone.utc)
+    span = (until - since).total_seconds()
+    for granularity, seconds in ROLLUP_TIERS:
+        if span / seconds < points:
+            continue
+        granularity = local_granularity(granularity, tz)
+        body_start = ceil_to_granularity(since, granularity)
+        body_end = floor_to_granularity(until, granularity)
+        if body_start >= body_end:
+            continue
+
+        body_end_str = body_end.isoformat().replace("+00:00", "Z")
+        queries = []
+        for pk in partition_keys or [None]:
+            q = rollup_query_filter(granularity, body_start, pk.replace("_", ".") if pk else None)
+            queries.append(("body", ROLLUP_TABLE_NAME, f"{q} and timestamp lt '{body_end_str}'", None, None))
+            for role, lo, hi in (("head", since, body_start - datetime.timedelta(seconds=1)), ("tail", body_end, until)):
+                if lo > hi:
+                    continue
+                if chunk_writes_enabled():
+                    queries.append((role, CHUNK_TABLE_NAME, chunk_query_filter(pk, lo, hi), lo, hi))
+                    continue
+                row_range = f"RowKey ge '{int(lo.timestamp()):010d}_' and RowKey lt '{int(hi.timestamp()) + 1:010d}_'"
+                if pk:
+                    queries.extend((role, "SensorData", q, None, None) for q in raw_partition_filters(pk, lo, hi, row_range))
+                else:
+                    queries.append((role, "SensorData", row_range, None, None))
+        return {"granularity": granularity, "points": points, "queries": queries}
+    return None
+
+
+def stitch_planned_history(plan: dict, results: list, limit: Optional[int]) -> Optional[list]:
+    """Combine rollup body rows with one aggregated point per raw edge.
+    Returns None when the body has no rollups, so the caller reads raw."""
+    body = []
+    edges: Dict[str, list] = {"head": [], "tail": []}
+    scanned = 0
+    for (role, table, _q, lo, hi), entities in zip(plan["queries"], results):
+        scanned += len(entities)
+        if role == "body":
+            body.extend(entities)
+        elif table == CHUNK_TABLE_NAME:
+            edges[role].extend(row for chunk in entities for row in chunk_rows(chunk, lo, hi))
+        else:
+            edges[role].extend(entities)
+    account_scan(f"planned:{plan['granularity']}" if body else "plannedMiss", scanned, len(plan["queries"]))
+    if not body:
+        return None
+
+    for rows in edges.values():
+        if not rows:
+            continue
+        point = {"timestamp": min(str(r.get("timestamp") or "") for r in rows), "deviceIp": rows[0].get("deviceIp")}
+        for field in ("moisture", "temperature", "humidity", "battery", "ph", "light"):
+            vals = [r[field] for r in rows if isinstance(r.get(field), (int, float)) and not isinstance(r.get(field), bool)]
+            point[field] = round(sum(vals) / len(vals), 2) if vals else None
+        body.append(point)
+    return shape_rollup_history(body, limit, target_points=plan["points"], whole_range=True)
+
+
+def fetch_sensor_history(device_ip: Optional[str] = None, timescale: str = "1h", limit: Optional[int] = 100, raw: bool = False, start_timestamp: Optional[str] = None, end_timestamp: Optional[str] = None, tz: Optional[str] = None, target_points: Optional[int] = None) -> list:
+    client = get_table_client("SensorData")
+    if not client:
+        return []
+
+    partition_keys = []
+    if device_ip:
+        partition_keys = [device_ip.replace('.', '_')]
+    else:
+        # No device specified: attempt to query each device partition separately for reliability
+        partition_keys = list_device_partition_keys()
+
+    # Time window filtering
+    since, until = history_window(timescale, start_timestamp, end_timestamp)
+    time_filter = raw_time_filter(since)
+
+    def fetch_rollup_history() -> Optional[list]:
+        if raw or timescale not in ROLLUP_GRANULARITY:
+            return None
+
+        granularity = local_granularity(ROLLUP_GRANULARITY[timescale], tz)
+        rollup_client = get_table_client(ROLLUP_TABLE_NAME)
+        if not rollup_client:
+            return None
+
+        rollup_entities = []
+        q = rollup_query_filter(granularity, since, device_ip)
+        try:
+            rollup_entities = list(rollup_client.query_entities(query_filter=q))
+        except Exception as ex:
+            logging.debug("Rollup query failed (%s): %s", q, ex)
+
+        shaped = shape_rollup_history(rollup_entities, limit)
+        account_scan("rollup" if shaped is not None else "rollupMiss", len(rollup_entities))
+        return shaped
+
+    # Use precomputed rollups first for the long-range views so we avoid
+    # scanning raw SensorData when the answer is already materialized.
+    if not start_timestamp and not end_timestamp and not raw:
+        rollup_history = fetch_rollup_history()
+        if rollup_history is not None:
+            return rollup_history
+
+    # Custom ranges: rollup body plus raw edges when a tier fits.
+    plan = plan_range_queries(partition_keys, since, until, target_points or HISTORY_TARGET_POINTS, tz) if (start_timestamp or end_timestamp) and not raw else None
+    if plan:
+        results = []
+        for _role, table, q, _lo, _hi in plan["queries"]:
+            try:
+                results.append(list(get_table_client(table).query_entities(query_filter=q)))
+            except Exception as ex:
+                logging.debug("Planned query failed (%s): %s", q, ex)
+                results.append([])
+        planned = stitch_planned_history(plan, results, limit)
+        if planned is not None:
+            return planned
+
+    if chunk_writes_enabled():
+        entities = fetch_chunk_entities(partition_keys, since, until)
+        log_history_scan("chunks", partition_keys, entities, max(1, len(partition_keys)))
+        return shape_raw_history(entities, timescale, limit, raw, until)
+
+    entities = []
+    path = "raw"
+    filters = [q for pk in partition_keys for q in raw_partition_filters(pk, since, until, time_filter)]
+
+    def query_partition(q: str) -> list:
+        try:
+            return list(client.query_entities(query_filter=q))
+        except Exception as ex:
+            logging.debug("Partition query failed (%s): %s", q, ex)
+            return []
+
+    # If we have explicit partition keys, query per-partition to avoid cross-partition query issues
+    try:
+        if partition_keys:
+            if len(filters) > 1:
+                # Time-sharded layouts split a range over many partitions; read them in parallel.
+                with ThreadPoolExecutor(max_workers=HISTORY_QUERY_CONCURRENCY) as pool:
+                    for part_entities in pool.map(query_partition, filters):
+                        entities.extend(part_entities)
+            else:
+                entities.extend(query_partition(filters[0]))
+            # If we found nothing but partition_keys was empty (or queries failed), fall back to full-table scan
+            if not entities and not device_ip:
+                # Fallback to previous behavior: time-only or full-table query
+                fallback_query = time_filter if time_filter else ""
+                entities = list(client.query_entities(query_filter=fallback_query))
+                path = "fullTable"
+        else:
+            # No partition keys available: do the original query (time-only or full table)
+            fallback_query = time_filter if time_filter else ""
+            entities = list(client.query_entities(query_filter=fallback_query))
+            path = "fullTable"
+    except Exception as e:
+        logging.error(f"Table query error: {e}")
+        return []
+
+    log_history_scan(path, partition_keys, entities, max(1, len(filters)))
+    return shape_raw_history(entities, timescale, limit, raw, until)
+
+
+async def fetch_sensor_history_async(device_ip: Optional[str] = None, timescale: str = "1h", limit: Optional[int] = 100, raw: bool = False, start_timestamp: Optional[str] = None, end_timestamp: Optional[str] = None, tz: Optional[str] = None, target_points: Optional[int] = None) -> list:
+    """Async variant of fetch_sensor_history. Per-partition rollup and raw
+    queries run as gathered coroutines bounded by HISTORY_QUERY_CONCURRENCY."""
+    client = get_async_table_client("SensorData")
+    if not client:
+        return await asyncio.to_thread(fetch_sensor_history, device_ip, timescale, limit, raw, start_timestamp, end_timestamp, tz)
+
+    if device_ip:
+        partition_keys = [device_ip.replace('.', '_')]
+    else:
+        partition_keys = await asyncio.to_thread(list_device_partition_keys)
+
+    since, until = history_window(timescale, start_timestamp, end_timestamp)
+    time_filter = raw_time_filter(since)
+    semaphore = asyncio.Semaphore(HISTORY_QUERY_CONCURRENCY)
+
+    async def gather_partitions(table_client, filters: list) -> list:
+        results = await asyncio.gather(*(query_entities_async(table_client, q, semaphore) for q in filters))
+        return [e for part in results for e in part]
+
+    if not start_timestamp and not end_timestamp and not raw and timescale in ROLLUP_GRANULARITY:
+        granularity = local_granularity(ROLLUP_GRANULARITY[timescale], tz)
+        rollup_client = get_async_table_client(ROLLUP_TABLE_NAME)
+        if partition_keys:
+            # Rollup partitions are "<device>|<granularity>", so fan out per device
+            # rather than scanning the whole table on the granularity column.
+            rollup_entities = await gather_partitions(
+                rollup_client, [rollup_query_filter(granularity, since, pk) for pk in partition_keys]
+            )
+        else:
+            rollup_entities = await query_entities_async(rollup_client, rollup_query_filter(granularity, since))
+        rollup_history = shape_rollup_history(rollup_entities, limit)
+        account_scan("rollup" if rollup_history is not None else "rollupMiss", len(rollup_entities), max(1, len(partition_keys)))
+        if rollup_history is not None:
+            return rollup_history
+
+    plan = plan_range_queries(partition_keys, since, until, target_points or HISTORY_TARGET_POINTS, tz) if (start_timestamp or end_timestamp) and not raw else None
+    if plan:
+        results = await asyncio.gather(*(
+            query_entities_async(get_async_table_client(table), q, semaphore) for _role, table, q, _lo, _hi in plan["queries"]
+        ))
+        planned = stitch_planned_history(plan, results, limit)
+        if planned is not None:
+            return planned
+
+    if chunk_writes_enabled():
+        chunk_client = get_async_table_client(CHUNK_TABLE_NAME)
+        chunks = await gather_partitions(chunk_client, [chunk_query_filter(pk, since, until) for pk in partition_keys or [None]])
+        entities = [row for chunk in chunks for row in chunk_rows(chunk, since, until)]
+        log_history_scan("chunks", partition_keys, entities, max(1, len(partition_keys)))
+        return shape_raw_history(entities, timescale, limit, raw, until)
+
+    fallback_query = time_filter if time_filter else ""
+    path = "raw"
+    filters = [q for pk in partition_keys for q in raw_partition_filters(pk, since, until, time_filter)]
+    if partition_keys:
+        entities = await gather_partitions(client, filters)
+        if not entities and not device_ip:
+            entities = await query_entities_async(client, fallback_query)
+            path = "fullTable"
+    else:
+        entities = await query_entities_async(client, fallback_query)
+        path = "fullTable"
+
+    log_history_scan(path, partition_keys, entities, max(1, len(filters)))
+    return shape_raw_history(entities, timescale, limit, raw, until)
+
+
+async def gather_partition_queries(table_name: str, filters: list, semaphore: asyncio.Semaphore) -> list:
+    """Run one query per filter concurrently and return a list of result lists
+    in filter order. Uses the aio client when available, else worker threads."""
+    client = get_async_table_client(table_name)
+    if client:
+        return await asyncio.gather(*(query_entities_async(client, q, semaphore) for q in filters))
+
+    sync_client = get_table_client(table_name)
+    if not sync_client:
+        return [[] for _ in filters]
+
+    async def run(q):
+        async with semaphore:
+            try:
+                return await asyncio.to_thread(lambda: list(sync_client.query_entities(query_filter=q)))
+            except Exception as ex:
+                logging.debug("Partition query failed (%s): %s", q, ex)
+                return []
+
+    return await asyncio.gather(*(run(q) for q in filters))
+
+
+async def fetch_grouped_history_async(device_ip: Optional[str] = None, timescale: str = "1h", limit: Optional[int] = 100, raw: bool = False, start_timestamp: Optional[str] = None, end_timestamp: Optional[str] = None, tz: Optional[str] = None) -> Dict[str, list]:
+    """History as one independently downsampled series per device.
+    Every device partition is fetched in one concurrent fan-out: rollups
+    first where the view has a rollup tier, then raw rows only for devices
+    that had no rollups."""
+    if device_ip:
+        partition_keys = [device_ip.replace('.', '_')]
+    else:
+        partition_keys = await asyncio.to_thread(list_device_partition_keys)
+    if not partition_keys:
+        return {}
+
+    since, until = history_window(timescale, start_timestamp, end_timestamp)
+    semaphore = asyncio.Semaphore(HISTORY_QUERY_CONCURRENCY)
+    series: Dict[str, list] = {}
+
+    def label(pk: str, entities: list) -> str:
+        for e in entities:
+            if e.get("deviceIp"):
+                return str(e["deviceIp"])
+        return pk.replace("_", ".")
+
+    pending = list(partition_keys)
+    if not start_timestamp and not end_timestamp and not raw and timescale in ROLLUP_GRANULARITY:
+        granularity = local_granularity(ROLLUP_GRANULARITY[timescale], tz)
+        results = await gather_partition_queries(
+            ROLLUP_TABLE_NAME, [rollup_query_filter(granularity, since, pk) for pk in pending], semaphore
+        )
+        pending = []
+        for pk, entities in zip(partition_keys, results):
+            shaped = shape_rollup_history(entities, limit)
+            account_scan("rollup" if shaped is not None else "rollupMiss", len(entities))
+            if shaped is None:
+                pending.append(pk)
+            else:
+                series[label(pk, entities)] = shaped
+
+    if pending:
+        if chunk_writes_enabled():
+            results = await gather_partition_queries(CHUNK_TABLE_NAME, [chunk_query_filter(pk, since, until) for pk in pending], semaphore)
+            results = [[row for chunk in chunks for row in chunk_rows(chunk, since, until)] for chunks in results]
+            account_scan("chunks", sum(len(rows) for rows in results), len(pending))
+        else:
+            plans = [raw_partition_filters(pk, since, until) for pk in pending]
+            flat = await gather_partition_queries("SensorData", [q for plan in plans for q in plan], semaphore)
+            results = []
+            for plan in plans:
+                parts, flat = flat[:len(plan)], flat[len(plan):]
+                results.append([e for part in parts for e in part])
+            account_scan("raw", sum(len(rows) for rows in results), sum(len(plan) for plan in plans))
+        for pk, entities in zip(pending, results):
+            if entities:
+                series[label(pk, entities)] = shape_raw_history(entities, timescale, limit, raw, until)
 
-def save_control_command(device_ip: str, command: str, payload: Optional[dict]) -> dict:
-    issued_at = now_iso()
+    return series
+
+
+# Delta sync. History responses carry a cursor: "raw|<epoch seconds>" or
+# "<granularity>|<ISO time>", the time the response was read. Passing it back
+# as since=<cursor> returns only the raw rows, chunks or rollup buckets that
+# storage wrote after it, unaggregated, plus the next cursor. "Written" is the
+# service-maintained Timestamp, not RowKey or lastUpdated, so late readings
+# (buffered line-protocol batches, spill replays, lagging device clocks) and
+# rollups rewritten by a long backfill run are still picked up. Each delta
+# re-reads DELTA_OVERLAP_SECONDS before the cursor to absorb clock skew and
+# in-flight writes, so clients merge rows by timestamp and device instead of
+# appending them.
+DELTA_OVERLAP_SECONDS = int(os.getenv("DELTA_OVERLAP_SECONDS", "300"))
+
+
+def history_cursor_source(timescale: str, raw: bool, start_timestamp: Optional[str], end_timestamp: Optional[str], tz: Optional[str]) -> str:
+    if raw or start_timestamp or end_timestamp or timescale not in ROLLUP_GRANULARITY:
+        return "raw"
+    return local_granularity(ROLLUP_GRANULARITY[timescale], tz)
+
+
+def served_cursor_source(source: str, account: Optional[dict]) -> str:
+    """A rollup view that fell back to raw rows continues from raw rows."""
+    if source != "raw" and account is not None and "rollup" not in account["paths"]:
+        return "raw"
+    return source
+
+
+def history_cursor(source: str, as_of: datetime.datetime) -> str:
+    """Cursor for data of `source` read at `as_of`."""
+    if source == "raw":
+        return f"raw|{int(as_of.timestamp()):010d}"
+    return f"{source}|{as_of.replace(microsecond=0).isoformat().replace('+00:00', 'Z')}"
+
+
+def written_since_filter(moment: datetime.datetime) -> str:
+    """Filter on the service Timestamp: entities inserted or replaced at or after `moment`."""
+    return f"Timestamp ge datetime'{moment.replace(microsecond=0).isoformat().replace('+00:00', 'Z')}'"
+
+
+def parse_history_cursor(value: str) -> tuple:
+    """(source, position) from a since= cursor. Raises ValueError when malformed."""
+    source, _, position = (value or "").partition("|")
+    try:
+        if source == "raw" and position[:10].isdigit():
+            return source, datetime.datetime.fromtimestamp(int(position[:10]), datetime.timezone.utc)
+        if source != "raw" and split_granularity(source)[0] in ("hour", "day", "month"):
+            parsed = parse_timestamp_utc(position)
+            if parsed:
+                return source, parsed
+    except Exception:
+        pass
+    raise ValueError("Invalid since cursor; pass the cursor from a previous history response")
+
+
+async def fetch_history_delta(device_ip: Optional[str], timescale: str, start_timestamp: Optional[str], end_timestamp: Optional[str], source: str, position: datetime.datetime) -> tuple:
+    """Rows written after a cursor position, as (rows, next_cursor, window_start)."""
+    started = datetime.datetime.now(datetime.timezone.utc)
+    if device_ip:
+        partition_keys = [device_ip.replace('.', '_')]
+    else:
+        partition_keys = await asyncio.to_thread(list_device_partition_keys)
+    since, until = history_window(timescale, start_timestamp, end_timestamp)
+    written = written_since_filter(position - datetime.timedelta(seconds=DELTA_OVERLAP_SECONDS))
+    semaphore = asyncio.Semaphore(HISTORY_QUERY_CONCURRENCY)
+
+    if source != "raw":
+        filters = [f"{rollup_query_filter(source, since, pk)} and {written}" for pk in partition_keys or [None]]
+        entities = [e for part in await gather_partition_queries(ROLLUP_TABLE_NAME, filters, semaphore) for e in part]
+        account_scan("deltaRollup", len(entities), len(filters))
+        rows = shape_rollup_history(entities, None, target_points=max(1, len(entities))) or []
+        return rows, history_cursor(source, started), since
+
+    # The view window still bounds the key range; the Timestamp filter picks
+    # the rows written since the cursor, whatever reading time they carry.
+    if chunk_writes_enabled():
+        filters = [" and ".join(filter(None, [chunk_query_filter(pk, since, until), written])) for pk in partition_keys or [None]]
+        chunks = [c for part in await gather_partition_queries(CHUNK_TABLE_NAME, filters, semaphore) for c in part]
+        # A rewritten chunk is returned whole; clients merge by timestamp.
+        entities = [row for chunk in chunks for row in chunk_rows(chunk, since, until)]
+        path = "deltaChunks"
+    else:
+        time_filter = " and ".join(filter(None, [raw_time_filter(since), written]))
+        filters = [q for pk in partition_keys for q in raw_partition_filters(pk, since, until, time_filter)] or [time_filter]
+        entities = [e for part in await gather_partition_queries("SensorData", filters, semaphore) for e in part]
+        path = "deltaRaw"
+    account_scan(path, len(entities), len(filters))
+    rows = shape_raw_history(entities, timescale, None, True, until)
+    return rows, history_cursor("raw", started), since
+
+
+# Precomputed dashboard series. The materializeDashboardSeries timer stores
+# each standard view (per device and all-devices) as one compressed entity in
+# DashboardSeries so getSensorData can answer it with a single point read.
+# The live 1h view is always queried, and fresh=true skips the series (the
+# dashboard sends it on a manual refresh).
+SERIES_TABLE_NAME = "DashboardSeries"
+SERIES_ALL_DEVICES = "_all"
+STANDARD_TIMESCALES = ("1d", "1m", "1y", "all")
+DASHBOARD_SERIES = os.getenv("DASHBOARD_SERIES", "true").strip().lower() in ("1", "true", "yes")
+# Served only while younger than this, which is kept near the 5-minute timer
+# period; older series fall back to a live query.
+DASHBOARD_SERIES_MAX_AGE_SECONDS = float(os.getenv("DASHBOARD_SERIES_MAX_AGE_SECONDS", "360"))
+# The timer stops after this long; the next run continues with the devices it missed.
+DASHBOARD_SERIES_MAX_RUN_SECONDS = float(os.getenv("DASHBOARD_SERIES_MAX_RUN_SECONDS", "240"))
+_series_state: Dict[str, int] = {"next": 0}
+
+
+def series_partition_key(device_ip: Optional[str]) -> str:
+    return device_ip.replace(".", "_") if device_ip else SERIES_ALL_DEVICES
+
+
+def encode_series(rows: list) -> bytes:
+    import zlib
+    return zlib.compress(json.dumps(rows, separators=(",", ":"), default=str).encode("utf-8"), 6)
+
+
+def decode_series(blob) -> list:
+    import zlib
+    return json.loads(zlib.decompress(bytes(blob)).decode("utf-8"))
+
+
+def series_response(entity) -> Optional[dict]:
+    """Build the history response for a stored series, or None if it is stale."""
+    computed_at = parse_timestamp_utc(entity.get("computedAt"))
+    if not computed_at:
+        return None
+    age = (datetime.datetime.now(datetime.timezone.utc) - computed_at).total_seconds()
+    if age > DASHBOARD_SERIES_MAX_AGE_SECONDS:
+        return None
+    history = decode_series(entity["series"])
+    return {
+        "count": len(history),
+        "history": history,
+        "timescale": entity.get("RowKey"),
+        "source": "materialized",
+        "materializedAt": entity.get("computedAt"),
+        "ageSeconds": round(age, 1),
+        # Series written before cursorSource was stored continue from raw rows.
+        "cursor": history_cursor(entity.get("cursorSource") or "raw", computed_at),
+    }
+
+
+async def fetch_materialized_series(device_ip: Optional[str], timescale: str) -> Optional[dict]:
+    if not DASHBOARD_SERIES or timescale not in STANDARD_TIMESCALES:
+        return None
+    pk = series_partition_key(device_ip)
+    client = get_async_table_client(SERIES_TABLE_NAME)
+    try:
+        if client:
+            entity = await client.get_entity(partition_key=pk, row_key=timescale)
+        else:
+            sync_client = get_table_client(SERIES_TABLE_NAME)
+            if not sync_client:
+                return None
+            entity = await asyncio.to_thread(sync_client.get_entity, partition_key=pk, row_key=timescale)
+    except Exception:
+        return None
+    return series_response(entity)
+
+
+def materialize_series(device_ip: Optional[str], client) -> int:
+    written = 0
+    for timescale in STANDARD_TIMESCALES:
+        # Same parameters as a default dashboard request (limit=100, not raw).
+        # A scratch account records whether the rows came from rollups or raw.
+        account = {"paths": [], "queries": 0, "pages": 0, "throttled": 0, "bytes": 0, "scanned": 0, "returned": None}
+        token = _query_account.set(account)
+        try:
+            rows = fetch_sensor_history(device_ip=device_ip, timescale=timescale, limit=100)
+        finally:
+            _query_account.reset(token)
+        cursor_source = served_cursor_source(history_cursor_source(timescale, False, None, None, None), account)
+        blob = encode_series(rows)
+        if len(blob) > 60000:
+            logging.warning("Series %s/%s is %d bytes compressed; skipping", device_ip or "all", timescale, len(blob))
+            continue
+        client.upsert_entity(mode=UpdateMode.REPLACE, entity={
+            "PartitionKey": series_partition_key(device_ip),
+            "RowKey": timescale,
+            "series": blob,
+            "count": len(rows),
+            "cursorSource": cursor_source,
+            "computedAt": now_iso(),
+        })
+        written += 1
+    return written
+
+
+CONTROL_TABLE_NAME = "ControlCommands"
+CONTROL_COMMAND_TTL_SECONDS = int(os.getenv("CONTROL_COMMAND_TTL_SECONDS", "3600"))
+CONTROL_LONG_POLL_MAX_SECONDS = float(os.getenv("CONTROL_LONG_POLL_MAX_SECONDS", "25"))
+CONTROL_LONG_POLL_INTERVAL_SECONDS = float(os.getenv("CONTROL_LONG_POLL_INTERVAL_SECONDS", "1"))
+CONTROL_LONG_POLL_MAX_INTERVAL_SECONDS = float(os.getenv("CONTROL_LONG_POLL_MAX_INTERVAL_SECONDS", "8"))
+
+# Local stand-in for the ControlCommands table, used when Table Storage is not
+# configured. Maps device IP -> list of command entries ordered by id.
+_control_commands: Dict[str, list] = {}
+_control_lock = threading.RLock()
+# Long-polls parked on this instance, keyed by device IP. Each entry is the
+# waiter's (event loop, asyncio.Event); queuing a command for the device sets
+# the event so the poll wakes immediately instead of on its next storage check.
+_control_waiters: Dict[str, list] = {}
+
+
+def notify_control_waiters(device_ip: str) -> None:
+    with _control_lock:
+        waiters = list(_control_waiters.get(device_ip, ()))
+    for loop, wake in waiters:
+        try:
+            loop.call_soon_threadsafe(wake.set)
+        except RuntimeError:
+            # The waiter's loop has already shut down.
+            pass
+
+
+def control_command_from_entity(entity) -> dict:
+    payload = entity.get("payload")
+    if isinstance(payload, str):
+        try:
+            payload = json.loads(payload)
+        except ValueError:
+            pass
+    return {
+        "id": entity.get("RowKey"),
+        "deviceIp": entity.get("deviceIp"),
+        "command": entity.get("command"),
+        "payload": payload,
+        "issuedAt": entity.get("issuedAt"),
+        "expiresAt": entity.get("expiresAt"),
+    }
+
+
+def save_control_command(device_ip: str, command: str, payload: Optional[dict], ttl_seconds: Optional[int] = None) -> dict:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    ttl = CONTROL_COMMAND_TTL_SECONDS if ttl_seconds is None else max(1, int(ttl_seconds))
+    expires_at = (now + datetime.timedelta(seconds=ttl)).replace(microsecond=0).isoformat().replace("+00:00", "Z")
+    # Millisecond prefix keeps RowKey order equal to issue order within a device partition.
+    command_id = f"{int(now.timestamp() * 1000):013d}_{uuid.uuid4().hex[:8]}"
     cmd_entry = {
+        "id": command_id,
         "deviceIp": device_ip,
         "command": command,
         "payload": payload,
-        "issuedAt": issued_at,
+        "issuedAt": now_iso(),
+        "expiresAt": expires_at,
     }
-    _control_commands[device_ip] = cmd_entry
+
+    client = ensure_table_client(CONTROL_TABLE_NAME)
+    if client:
+        client.create_entity(entity={
+            "PartitionKey": device_ip.replace(".", "_"),
+            "RowKey": command_id,
+            "deviceIp": device_ip,
+            "command": command,
+            "payload": json.dumps(payload) if payload is not None else None,
+            "issuedAt": cmd_entry["issuedAt"],
+            "expiresAt": expires_at,
+            "status": "pending",
+        })
+    else:
+        with _control_lock:
+            _control_commands.setdefault(device_ip, []).append(cmd_entry)
+
+    notify_control_waiters(device_ip)
     return cmd_entry
 
 
+def list_control_commands(device_ip: str) -> list:
+    """Return unexpired pending commands for a device, oldest first.
+    Expired or already-delivered entries found along the way are removed."""
+    now_str = now_iso()
+    client = ensure_table_client(CONTROL_TABLE_NAME)
+    if not client:
+        with _control_lock:
+            queue = _control_commands.get(device_ip, [])
+            queue[:] = [c for c in queue if str(c.get("expiresAt") or "") >= now_str]
+            return list(queue)
+
+    pending = []
+    try:
+        entities = client.query_entities(query_filter=f"PartitionKey eq '{device_ip.replace('.', '_')}'")
+        for e in entities:
+            if e.get("status") == "pending" and str(e.get("expiresAt") or "") >= now_str:
+                pending.append(e)
+                continue
+            try:
+                client.delete_entity(partition_key=e["PartitionKey"], row_key=e["RowKey"])
+            except Exception as ex:
+                logging.debug("Failed to purge control command %s: %s", e.get("RowKey"), ex)
+    except Exception as ex:
+        logging.error("Control command query failed for %s: %s", device_ip, ex)
+        return []
+    return pending
+
+
 def fetch_control_command(device_ip: str) -> Optional[dict]:
-    return _control_commands.get(device_ip)
+    pending = list_control_commands(device_ip)
+    if not pending:
+        return None
+    first = pending[0]
+    entry = dict(first) if "PartitionKey" not in first else control_command_from_entity(first)
+    entry["pending"] = len(pending)
+    return entry
 
 
-def delete_control_command(device_ip: str) -> None:
-    if device_ip in _control_commands:
-        del _control_commands[device_ip]
+def claim_control_command(device_ip: str) -> Optional[dict]:
+    """Remove and return the oldest pending command for a device.
+    With Table Storage the claim is an etag-conditional MERGE, so a command is
+    delivered at most once even when several instances poll the same device."""
+    client = ensure_table_client(CONTROL_TABLE_NAME)
+    if not client:
+        with _control_lock:
+            pending = list_control_commands(device_ip)
+            if not pending:
+                return None
+            _control_commands[device_ip].pop(0)
+            return {**pending[0], "pending": len(pending) - 1}
+
+    pending = list_control_commands(device_ip)
+    for index, entity in enumerate(pending):
+        try:
+            client.update_entity(
+                mode=UpdateMode.MERGE,
+                entity={"PartitionKey": entity["PartitionKey"], "RowKey": entity["RowKey"], "status": "delivered"},
+                etag=entity.metadata.get("etag"),
+                match_condition=MatchConditions.IfNotModified,
+            )
+        except (ResourceModifiedError, ResourceNotFoundError):
+            # Another poller claimed it first; try the next one.
+            continue
+        try:
+            client.delete_entity(partition_key=entity["PartitionKey"], row_key=entity["RowKey"])
+        except Exception as ex:
+            logging.debug("Delivered control command %s not deleted: %s", entity.get("RowKey"), ex)
+        return {**control_command_from_entity(entity), "pending": len(pending) - index - 1}
+    return None
+
+
+def delete_control_command(device_ip: str, command_id: Optional[str] = None) -> None:
+    """Delete one command by id, or every queued command for the device."""
+    client = ensure_table_client(CONTROL_TABLE_NAME)
+    if not client:
+        with _control_lock:
+            if command_id is None:
+                _control_commands.pop(device_ip, None)
+            else:
+                _control_commands[device_ip] = [c for c in _control_commands.get(device_ip, []) if c.get("id") != command_id]
+        return
+
+    pk = device_ip.replace(".", "_")
+    row_keys = [command_id] if command_id else [e["RowKey"] for e in client.query_entities(query_filter=f"PartitionKey eq '{pk}'", select=["RowKey"])]
+    for row_key in row_keys:
+        client.delete_entity(partition_key=pk, row_key=row_key)
+
+
+async def wait_for_control_command(device_ip: str, wait_seconds: float, consume: bool) -> Optional[dict]:
+    """Long-poll for a command without holding a worker thread. Commands queued on
+    this instance wake the waiter immediately; commands queued elsewhere are picked
+    up by storage checks whose interval doubles up to CONTROL_LONG_POLL_MAX_INTERVAL_SECONDS."""
+    deadline = time.monotonic() + max(0.0, min(wait_seconds, CONTROL_LONG_POLL_MAX_SECONDS))
+    check = claim_control_command if consume else fetch_control_command
+    waiter = (asyncio.get_running_loop(), asyncio.Event())
+    with _control_lock:
+        _control_waiters.setdefault(device_ip, []).append(waiter)
+    interval = CONTROL_LONG_POLL_INTERVAL_SECONDS
+    try:
+        while True:
+            # Cleared before the check so a command queued mid-check still wakes the next wait.
+            waiter[1].clear()
+            command_entry = await asyncio.to_thread(check, device_ip)
+            remaining = deadline - time.monotonic()
+            if command_entry or remaining <= 0:
+                return command_entry
+            try:
+                await asyncio.wait_for(waiter[1].wait(), timeout=min(remaining, interval))
+            except asyncio.TimeoutError:
+                interval = min(interval * 2, CONTROL_LONG_POLL_MAX_INTERVAL_SECONDS)
+    finally:
+        with _control_lock:
+            waiters = _control_waiters.get(device_ip, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+            if not waiters:
+                _control_waiters.pop(device_ip, None)
 
 
 @app.function_name("registerDevice")
@@ -664,12 +2726,292 @@ def register_device(req: func.HttpRequest) -> func.HttpResponse:
     return json_response(device_info)
 
 
+# Request coalescing. Identical history requests that arrive while one is
+# already being served on this instance wait for that result instead of
+# running their own storage fetch and aggregation.
+COALESCE_HISTORY = os.getenv("COALESCE_HISTORY", "true").strip().lower() in ("1", "true", "yes")
+_inflight_history: Dict[tuple, Dict[str, Any]] = {}
+_coalesce_stats: Dict[str, Any] = {"leaders": 0, "coalesced": 0, "leadersCancelled": 0, "waitSeconds": 0.0, "maxWaitSeconds": 0.0, "maxWaiters": 0}
+# Result a cancelled leader hands its waiters: run the load again, one of them leading.
+_LEADER_CANCELLED = object()
+
+
+def history_request_key(device_ip, timescale, raw, start_timestamp, end_timestamp, limit, group_by, tz=None, since=None, fresh=False) -> tuple:
+    def normalize_ts(value):
+        parsed = parse_timestamp_utc(value) if value else None
+        return parsed.replace(microsecond=0).isoformat() if parsed else (value or "")
+    return ((device_ip or "").strip(), timescale, bool(raw), normalize_ts(start_timestamp), normalize_ts(end_timestamp), limit, group_by, tz, since or "", bool(fresh))
+
+
+async def coalesce_history(key: tuple, load) -> dict:
+    """Run `load()` once per key at a time on this event loop; concurrent callers
+    with the same key await the leader's result (or its exception). If the
+    leader is cancelled its waiters are not: the first to retry leads anew."""
+    if not COALESCE_HISTORY:
+        return await load()
+    loop = asyncio.get_running_loop()
+    full_key = (id(loop),) + key
+    while True:
+        inflight = _inflight_history.get(full_key)
+        if inflight is None:
+            break
+        inflight["waiters"] += 1
+        _coalesce_stats["coalesced"] += 1
+        _coalesce_stats["maxWaiters"] = max(_coalesce_stats["maxWaiters"], inflight["waiters"])
+        account_scan("coalesced", 0, 0)
+        started = time.perf_counter()
+        try:
+            result = await asyncio.shield(inflight["future"])
+        finally:
+            waited = time.perf_counter() - started
+            _coalesce_stats["waitSeconds"] = round(_coalesce_stats["waitSeconds"] + waited, 4)
+            _coalesce_stats["maxWaitSeconds"] = round(max(_coalesce_stats["maxWaitSeconds"], waited), 4)
+        if result is not _LEADER_CANCELLED:
+            return result
+
+    future = loop.create_future()
+    _inflight_history[full_key] = {"future": future, "waiters": 0}
+    _coalesce_stats["leaders"] += 1
+    try:
+        result = await load()
+        future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        # Only this request was cancelled; send the waiters back to retry.
+        _coalesce_stats["leadersCancelled"] += 1
+        future.set_result(_LEADER_CANCELLED)
+        raise
+    except Exception as ex:
+        future.set_exception(ex)
+        # Mark the exception retrieved when nobody was waiting for it.
+        future.exception()
+        raise
+    finally:
+        _inflight_history.pop(full_key, None)
+
+
+# Ingest rate limiting. Each device gets a token bucket on this instance:
+# INGEST_BURST posts back to back, refilled at INGEST_RATE_PER_MINUTE. A post
+# with no token left gets 429 and Retry-After without touching storage. With
+# INGEST_MERGE_EXCESS the rejected readings are kept in memory and averaged
+# into the device's next accepted reading instead of being dropped.
+INGEST_RATE_PER_MINUTE = float(os.getenv("INGEST_RATE_PER_MINUTE", "0"))  # 0 = no limit
+INGEST_BURST = max(1, int(os.getenv("INGEST_BURST", "10")))
+INGEST_MERGE_EXCESS = os.getenv("INGEST_MERGE_EXCESS", "false").strip().lower() in ("1", "true", "yes")
+INGEST_LIMITER_MAX_DEVICES = int(os.getenv("INGEST_LIMITER_MAX_DEVICES", "10000"))
+_ingest_buckets: "collections.OrderedDict[str, Dict[str, Any]]" = collections.OrderedDict()
+# limitedByDevice keeps the most recently limited INGEST_LIMITER_MAX_DEVICES devices.
+_ingest_limit_stats: Dict[str, Any] = {"allowed": 0, "limited": 0, "merged": 0, "mergedIntoStored": 0, "limitedByDevice": collections.OrderedDict()}
+
+
+def take_ingest_token(device_ip: str) -> float:
+    """0 when the post may proceed, otherwise seconds until the next token."""
+    if INGEST_RATE_PER_MINUTE <= 0:
+        return 0.0
+    now = time.monotonic()
+    rate = INGEST_RATE_PER_MINUTE / 60.0
+    bucket = _ingest_buckets.get(device_ip)
+    if bucket is None:
+        bucket = _ingest_buckets[device_ip] = {"tokens": float(INGEST_BURST), "updated": now, "pending": {}, "pendingCount": 0}
+        while len(_ingest_buckets) > INGEST_LIMITER_MAX_DEVICES:
+            _ingest_buckets.popitem(last=False)
+    else:
+        _ingest_buckets.move_to_end(device_ip)
+        bucket["tokens"] = min(float(INGEST_BURST), bucket["tokens"] + (now - bucket["updated"]) * rate)
+        bucket["updated"] = now
+    if bucket["tokens"] >= 1.0:
+        bucket["tokens"] -= 1.0
+        _ingest_limit_stats["allowed"] += 1
+        return 0.0
+    _ingest_limit_stats["limited"] += 1
+    by_device = _ingest_limit_stats["limitedByDevice"]
+    by_device[device_ip] = by_device.pop(device_ip, 0) + 1
+    while len(by_device) > INGEST_LIMITER_MAX_DEVICES:
+        by_device.popitem(last=False)
+    return (1.0 - bucket["tokens"]) / rate
+
+
+def payload_metric(payload: dict, field: str):
+    names = ("battery", "batteryVoltage", "battery_v", "voltage") if field == "battery" else (field,)
+    for name in names:
+        value = payload.get(name)
+        if value is None or (isinstance(value, str) and not value.strip()):
+            continue
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+def hold_excess_readings(device_ip: str, payloads: list) -> int:
+    """Keep rate-limited readings for the device's next accepted post."""
+    bucket = _ingest_buckets.get(device_ip)
+    if bucket is None:
+        return 0
+    for payload in payloads:
+        for field in SENSOR_LINE_FIELDS:
+            value = payload_metric(payload, field)
+            if value is not None:
+                total = bucket["pending"].setdefault(field, [0.0, 0])
+                total[0] += value
+                total[1] += 1
+        bucket["pendingCount"] += 1
+    _ingest_limit_stats["merged"] += len(payloads)
+    return len(payloads)
+
+
+def merge_held_readings(device_ip: str, payload: dict) -> dict:
+    """Average any held readings into `payload`; returns it unchanged when none are held."""
+    bucket = _ingest_buckets.get(device_ip)
+    if not bucket or not bucket["pendingCount"]:
+        return payload
+    merged = dict(payload)
+    for field, (total, count) in bucket["pending"].items():
+        value = payload_metric(payload, field)
+        if value is not None:
+            total, count = total + value, count + 1
+        merged[field] = round(total / count, 4)
+    logging.info("Averaged %d held readings into the stored reading for %s", bucket["pendingCount"], device_ip)
+    _ingest_limit_stats["mergedIntoStored"] += bucket["pendingCount"]
+    bucket["pending"] = {}
+    bucket["pendingCount"] = 0
+    return merged
+
+
+def ingest_limited_response(device_ip: str, payloads: list, retry_after: float) -> func.HttpResponse:
+    merged = hold_excess_readings(device_ip, payloads) if INGEST_MERGE_EXCESS else 0
+    logging.warning("Rate limited sensor post from %s (%d readings, merged=%d)", device_ip, len(payloads), merged)
+    seconds = max(1, math.ceil(retry_after))
+    return json_response(
+        {"error": "Too many requests", "retryAfterSeconds": seconds, "merged": merged},
+        status=429,
+        headers={"Retry-After": str(seconds)},
+    )
+
+
+def ingest_limiter_summary() -> Dict[str, Any]:
+    top = sorted(_ingest_limit_stats["limitedByDevice"].items(), key=lambda kv: kv[1], reverse=True)[:10]
+    return {
+        "ratePerMinute": INGEST_RATE_PER_MINUTE,
+        "burst": INGEST_BURST,
+        "mergeExcess": INGEST_MERGE_EXCESS,
+        "allowed": _ingest_limit_stats["allowed"],
+        "limited": _ingest_limit_stats["limited"],
+        "merged": _ingest_limit_stats["merged"],
+        "mergedIntoStored": _ingest_limit_stats["mergedIntoStored"],
+        "devicesTracked": len(_ingest_buckets),
+        "pendingReadings": sum(b["pendingCount"] for b in _ingest_buckets.values()),
+        "topLimited": [{"deviceIp": ip, "limited": n} for ip, n in top],
+    }
+
+
+# Adaptive reporting. Ingest responses carry nextReportSeconds: the interval
+# at which the fastest-moving metric would change by its REPORT_DELTAS step
+# (send-on-delta), stretched while this instance is busy or storage is
+# throttling and when the battery is low. Recent readings are remembered per
+# device on this instance; a device seen for the first time gets the default.
+REPORT_INTERVAL_MIN_SECONDS = int(os.getenv("REPORT_INTERVAL_MIN_SECONDS", "60"))
+REPORT_INTERVAL_MAX_SECONDS = int(os.getenv("REPORT_INTERVAL_MAX_SECONDS", "900"))
+REPORT_INTERVAL_DEFAULT_SECONDS = int(os.getenv("REPORT_INTERVAL_DEFAULT_SECONDS", "300"))
+REPORT_LOAD_TARGET_PER_MINUTE = float(os.getenv("REPORT_LOAD_TARGET_PER_MINUTE", "600"))  # 0 = ignore load
+REPORT_BATTERY_LOW_VOLTS = float(os.getenv("REPORT_BATTERY_LOW_VOLTS", "3.5"))
+REPORT_BATTERY_CRITICAL_VOLTS = float(os.getenv("REPORT_BATTERY_CRITICAL_VOLTS", "3.3"))
+REPORT_DELTAS = {"moisture": 2.0, "temperature": 0.5, "humidity": 3.0, "ph": 0.1, "light": 100.0}
+REPORT_HISTORY_LENGTH = 6
+_recent_readings: "collections.OrderedDict[str, collections.deque]" = collections.OrderedDict()
+_recent_ingests: "collections.deque[float]" = collections.deque(maxlen=100000)
+
+
+def remember_readings(entries: list) -> None:
+    now = time.monotonic()
+    for entry in entries:
+        device_ip = entry.get("deviceIp")
+        if not device_ip:
+            continue
+        _recent_ingests.append(now)
+        history = _recent_readings.get(device_ip)
+        if history is None:
+            history = _recent_readings[device_ip] = collections.deque(maxlen=REPORT_HISTORY_LENGTH)
+            while len(_recent_readings) > INGEST_LIMITER_MAX_DEVICES:
+                _recent_readings.popitem(last=False)
+        else:
+            _recent_readings.move_to_end(device_ip)
+        epoch = int(str(entry["RowKey"]).split("_", 1)[0])
+        if history and epoch <= history[-1][0]:
+            continue
+        history.append((epoch, {f: payload_metric(entry, f) for f in REPORT_DELTAS}))
+
+
+def report_load_factor() -> float:
+    """>= 1 when this instance is ingesting above target or storage is throttling."""
+    cutoff = time.monotonic() - 60
+    factor = 1.0
+    if REPORT_LOAD_TARGET_PER_MINUTE > 0:
+        recent = 0
+        for t in reversed(_recent_ingests):
+            if t < cutoff:
+                break
+            recent += 1
+        factor = max(1.0, recent / REPORT_LOAD_TARGET_PER_MINUTE)
+    if _recent_throttles and _recent_throttles[-1] >= cutoff:
+        factor *= 2
+    return factor
+
+
+def recommend_report_interval(entry: dict) -> int:
+    history = _recent_readings.get(entry.get("deviceIp")) or ()
+    interval = None
+    for (t0, v0), (t1, v1) in zip(list(history), list(history)[1:]):
+        for field, step in REPORT_DELTAS.items():
+            if v0.get(field) is None or v1.get(field) is None:
+                continue
+            change = abs(v1[field] - v0[field]) / (t1 - t0)
+            if change > 0:
+                interval = min(interval or float("inf"), step / change)
+    if interval is None:
+        # No change seen yet: stable (max) once there are two readings, else the default.
+        interval = REPORT_INTERVAL_MAX_SECONDS if len(history) >= 2 else REPORT_INTERVAL_DEFAULT_SECONDS
+
+    interval *= report_load_factor()
+    battery = payload_metric(entry, "battery")
+    if battery is not None and battery <= REPORT_BATTERY_CRITICAL_VOLTS:
+        interval = REPORT_INTERVAL_MAX_SECONDS
+    elif battery is not None and battery <= REPORT_BATTERY_LOW_VOLTS:
+        interval *= 2
+    floor = REPORT_INTERVAL_MIN_SECONDS
+    if INGEST_RATE_PER_MINUTE > 0:
+        floor = max(floor, math.ceil(60 / INGEST_RATE_PER_MINUTE))
+    return int(min(REPORT_INTERVAL_MAX_SECONDS, max(floor, interval)))
+
+
 @app.function_name("postSensorData")
 @app.route(route="sensor-data", methods=["POST"], auth_level=func.AuthLevel.FUNCTION)
 @safe_function
-def save_sensor_data(req: func.HttpRequest) -> func.HttpResponse:
+async def save_sensor_data(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("Saving sensor data")
 
+    content_type = (req.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+    if content_type == SENSOR_LINES_CONTENT_TYPE:
+        try:
+            payloads = parse_sensor_lines(req.get_body())
+        except (ValueError, UnicodeDecodeError) as exc:
+            logging.warning("Invalid sensor lines payload: %s", exc)
+            return json_response({"error": f"Invalid sensor lines payload: {exc}"}, status=400)
+        if not payloads:
+            return json_response({"error": "No readings in payload"}, status=400)
+        device_ip = payloads[0].get("deviceIp")
+        retry_after = take_ingest_token(device_ip)
+        if retry_after:
+            return ingest_limited_response(device_ip, payloads, retry_after)
+        payloads[-1] = merge_held_readings(device_ip, payloads[-1])
+        entries = await store_sensor_entries_async(payloads)
+        remember_readings(sorted(entries, key=lambda e: e["RowKey"]))
+        schedule_spill_drain()
+        next_report = recommend_report_interval(max(entries, key=lambda e: e["RowKey"])) if entries else REPORT_INTERVAL_DEFAULT_SECONDS
+        # Keep the response small; the device does not need the stored rows echoed back.
+        return json_response({"message": "Sensor data stored", "count": len(entries), "nextReportSeconds": next_report}, status=201)
+
     try:
         payload = req.get_json()
     except ValueError as exc:
@@ -693,13 +3035,21 @@ def save_sensor_data(req: func.HttpRequest) -> func.HttpResponse:
     if not device_ip:
         return json_response({"error": "Device IP is required"}, status=400)
 
-    entry = store_sensor_entry(payload)
-    return json_response({"message": "Sensor data stored", "data": entry}, status=201)
+    retry_after = take_ingest_token(device_ip)
+    if retry_after:
+        return ingest_limited_response(device_ip, [payload], retry_after)
+    payload = merge_held_readings(device_ip, payload)
+
+    entry = await store_sensor_entry_async(payload)
+    remember_readings([entry])
+    schedule_spill_drain()
+    return json_response({"message": "Sensor data stored", "data": entry, "nextReportSeconds": recommend_report_interval(entry)}, status=201)
 
 
 @app.function_name("getSensorData")
 @app.route(route="sensor-data", methods=["GET"], auth_level=func.AuthLevel.FUNCTION)
-def get_sensor_data(req: func.HttpRequest) -> func.HttpResponse:
+@safe_function
+async def get_sensor_data(req: func.HttpRequest) -> func.HttpResponse:
     device_ip = req.params.get("deviceIp")
     device_id = req.params.get("deviceId")
     is_history = parse_bool(req.params.get("history"), False)
@@ -716,17 +3066,85 @@ def get_sensor_data(req: func.HttpRequest) -> func.HttpResponse:
             # Preserve capped defaults for standard chart ranges, but keep custom/raw uncapped.
             limit = None if raw else 100
         
-        data = fetch_sensor_history(
-            device_ip=device_ip, 
-            timescale=timescale, 
-            limit=limit,
-            raw=raw,
-            start_timestamp=start_timestamp,
-            end_timestamp=end_timestamp
-        )
-        return json_response({"count": len(data), "history": data, "timescale": timescale})
-
-    entry = fetch_latest_sensor_entry(device_ip=device_ip, device_id=device_id)
+        group_by = (req.params.get("groupBy") or "").lower()
+        try:
+            tz = resolve_history_timezone(req.params.get("tz"))
+        except ValueError as exc:
+            return json_response({"error": str(exc)}, status=400)
+        since_cursor = req.params.get("since")
+        if since_cursor:
+            if group_by == "device":
+                return json_response({"error": "since is not supported with groupBy=device"}, status=400)
+            try:
+                cursor_source, cursor_position = parse_history_cursor(since_cursor)
+            except ValueError as exc:
+                return json_response({"error": str(exc)}, status=400)
+        fresh = parse_bool(req.params.get("fresh"), False)
+        cursor_source_default = history_cursor_source(timescale, raw, start_timestamp, end_timestamp, tz)
+
+        async def load() -> dict:
+            if since_cursor:
+                rows, cursor, window_start = await fetch_history_delta(
+                    device_ip, timescale, start_timestamp, end_timestamp, cursor_source, cursor_position
+                )
+                account_returned(len(rows))
+                return {
+                    "count": len(rows),
+                    "history": rows,
+                    "timescale": timescale,
+                    "delta": True,
+                    "cursor": cursor,
+                    "windowStart": window_start.replace(microsecond=0).isoformat().replace('+00:00', 'Z') if window_start else None,
+                }
+
+            started = datetime.datetime.now(datetime.timezone.utc)
+            if group_by == "device":
+                series = await fetch_grouped_history_async(
+                    device_ip=device_ip,
+                    timescale=timescale,
+                    limit=limit,
+                    raw=raw,
+                    start_timestamp=start_timestamp,
+                    end_timestamp=end_timestamp,
+                    tz=tz
+                )
+                account_returned(sum(len(rows) for rows in series.values()))
+                return {
+                    "count": sum(len(rows) for rows in series.values()),
+                    "series": series,
+                    "timescale": timescale,
+                    "groupBy": "device",
+                }
+
+            # Standard views come from the materialized series when it is fresh.
+            if not raw and not start_timestamp and not end_timestamp and limit_param is None and not tz and not fresh:
+                materialized = await fetch_materialized_series(device_ip, timescale)
+                if materialized:
+                    account_scan("materialized", 1)
+                    account_returned(materialized.get("count", 0))
+                    return materialized
+
+            data = await fetch_sensor_history_async(
+                device_ip=device_ip, 
+                timescale=timescale, 
+                limit=limit,
+                raw=raw,
+                start_timestamp=start_timestamp,
+                end_timestamp=end_timestamp,
+                tz=tz,
+                target_points=limit if limit_param is not None else None
+            )
+            account_returned(len(data))
+            source = served_cursor_source(cursor_source_default, _query_account.get())
+            payload = {"count": len(data), "history": data, "timescale": timescale, "cursor": history_cursor(source, started)}
+            if tz:
+                payload["tz"] = tz
+            return payload
+
+        key = history_request_key(device_ip, timescale, raw, start_timestamp, end_timestamp, limit, group_by, tz, since_cursor, fresh)
+        return json_response(await coalesce_history(key, load))
+
+    entry = await asyncio.to_thread(fetch_latest_sensor_entry, device_ip, device_id)
 
     if not entry:
         message = "No data available"
@@ -755,29 +3173,100 @@ def queue_control_command(req: func.HttpRequest) -> func.HttpResponse:
     if not device_ip or not command:
         return json_response({"error": "deviceIp and command are required"}, status=400)
 
-    command_entry = save_control_command(device_ip, command, body.get("payload"))
+    ttl_seconds = body.get("ttlSeconds")
+    if ttl_seconds is not None:
+        try:
+            ttl_seconds = int(ttl_seconds)
+        except (TypeError, ValueError):
+            return json_response({"error": "ttlSeconds must be a number"}, status=400)
+
+    command_entry = save_control_command(device_ip, command, body.get("payload"), ttl_seconds=ttl_seconds)
     return json_response({"message": "Command queued", "command": command_entry})
 
 
 @app.function_name("getControlCommand")
 @app.route(route="control", methods=["GET"], auth_level=func.AuthLevel.FUNCTION)
 @safe_function
-def get_control_command(req: func.HttpRequest) -> func.HttpResponse:
+async def get_control_command(req: func.HttpRequest) -> func.HttpResponse:
     device_ip = req.params.get("deviceIp")
 
     if not device_ip:
         return json_response({"error": "Device IP is required"}, status=400)
 
     consume = parse_bool(req.params.get("consume"), True)
-    command_entry = fetch_control_command(device_ip)
+    # Optional long-poll: hold the request up to `wait` seconds until a command arrives.
+    try:
+        wait_seconds = float(req.params.get("wait") or 0)
+    except ValueError:
+        return json_response({"error": "wait must be a number of seconds"}, status=400)
 
-    if command_entry and consume:
-        delete_control_command(device_ip)
+    command_entry = await wait_for_control_command(device_ip, wait_seconds, consume)
 
     payload = command_entry or {"deviceIp": device_ip, "command": None, "status": "idle"}
     return json_response(payload)
 
 
+@app.function_name("cancelControlCommand")
+@app.route(route="control", methods=["DELETE"], auth_level=func.AuthLevel.FUNCTION)
+@safe_function
+def cancel_control_command(req: func.HttpRequest) -> func.HttpResponse:
+    device_ip = req.params.get("deviceIp")
+
+    if not device_ip:
+        return json_response({"error": "Device IP is required"}, status=400)
+
+    command_id = req.params.get("id")
+    delete_control_command(device_ip, command_id)
+    return json_response({"message": "Command cancelled" if command_id else "Commands cleared", "deviceIp": device_ip, "id": command_id})
+
+
+def prime_shared_state() -> Dict[str, Any]:
+    """Build the storage clients and device list a cold worker would otherwise
+    construct on its first real request. Returns the timing of each step."""
+    timings: Dict[str, Any] = {}
+    started = time.perf_counter()
+    get_table_service()
+    timings["tableServiceSeconds"] = round(time.perf_counter() - started, 4)
+
+    for table_name in ("SensorData", "Devices", CONTROL_TABLE_NAME, LIVENESS_TABLE_NAME):
+        step = time.perf_counter()
+        ensure_table_client(table_name)
+        timings[f"{table_name}Seconds"] = round(time.perf_counter() - step, 4)
+
+    step = time.perf_counter()
+    timings["devices"] = len(list_device_partition_keys())
+    timings["deviceListSeconds"] = round(time.perf_counter() - step, 4)
+    timings["totalSeconds"] = round(time.perf_counter() - started, 4)
+    _startup_timings.setdefault("warmup", timings)
+    return timings
+
+
+@app.function_name("warmup")
+@app.warm_up_trigger("warmup")
+def warmup(warmup) -> None:
+    # Runs before a new instance receives traffic on Premium/Dedicated plans.
+    timings = prime_shared_state()
+    logging.info("Warmup complete: %s", json.dumps(timings))
+
+
+@app.function_name("warmupHttp")
+@app.route(route="warmup", methods=["GET"], auth_level=func.AuthLevel.FUNCTION)
+@safe_function
+def warmup_http(req: func.HttpRequest) -> func.HttpResponse:
+    # Consumption plans have no warmup trigger; ping this route after deploys
+    # or from a keep-warm probe instead.
+    timings = prime_shared_state()
+    return json_response({"message": "Warm", "warmup": timings, "startup": _startup_timings, "transport": table_transport_stats()})
+
+
+@app.function_name("diagnostics")
+@app.route(route="diagnostics", methods=["GET"], auth_level=func.AuthLevel.ADMIN)
+@safe_function
+def diagnostics(req: func.HttpRequest) -> func.HttpResponse:
+    # Admin (master key) only: the slowest list echoes request parameters.
+    return json_response({"queries": diagnostics_summary(), "coalescing": dict(_coalesce_stats, inflight=len(_inflight_history)), "ingestLimiter": ingest_limiter_summary(), "spillJournal": spill_journal_stats(), "transport": table_transport_stats()})
+
+
 @app.function_name("healthCheck")
 @app.route(route="health", methods=["GET"], auth_level=func.AuthLevel.ANONYMOUS)
 @safe_function
@@ -852,22 +3341,21 @@ def test_email(req: func.HttpRequest) -> func.HttpResponse:
         return json_response({"error":"Failed to send test email", "details": str(e)}, status=500)
 
 
-def send_alert_email(device_id: str, last_seen: str, subject_override: Optional[str] = None, debug: bool = False) -> dict:
-    """Send an alert email. Prefer Azure Communication Services (ACS) if configured, otherwise fall back to SMTP.
-    If `subject_override` is provided it will be used as the email subject. Use the special value "sender" to
-    set the subject to the verified ACS sender email address.
+ALERT_SEND_CONCURRENCY = max(1, int(os.getenv("ALERT_SEND_CONCURRENCY", "4")))
+# Collapse a run's offline alerts into one digest email once at least this many
+# devices are offline together. 0 disables digests.
+ALERT_DIGEST_MIN_DEVICES = int(os.getenv("ALERT_DIGEST_MIN_DEVICES", "0"))
 
-    When `debug=True`, ACS exceptions (if any) will be returned in the result under the key `acs_exception`.
 
-    Returns a dict describing how the send was attempted and any identifiers or errors.
-    Example: { "method": "acs", "id": "<msg-id>" } or { "method": "smtp", "sent": True }
-    """
-    recipient = os.getenv("ALERT_RECIPIENT", "tybierwagen@tamu.edu")
+def alert_timezone():
+    # Convert to Central Time (America/Chicago). ZoneInfo may be unavailable on Python<3.9 in some runtimes.
+    if ZoneInfo:
+        return ZoneInfo("America/Chicago")
+    return datetime.timezone(datetime.timedelta(hours=-5))  # fallback for CST (no DST shift)
 
-    # Try Azure Communication Services first (connection string stored in Key Vault for production)
-    acs_conn = os.getenv("ACS_CONNECTION_STRING")
-    acs_sender = os.getenv("ACS_SENDER_EMAIL", "DoNotReply@tybierwagen.com")
 
+def describe_last_seen(last_seen: str) -> Dict[str, str]:
+    """Return Central-time 'lastSeen', 'now' and 'elapsed' strings for alert bodies."""
     # Parse last_seen into a timezone-aware datetime (assume input is iso/z)
     try:
         last_seen_dt_utc = parse_timestamp_utc(last_seen)
@@ -878,12 +3366,7 @@ def send_alert_email(device_id: str, last_seen: str, subject_override: Optional[
         last_seen_dt_utc = datetime.datetime.now(datetime.timezone.utc)
 
     now_utc = datetime.datetime.now(datetime.timezone.utc)
-
-    # Convert to Central Time (America/Chicago). ZoneInfo may be unavailable on Python<3.9 in some runtimes.
-    if ZoneInfo:
-        central_tz = ZoneInfo("America/Chicago")
-    else:
-        central_tz = datetime.timezone(datetime.timedelta(hours=-5))  # fallback for CST (no DST shift)
+    central_tz = alert_timezone()
 
     try:
         last_seen_central = last_seen_dt_utc.astimezone(central_tz)
@@ -891,164 +3374,507 @@ def send_alert_email(device_id: str, last_seen: str, subject_override: Optional[
         last_seen_central = last_seen_dt_utc.replace(tzinfo=datetime.timezone.utc).astimezone(central_tz)
     now_central = now_utc.astimezone(central_tz)
 
-    # Human readable fields
-    last_seen_str = last_seen_central.replace(microsecond=0).isoformat()
-    now_str = now_central.replace(microsecond=0).isoformat()
+    return {
+        "lastSeen": last_seen_central.replace(microsecond=0).isoformat(),
+        "now": now_central.replace(microsecond=0).isoformat(),
+        "elapsed": format_timedelta((now_utc - last_seen_dt_utc).total_seconds()),
+    }
 
-    elapsed_seconds = (now_utc - last_seen_dt_utc).total_seconds()
-    elapsed_str = format_timedelta(elapsed_seconds)
 
-    body = f"""
+def format_alert_body(device_id: str, last_seen: str) -> str:
+    seen = describe_last_seen(last_seen)
+    return f"""
     The soil sensor device '{device_id}' has gone offline.
 
-    Last Seen (Central): {last_seen_str}
-    Current Time (Central): {now_str}
+    Last Seen (Central): {seen["lastSeen"]}
+    Current Time (Central): {seen["now"]}
 
-    Not seen in: {elapsed_str}
+    Not seen in: {seen["elapsed"]}
 
     Please check the robot's power and network connection.
     """
 
-    # Determine subject
-    if subject_override:
-        subject = str(subject_override)
-    else:
-        subject = f"ALERT: Soil Sensor Offline - {device_id}"
 
-    # If subject was explicitly set to the sentinel "sender", use the configured ACS sender email
-    if subject and subject.lower() == "sender":
-        subject = acs_sender or os.getenv("ACS_SENDER_EMAIL") or subject
+def format_digest_body(alerts: list) -> str:
+    lines = []
+    now_str = ""
+    for device_id, last_seen in alerts:
+        seen = describe_last_seen(last_seen)
+        now_str = seen["now"]
+        lines.append(f"    - {device_id}: last seen {seen['lastSeen']} ({seen['elapsed']} ago)")
+    device_lines = "\n".join(lines)
+    return f"""
+    {len(alerts)} soil sensor devices have gone offline.
 
-    acs_exception = None
+    Current Time (Central): {now_str}
 
-    # Attempt ACS send and return result including message id when available
-    if acs_conn and acs_sender:
-        try:
-            from azure.communication.email import EmailClient
-            client = EmailClient.from_connection_string(acs_conn)
-
-            # Use the payload shape expected by ACS SDK (senderAddress and recipient address)
-            message = {
-                "senderAddress": acs_sender,
-                "content": {"subject": subject, "plainText": body},
-                "recipients": {"to": [{"address": recipient}]}
-            }
-
-            poller = client.begin_send(message) # type: ignore
-            resp = poller.result()
-            # Response may be a mapping or object; try common keys
-            msg_id = None
+{device_lines}
+
+    Please check the robots' power and network connection.
+    """
+
+
+class AlertDispatcher:
+    """Sends alert emails for one health-check run.
+
+    One ACS client and one SMTP session are opened lazily and reused for every
+    message in the run; messages are sent on a bounded thread pool. The ACS
+    client is created under a lock so concurrent first sends share one client.
+    SMTP sessions are not thread-safe, so SMTP sends share the session under a lock.
+    Use as a context manager so the SMTP session is closed at the end."""
+
+    def __init__(self, max_workers: int = ALERT_SEND_CONCURRENCY):
+        self.max_workers = max(1, max_workers)
+        self.recipient = os.getenv("ALERT_RECIPIENT", "tybierwagen@tamu.edu")
+        self.acs_conn = os.getenv("ACS_CONNECTION_STRING")
+        self.acs_sender = os.getenv("ACS_SENDER_EMAIL", "DoNotReply@tybierwagen.com")
+        self._acs_client = None
+        self._acs_lock = threading.Lock()
+        self._smtp = None
+        self._smtp_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        if self._smtp is not None:
             try:
-                if isinstance(resp, dict):
-                    msg_id = resp.get('id') or resp.get('messageId') or resp.get('message_id')
-                else:
-                    msg_id = getattr(resp, 'id', None)
+                self._smtp.quit()
             except Exception:
+                pass
+            self._smtp = None
+
+    def _acs(self):
+        if self._acs_client is None:
+            with self._acs_lock:
+                if self._acs_client is None:
+                    from azure.communication.email import EmailClient
+                    self._acs_client = EmailClient.from_connection_string(self.acs_conn)
+        return self._acs_client
+
+    def _send_smtp(self, subject: str, body: str) -> None:
+        import smtplib
+        from email.mime.text import MIMEText
+        from email.mime.multipart import MIMEMultipart
+
+        smtp_user = os.getenv("SMTP_USER")
+        msg = MIMEMultipart()
+        msg['From'] = smtp_user or self.acs_sender
+        msg['To'] = self.recipient
+        msg['Subject'] = subject
+        msg.attach(MIMEText(body, 'plain'))
+
+        with self._smtp_lock:
+            if self._smtp is None:
+                server = smtplib.SMTP(os.getenv("SMTP_SERVER", "smtp.gmail.com"), int(os.getenv("SMTP_PORT", "587")))
+                server.starttls()
+                server.login(smtp_user, os.getenv("SMTP_PASSWORD"))
+                self._smtp = server
+            try:
+                self._smtp.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                # Session timed out between messages; reconnect once.
+                self._smtp = None
+                raise
+
+    def send(self, subject: str, body: str, debug: bool = False) -> dict:
+        """Send one message. Prefer ACS if configured, otherwise fall back to SMTP.
+        Returns a dict describing how the send was attempted, as send_alert_email does."""
+        import smtplib
+        import traceback
+
+        recipient = self.recipient
+        acs_exception = None
+
+        # Attempt ACS send and return result including message id when available
+        if self.acs_conn and self.acs_sender:
+            try:
+                # Use the payload shape expected by ACS SDK (senderAddress and recipient address)
+                message = {
+                    "senderAddress": self.acs_sender,
+                    "content": {"subject": subject, "plainText": body},
+                    "recipients": {"to": [{"address": recipient}]}
+                }
+
+                poller = self._acs().begin_send(message) # type: ignore
+                resp = poller.result()
+                # Response may be a mapping or object; try common keys
                 msg_id = None
+                try:
+                    if isinstance(resp, dict):
+                        msg_id = resp.get('id') or resp.get('messageId') or resp.get('message_id')
+                    else:
+                        msg_id = getattr(resp, 'id', None)
+                except Exception:
+                    msg_id = None
+
+                logging.info("Alert email queued via ACS to %s (id=%s)", recipient, msg_id)
+                result: Dict[str, Any] = {"method": "acs", "id": msg_id}
+                if debug:
+                    result["body_preview"] = body
+                return result
+            except Exception as e:
+                logging.exception("Failed to send alert via ACS, will attempt SMTP fallback: %s", e)
+                acs_exception = {"error": str(e), "trace": traceback.format_exc()}
+
+        # Fallback to SMTP if ACS not configured or failed
+        if not os.getenv("SMTP_USER") or not os.getenv("SMTP_PASSWORD"):
+            logging.warning("SMTP credentials not configured. Skipping email alert.")
+            result = {"method": "none", "reason": "smtp_credentials_missing"}
+        else:
+            try:
+                try:
+                    self._send_smtp(subject, body)
+                except smtplib.SMTPServerDisconnected:
+                    self._send_smtp(subject, body)
+                logging.info("Alert email sent to %s", recipient)
+                result = {"method": "smtp", "sent": True}
+            except Exception as e:
+                logging.error("Failed to send alert email via SMTP: %s", e)
+                result = {"method": "smtp", "sent": False, "error": str(e)}
 
-            logging.info("Alert email queued via ACS to %s (id=%s)", recipient, msg_id)
-            result: Dict[str, Any] = {"method": "acs", "id": msg_id}
-            if debug:
-                result["body_preview"] = body
-            return result
-        except Exception as e:
-            logging.exception("Failed to send alert via ACS, will attempt SMTP fallback: %s", e)
-            acs_exception = {"error": str(e), "trace": traceback.format_exc()}
-
-    # Fallback to SMTP if ACS not configured or failed
-    smtp_server = os.getenv("SMTP_SERVER", "smtp.gmail.com")
-    smtp_port = int(os.getenv("SMTP_PORT", "587"))
-    smtp_user = os.getenv("SMTP_USER")
-    smtp_password = os.getenv("SMTP_PASSWORD")
-
-    if not smtp_user or not smtp_password:
-        logging.warning("SMTP credentials not configured. Skipping email alert.")
-        result: Dict[str, Any] = {"method": "none", "reason": "smtp_credentials_missing"}
         if debug and acs_exception:
             result["acs_exception"] = acs_exception
         if debug:
             result["body_preview"] = body
         return result
-    msg = MIMEMultipart()
-    msg['From'] = smtp_user or acs_sender
-    msg['To'] = recipient
-    msg['Subject'] = subject
-    msg.attach(MIMEText(body, 'plain'))
 
+    def send_many(self, messages: list) -> list:
+        """Send (subject, body) pairs concurrently; results are returned in input order."""
+        if len(messages) <= 1 or self.max_workers == 1:
+            return [self.send(subject, body) for subject, body in messages]
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(messages))) as pool:
+            return list(pool.map(lambda m: self.send(*m), messages))
+
+    def send_offline_alerts(self, alerts: list) -> list:
+        """Alert for (device_id, last_seen) pairs, as one digest email when
+        ALERT_DIGEST_MIN_DEVICES is reached or one email per device otherwise."""
+        if not alerts:
+            return []
+        if ALERT_DIGEST_MIN_DEVICES and len(alerts) >= ALERT_DIGEST_MIN_DEVICES:
+            subject = f"ALERT: {len(alerts)} Soil Sensors Offline"
+            return [self.send(subject, format_digest_body(alerts))]
+        return self.send_many([
+            (f"ALERT: Soil Sensor Offline - {device_id}", format_alert_body(device_id, last_seen))
+            for device_id, last_seen in alerts
+        ])
+
+
+def send_alert_email(device_id: str, last_seen: str, subject_override: Optional[str] = None, debug: bool = False) -> dict:
+    """Send an alert email. Prefer Azure Communication Services (ACS) if configured, otherwise fall back to SMTP.
+    If `subject_override` is provided it will be used as the email subject. Use the special value "sender" to
+    set the subject to the verified ACS sender email address.
+
+    When `debug=True`, ACS exceptions (if any) will be returned in the result under the key `acs_exception`.
+
+    Returns a dict describing how the send was attempted and any identifiers or errors.
+    Example: { "method": "acs", "id": "<msg-id>" } or { "method": "smtp", "sent": True }
+    """
+    with AlertDispatcher(max_workers=1) as dispatcher:
+        body = format_alert_body(device_id, last_seen)
+
+        # Determine subject
+        if subject_override:
+            subject = str(subject_override)
+        else:
+            subject = f"ALERT: Soil Sensor Offline - {device_id}"
+
+        # If subject was explicitly set to the sentinel "sender", use the configured ACS sender email
+        if subject and subject.lower() == "sender":
+            subject = dispatcher.acs_sender or os.getenv("ACS_SENDER_EMAIL") or subject
+
+        return dispatcher.send(subject, body, debug=debug)
+
+
+def ensure_liveness_index(devices_client, index_client) -> None:
+    """Build the liveness index from a full Devices scan the first time it is needed.
+    A marker row records completion so later runs skip straight to the deadline query."""
     try:
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(smtp_user, smtp_password)
-        server.send_message(msg)
-        server.quit()
-        logging.info("Alert email sent to %s", recipient)
-        result: Dict[str, Any] = {"method": "smtp", "sent": True}
-        if debug and acs_exception:
-            result["acs_exception"] = acs_exception
-        if debug:
-            result["body_preview"] = body
-        return result
-    except Exception as e:
-        logging.error("Failed to send alert email via SMTP: %s", e)
-        result: Dict[str, Any] = {"method": "smtp", "sent": False, "error": str(e)}
-        if debug and acs_exception:
-            result["acs_exception"] = acs_exception
-        if debug:
-            result["body_preview"] = body
-        return result
+        index_client.get_entity(partition_key="Meta", row_key="built")
+        return
+    except ResourceNotFoundError:
+        pass
+
+    logging.info("Liveness index missing; building from Devices table")
+    now = datetime.datetime.now(datetime.timezone.utc)
+    index_ops = []
+    device_updates = []
+    for device in devices_client.query_entities(query_filter="PartitionKey eq 'Device'"):
+        device_key = device.get("RowKey")
+        last_seen = device.get("lastSeen")
+        key = offline_deadline_key(device_key, last_seen)
+        if not key:
+            continue
+        # Devices alerted recently stay quiet until the repeat window ends.
+        last_alert = parse_timestamp_utc(device.get("lastAlertSentAt"))
+        if last_alert and (now - last_alert).total_seconds() < ALERT_REPEAT_SECONDS:
+            key = liveness_row_key(device_key, last_alert + datetime.timedelta(seconds=ALERT_REPEAT_SECONDS))
+        index_ops.extend(liveness_move_ops(device_key, None, key, last_seen))
+        device_updates.append(("update", {"PartitionKey": "Device", "RowKey": device_key, "livenessKey": key}, {"mode": UpdateMode.MERGE}))
+
+    submit_batched(index_client, index_ops)
+    submit_batched(devices_client, device_updates)
+    index_client.upsert_entity(entity={"PartitionKey": "Meta", "RowKey": "built", "builtAt": now_iso()})
+    logging.info("Liveness index built for %d devices", len(device_updates))
+
 
 @app.function_name("checkDeviceHealth")
 @app.timer_trigger(schedule="0 */10 * * * *", arg_name="myTimer", run_on_startup=False, use_monitor=False) 
 def check_device_health(myTimer: func.TimerRequest) -> None:
     logging.info("Running scheduled health check")
     client = get_table_client("Devices")
-    if not client:
+    index = ensure_table_client(LIVENESS_TABLE_NAME)
+    if not client or not index:
         return
 
     try:
-        # Check all active devices
-        devices = list(client.query_entities(query_filter="status eq 'active'"))
+        ensure_liveness_index(client, index)
         now = datetime.datetime.now(datetime.timezone.utc)
-        
-        for device in devices:
-            last_seen_str = device.get("lastSeen")
-            if not last_seen_str:
+
+        # Only devices whose offline (or alert-repeat) deadline has passed are read.
+        due = list(index.query_entities(
+            query_filter=f"PartitionKey eq '{LIVENESS_PARTITION}' and RowKey lt '{int(now.timestamp()) + 1:010d}'"
+        ))
+        logging.info("Health check: %d devices past their deadline", len(due))
+
+        index_ops = []
+        device_updates = []
+        offline_alerts = []
+        for row in due:
+            device_key = row.get("device")
+            try:
+                device = client.get_entity(partition_key="Device", row_key=device_key)
+            except ResourceNotFoundError:
+                index_ops.append(("delete", row))
+                continue
+
+            if device.get("livenessKey") != row["RowKey"]:
+                # Left behind by a concurrent ingest; the device's live row is elsewhere.
+                index_ops.append(("delete", row))
                 continue
-            
+
+            last_seen_str = device.get("lastSeen")
             last_seen = parse_timestamp_utc(last_seen_str)
             if not last_seen:
-                logging.warning("Skipping health check for device %s due to malformed lastSeen: %r", device.get("RowKey"), last_seen_str)
+                logging.warning("Skipping health check for device %s due to malformed lastSeen: %r", device_key, last_seen_str)
+                index_ops.append(("delete", row))
                 continue
-            diff = (now - last_seen).total_seconds()
-            
-            # If offline for more than 10 minutes (600 seconds)
-            if diff > 600:
-                # Check if we've already sent an alert in the last 24 hours to avoid spamming
-                last_alert = device.get("lastAlertSentAt")
-                should_alert = True
-                if last_alert:
-                    last_alert_dt = parse_timestamp_utc(last_alert)
-                    if not last_alert_dt:
-                        logging.warning("Ignoring malformed lastAlertSentAt for device %s: %r", device.get("RowKey"), last_alert)
-                    elif (now - last_alert_dt).total_seconds() < 86400: # 24 hours
-                        should_alert = False
-                
-                if should_alert:
-                    device_id = str(device.get("RowKey") or "unknown")
-                    logging.warning("Device %s is offline (Last seen: %s). Sending alert.", device_id, last_seen_str)
-                    send_alert_email(device_id, last_seen_str)
-                    
-                    # Update device with alert timestamp
-                    device["lastAlertSentAt"] = now_iso()
-                    client.update_entity(mode=UpdateMode.REPLACE, entity=device)
-                else:
-                    logging.info("Device %s is offline but alert was already sent recently.", device.get("RowKey"))
+
+            update = {"PartitionKey": "Device", "RowKey": device_key}
+            if (now - last_seen).total_seconds() <= DEVICE_OFFLINE_SECONDS:
+                # Device clock ahead of ours; re-arm at its real deadline.
+                new_key = offline_deadline_key(device_key, last_seen_str) or row["RowKey"]
             else:
-                # Device is back online, reset alert timestamp if needed
-                if device.get("lastAlertSentAt"):
-                    logging.info("Device %s is back online. Resetting alert status.", device.get("RowKey"))
-                    device["lastAlertSentAt"] = None
-                    client.update_entity(mode=UpdateMode.REPLACE, entity=device)
-                
+                device_id = str(device_key or "unknown")
+                logging.warning("Device %s is offline (Last seen: %s). Sending alert.", device_id, last_seen_str)
+                offline_alerts.append((device_id, last_seen_str))
+                # Re-arm for the next reminder instead of re-reading the device every run.
+                new_key = liveness_row_key(device_key, now + datetime.timedelta(seconds=ALERT_REPEAT_SECONDS))
+                update["lastAlertSentAt"] = now_iso()
+
+            update["livenessKey"] = new_key
+            device_updates.append(("update", update, {
+                "mode": UpdateMode.MERGE,
+                "etag": device.metadata.get("etag"),
+                "match_condition": MatchConditions.IfNotModified,
+            }))
+            index_ops.extend(liveness_move_ops(device_key, row["RowKey"], new_key, last_seen_str))
+
+        if offline_alerts:
+            with AlertDispatcher() as dispatcher:
+                dispatcher.send_offline_alerts(offline_alerts)
+
+        # An ingest that races with this run fails the etag check and keeps its own state.
+        submit_batched(client, device_updates)
+        submit_batched(index, index_ops)
     except Exception as e:
         logging.error("Health check query failed: %s", e)
+
+
+@app.function_name("materializeDashboardSeries")
+@app.timer_trigger(schedule="0 */5 * * * *", arg_name="myTimer", run_on_startup=False, use_monitor=False)
+def materialize_dashboard_series(myTimer: func.TimerRequest) -> None:
+    if not DASHBOARD_SERIES:
+        return
+    client = ensure_table_client(SERIES_TABLE_NAME)
+    if not client:
+        return
+
+    started = time.perf_counter()
+    deadline = time.monotonic() + DASHBOARD_SERIES_MAX_RUN_SECONDS
+    written = 0
+    devices = [pk.replace("_", ".") for pk in list_device_partition_keys()]
+    # Start where the last run ran out of time so every device gets its turn.
+    offset = _series_state["next"] % len(devices) if devices else 0
+    targets = [None] + devices[offset:] + devices[:offset]
+    done = 0
+    for device_ip in targets:
+        if time.monotonic() > deadline:
+            _series_state["next"] = offset + max(0, done - 1)
+            logging.info("Dashboard series time budget spent after %d of %d targets; resuming next run", done, len(targets))
+            break
+        try:
+            written += materialize_series(device_ip, client)
+        except Exception as e:
+            logging.error("Failed to materialize series for %s: %s", device_ip or "all devices", e)
+        done += 1
+    logging.info("Materialized %d dashboard series for %d targets in %.2fs", written, done, time.perf_counter() - started)
+
+
+# Raw retention. Raw SensorData rows older than a device's horizon are deleted
+# once the day (and month) rollups covering them are confirmed to hold at
+# least as many readings as are being removed. The horizon is the Devices row
+# `retentionDays`, else RAW_RETENTION_DAYS; 0 keeps raw data forever. Progress
+# is a per-device RowKey cursor in RetentionState, so a run cut short by the
+# time budget or by throttling resumes where it stopped.
+RAW_RETENTION_DAYS = int(os.getenv("RAW_RETENTION_DAYS", "0"))
+RETENTION_TABLE_NAME = "RetentionState"
+RETENTION_MAX_RUN_SECONDS = float(os.getenv("RETENTION_MAX_RUN_SECONDS", "240"))
+RETENTION_BATCH_PAUSE_SECONDS = float(os.getenv("RETENTION_BATCH_PAUSE_SECONDS", "0.2"))
+# Stop the run when this many throttled storage responses were seen during it.
+RETENTION_MAX_THROTTLED = int(os.getenv("RETENTION_MAX_THROTTLED", "5"))
+
+
+def retention_horizons() -> Dict[str, int]:
+    """SensorData partition key -> retention days, for devices that have one."""
+    client = get_table_client("Devices")
+    if not client:
+        return {}
+    horizons = {}
+    for device in client.query_entities(query_filter="PartitionKey eq 'Device'", select=["RowKey", "retentionDays"]):
+        days = device.get("retentionDays")
+        try:
+            days = int(days) if days not in (None, "") else RAW_RETENTION_DAYS
+        except (TypeError, ValueError):
+            days = RAW_RETENTION_DAYS
+        if days > 0 and device.get("RowKey"):
+            horizons[device["RowKey"]] = days
+    return horizons
+
+
+def rollup_count(rollup_client, partition_key: str, granularity: str, bucket_start: datetime.datetime, cache: dict) -> int:
+    row_key = bucket_start.isoformat().replace("+00:00", "Z")
+    key = (partition_key, granularity, row_key)
+    if key not in cache:
+        try:
+            entity = rollup_client.get_entity(partition_key=f"{partition_key}|{granularity}", row_key=row_key, select=["count"])
+            cache[key] = int(entity.get("count") or 0)
+        except ResourceNotFoundError:
+            cache[key] = 0
+    return cache[key]
+
+
+def rollups_cover(rollup_client, partition_key: str, rows: list, cache: dict) -> bool:
+    """True when every day and month the rows fall in has a rollup counting at
+    least as many readings as the rows being removed from it."""
+    per_bucket: Dict[tuple, int] = collections.Counter()
+    for row in rows:
+        ts = parse_timestamp_utc(row.get("timestamp"))
+        if ts is None:
+            # Unparseable rows never made it into a rollup; they are safe to drop.
+            continue
+        day = ts.replace(hour=0, minute=0, second=0, microsecond=0)
+        per_bucket[("day", day)] += 1
+        per_bucket[("month", day.replace(day=1))] += 1
+    return all(rollup_count(rollup_client, partition_key, g, start, cache) >= n for (g, start), n in per_bucket.items())
+
+
+def apply_raw_retention(partition_key: str, days: int, source, rollup_client, state_client, deadline: float, throttled_at_start: int) -> int:
+    """Delete one device's expired raw rows a RowKey-day at a time. Returns rows deleted."""
+    horizon = int(time.time()) - days * 86400
+    horizon -= horizon % 86400
+    try:
+        state = state_client.get_entity(partition_key="Retention", row_key=partition_key)
+    except ResourceNotFoundError:
+        state = {"PartitionKey": "Retention", "RowKey": partition_key, "cursor": "", "deletedTotal": 0}
+
+    cursor = state.get("cursor") or ""
+    cursor_epoch = int(cursor.split("_", 1)[0]) if cursor[:1].isdigit() else None
+    filters = raw_partition_filters(
+        partition_key,
+        datetime.datetime.fromtimestamp(cursor_epoch, datetime.timezone.utc) if cursor_epoch else None,
+        datetime.datetime.fromtimestamp(horizon, datetime.timezone.utc),
+        f"RowKey ge '{cursor}' and RowKey lt '{horizon:010d}_'",
+    )
+    rows = (row for q in filters for row in source.query_entities(query_filter=q, select=["PartitionKey", "RowKey", "timestamp"]))
+
+    cache: dict = {}
+    deleted = 0
+    slice_rows: list = []
+    slice_day = None
+
+    def flush() -> bool:
+        nonlocal deleted
+        if not slice_rows:
+            return True
+        if not rollups_cover(rollup_client, partition_key, slice_rows, cache):
+            logging.warning("Retention for %s stopped at %s: rollups do not cover the raw rows", partition_key, slice_rows[0]["RowKey"])
+            return False
+        for group in group_by_partition(slice_rows):
+            ops = [("delete", {"PartitionKey": r["PartitionKey"], "RowKey": r["RowKey"]}) for r in group]
+            for i in range(0, len(ops), TABLE_BATCH_SIZE):
+                deleted += submit_batched(source, ops[i:i + TABLE_BATCH_SIZE])
+                time.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+        # Never move the cursor backwards (legacy and shard partitions can interleave mid-migration).
+        state["cursor"] = max(str(state.get("cursor") or ""), f"{slice_day + 86400:010d}_")
+        state["deletedTotal"] = int(state.get("deletedTotal") or 0) + len(slice_rows)
+        state["lastRunAt"] = now_iso()
+        state_client.upsert_entity(entity=state)
+        slice_rows.clear()
+        return True
+
+    for row in rows:
+        epoch = int(row["RowKey"].split("_", 1)[0])
+        day = epoch - epoch % 86400
+        if slice_day is not None and day != slice_day:
+            if not flush():
+                return deleted
+            if time.monotonic() > deadline or _transport_stats["throttled"] - throttled_at_start >= RETENTION_MAX_THROTTLED:
+                return deleted
+        slice_day = day
+        slice_rows.append(row)
+    flush()
+    return deleted
+
+
+@app.function_name("rawRetention")
+@app.timer_trigger(schedule="0 30 3 * * *", arg_name="myTimer", run_on_startup=False, use_monitor=False)
+def raw_retention(myTimer: func.TimerRequest) -> None:
+    source = get_table_client("SensorData")
+    rollup_client = get_table_client(ROLLUP_TABLE_NAME)
+    state_client = ensure_table_client(RETENTION_TABLE_NAME)
+    if not source or not rollup_client or not state_client:
+        return
+
+    started = time.monotonic()
+    deadline = started + RETENTION_MAX_RUN_SECONDS
+    throttled_at_start = _transport_stats["throttled"]
+    deleted = 0
+    try:
+        horizons = retention_horizons()
+    except Exception as e:
+        logging.error("Retention could not list devices: %s", e)
+        return
+
+    for partition_key, days in horizons.items():
+        if time.monotonic() > deadline:
+            logging.info("Retention time budget spent; resuming next run")
+            break
+        if _transport_stats["throttled"] - throttled_at_start >= RETENTION_MAX_THROTTLED:
+            logging.warning("Retention backing off after %d throttled responses", _transport_stats["throttled"] - throttled_at_start)
+            break
+        try:
+            deleted += apply_raw_retention(partition_key, days, source, rollup_client, state_client, deadline, throttled_at_start)
+        except Exception as e:
+            logging.error("Retention failed for %s: %s", partition_key, e)
+    logging.info("Retention deleted %d raw rows in %.1fs", deleted, time.monotonic() - started)
+
+
+_MODULE_LOADED = time.perf_counter()
+_startup_timings["moduleLoadSeconds"] = round(_MODULE_LOADED - _IMPORT_STARTED, 4)
+if STARTUP_PROFILE:
+    logging.info("Startup profile: %s", json.dumps(_startup_timings))
@@ -1,13 +1,16 @@
 import argparse
+import calendar
 import datetime as dt
 import json
 import logging
 import os
 from collections import defaultdict
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
-from azure.data.tables import TableServiceClient, UpdateMode
+from azure.data.tables import TableServiceClient
+
+from backfill_rollups import RollupWriter, load_existing_rollups, query_device_rows, rollup_granularities, rollup_timezones, split_granularity
 
 NUMERIC_FIELDS = ("humidity", "temperature", "battery", "moisture", "ph", "light")
 ROLLUP_TABLE_NAME = "SensorHistoryRollups"
@@ -55,6 +58,11 @@ def parse_timestamp(value: Any):
 
 
 def floor_to_bucket(timestamp: dt.datetime, granularity: str) -> dt.datetime:
+    granularity, zone = split_granularity(granularity)
+    if zone is not None:
+        local = timestamp.astimezone(zone)
+        start = dt.datetime(local.year, local.month, 1 if granularity == "month" else local.day, tzinfo=zone)
+        return start.astimezone(dt.timezone.utc)
     timestamp = timestamp.astimezone(dt.timezone.utc).replace(microsecond=0)
     if granularity == "hour":
         return timestamp.replace(minute=0, second=0)
@@ -73,6 +81,20 @@ def rollup_row_key(bucket_start: dt.datetime) -> str:
     return bucket_start.replace(microsecond=0).isoformat().replace("+00:00", "Z")
 
 
+def bucket_end(bucket_start: dt.datetime, granularity: str) -> dt.datetime:
+    granularity, zone = split_granularity(granularity)
+    if zone is not None:
+        # Step in local dates so 23- and 25-hour DST days end at local midnight.
+        local = bucket_start.astimezone(zone).date()
+        following = local + dt.timedelta(days=1) if granularity == "day" else (local.replace(day=28) + dt.timedelta(days=4)).replace(day=1)
+        return dt.datetime(following.year, following.month, following.day, tzinfo=zone).astimezone(dt.timezone.utc)
+    if granularity == "hour":
+        return bucket_start + dt.timedelta(hours=1)
+    if granularity == "day":
+        return bucket_start + dt.timedelta(days=1)
+    return bucket_start + dt.timedelta(days=calendar.monthrange(bucket_start.year, bucket_start.month)[1])
+
+
 def to_float(value: Any):
     if value is None or value == "":
         return None
@@ -82,69 +104,172 @@ def to_float(value: Any):
         return None
 
 
-def build_and_write_for_device(conn_str: str, partition_key: str) -> None:
+def new_bucket(device_ip: str, granularity: str, bucket_start: dt.datetime) -> Dict[str, Any]:
+    return {"deviceIp": device_ip, "granularity": granularity, "bucket_start": bucket_start, "count": 0, "sums": defaultdict(float), "numeric_counts": defaultdict(int)}
+
+
+def add_to_bucket(bucket: Dict[str, Any], row: Dict[str, Any]) -> None:
+    bucket["count"] += 1
+    for field in NUMERIC_FIELDS:
+        numeric = to_float(row.get(field))
+        if numeric is None:
+            continue
+        bucket["sums"][field] += numeric
+        bucket["numeric_counts"][field] += 1
+
+
+def rollup_entity(bucket: Dict[str, Any], now: str) -> Dict[str, Any]:
+    bucket_start = bucket["bucket_start"]
+    entity = {
+        "PartitionKey": rollup_bucket_key(bucket["deviceIp"], bucket["granularity"]),
+        "RowKey": rollup_row_key(bucket_start),
+        "deviceIp": bucket["deviceIp"],
+        "granularity": bucket["granularity"],
+        "timestamp": rollup_row_key(bucket_start),
+        "count": bucket["count"],
+        "lastUpdated": now,
+    }
+    for field in ("humidity", "temperature", "battery", "moisture", "ph", "light"):
+        n = bucket["numeric_counts"].get(field)
+        entity[field] = round(bucket["sums"][field] / n, 2) if n else None
+    return entity
+
+
+def device_rollup_writer(rollup, partition_key: str, granularities: list, dry_run: bool, keep_diff: bool) -> RollupWriter:
+    """Writer primed with the device's stored rollups (one query per granularity)."""
+    existing = load_existing_rollups(rollup, (f"{partition_key}|{g}" for g in granularities))
+    logging.info("Loaded %s stored rollups for %s", len(existing), partition_key)
+    return RollupWriter(rollup, existing, dry_run=dry_run, keep_diff=keep_diff)
+
+
+def build_and_write_for_device(conn_str: str, partition_key: str, dry_run: bool = False, diff_report: Optional[str] = None, timezones: tuple = ()) -> None:
     service = TableServiceClient.from_connection_string(conn_str)
     source = service.get_table_client(SOURCE_TABLE_NAME)
     rollup = service.get_table_client(ROLLUP_TABLE_NAME)
 
     select = ["PartitionKey", "RowKey", "timestamp", "deviceIp", *NUMERIC_FIELDS, "Timestamp"]
-    query = f"PartitionKey eq '{partition_key}'"
     logging.info("Querying SensorData for partition %s", partition_key)
-    rows = list(source.query_entities(query_filter=query, select=select))
+    # Covers the legacy per-device partition and any time shards ("<device>|2024-05").
+    rows = list(query_device_rows(source, partition_key, select=select))
     logging.info("Found %s raw rows for %s", len(rows), partition_key)
 
+    granularities = rollup_granularities(timezones)
     buckets = {}
     for row in rows:
         timestamp = parse_timestamp(row.get("timestamp") or row.get("Timestamp"))
         if not timestamp:
             continue
         device_ip = row.get("deviceIp") or partition_key.replace('_', '.')
-        for granularity in ("hour", "day", "month"):
+        for granularity in granularities:
             bucket_start = floor_to_bucket(timestamp, granularity)
             bucket_id = (device_ip, granularity, rollup_row_key(bucket_start))
             bucket = buckets.get(bucket_id)
             if not bucket:
-                bucket = {"deviceIp": device_ip, "granularity": granularity, "bucket_start": bucket_start, "count": 0, "sums": defaultdict(float), "numeric_counts": defaultdict(int)}
+                bucket = new_bucket(device_ip, granularity, bucket_start)
                 buckets[bucket_id] = bucket
-            bucket["count"] += 1
-            for field in NUMERIC_FIELDS:
-                numeric = to_float(row.get(field))
-                if numeric is None:
-                    continue
-                bucket["sums"][field] += numeric
-                bucket["numeric_counts"][field] += 1
+            add_to_bucket(bucket, row)
 
-    logging.info("Built %s buckets; writing to rollup table...", len(buckets))
+    logging.info("Built %s buckets; writing changed ones to rollup table...", len(buckets))
     now = dt.datetime.now(dt.timezone.utc).replace(microsecond=0).isoformat().replace("+00:00", "Z")
-    written = 0
+    writer = device_rollup_writer(rollup, partition_key, granularities, dry_run, bool(diff_report))
     for bucket in buckets.values():
-        bucket_start = bucket["bucket_start"]
-        entity = {
-            "PartitionKey": rollup_bucket_key(bucket["deviceIp"], bucket["granularity"]),
-            "RowKey": rollup_row_key(bucket_start),
-            "deviceIp": bucket["deviceIp"],
-            "granularity": bucket["granularity"],
-            "timestamp": rollup_row_key(bucket_start),
-            "count": bucket["count"],
-            "humidity": (round(bucket["sums"]["humidity"]/bucket["numeric_counts"].get("humidity",1),2) if bucket["numeric_counts"].get("humidity") else None),
-            "temperature": (round(bucket["sums"]["temperature"]/bucket["numeric_counts"].get("temperature",1),2) if bucket["numeric_counts"].get("temperature") else None),
-            "battery": (round(bucket["sums"]["battery"]/bucket["numeric_counts"].get("battery",1),2) if bucket["numeric_counts"].get("battery") else None),
-            "moisture": (round(bucket["sums"]["moisture"]/bucket["numeric_counts"].get("moisture",1),2) if bucket["numeric_counts"].get("moisture") else None),
-            "ph": (round(bucket["sums"]["ph"]/bucket["numeric_counts"].get("ph",1),2) if bucket["numeric_counts"].get("ph") else None),
-            "light": (round(bucket["sums"]["light"]/bucket["numeric_counts"].get("light",1),2) if bucket["numeric_counts"].get("light") else None),
-            "lastUpdated": now,
-        }
-        try:
-            rollup.upsert_entity(mode=UpdateMode.REPLACE, entity=entity)
-            written += 1
-        except Exception as e:
-            logging.warning("Failed to upsert rollup entity: %s", e)
-    logging.info("Wrote %s rollup rows for partition %s", written, partition_key)
+        writer.write(rollup_entity(bucket, now))
+    writer.finish(diff_report)
+
+
+def stream_and_write_for_device(conn_str: str, partition_key: str, grace_seconds: int = 0, skew_seconds: int = 3600, dry_run: bool = False, diff_report: Optional[str] = None, timezones: tuple = ()) -> None:
+    """Streaming variant of build_and_write_for_device. Rows arrive in RowKey
+    (time) order, so each hour/day/month bucket is written as soon as the
+    newest reading seen is past its end (plus `grace_seconds`), while the
+    query is still paging. Memory holds only the open buckets. A row that
+    lands in an already-written bucket marks it late; late buckets are
+    recomputed at the end from a RowKey-range query of just that bucket."""
+    service = TableServiceClient.from_connection_string(conn_str)
+    source = service.get_table_client(SOURCE_TABLE_NAME)
+    rollup = service.get_table_client(ROLLUP_TABLE_NAME)
+
+    select = ["PartitionKey", "RowKey", "timestamp", "deviceIp", *NUMERIC_FIELDS, "Timestamp"]
+    grace = dt.timedelta(seconds=grace_seconds)
+    granularities = rollup_granularities(timezones)
+    now = dt.datetime.now(dt.timezone.utc).replace(microsecond=0).isoformat().replace("+00:00", "Z")
+
+    open_buckets: Dict[tuple, Dict[str, Any]] = {}
+    late: Dict[tuple, list] = {}
+    watermark = None
+    stats = {"rows": 0, "written": 0, "peakOpen": 0}
+    # Stored rollups are one small row per bucket, so holding them for the
+    # comparison stays far below holding the raw history.
+    writer = device_rollup_writer(rollup, partition_key, granularities, dry_run, bool(diff_report))
+
+    def write(bucket):
+        writer.write(rollup_entity(bucket, now))
+        stats["written"] += 1
+
+    def close_due():
+        for key in [k for k, b in open_buckets.items() if bucket_end(b["bucket_start"], b["granularity"]) + grace <= watermark]:
+            write(open_buckets.pop(key))
+
+    logging.info("Streaming SensorData for partition %s", partition_key)
+    for row in query_device_rows(source, partition_key, select=select):
+        timestamp = parse_timestamp(row.get("timestamp") or row.get("Timestamp"))
+        if not timestamp:
+            continue
+        stats["rows"] += 1
+        device_ip = row.get("deviceIp") or partition_key.replace('_', '.')
+        for granularity in granularities:
+            bucket_start = floor_to_bucket(timestamp, granularity)
+            key = (device_ip, granularity, bucket_start)
+            bucket = open_buckets.get(key)
+            if bucket is None:
+                if watermark is not None and bucket_end(bucket_start, granularity) + grace <= watermark:
+                    late.setdefault(key, []).append(row)
+                    continue
+                bucket = open_buckets[key] = new_bucket(device_ip, granularity, bucket_start)
+            add_to_bucket(bucket, row)
+        if watermark is None or timestamp > watermark:
+            watermark = timestamp
+            close_due()
+        stats["peakOpen"] = max(stats["peakOpen"], len(open_buckets))
+        if stats["rows"] % 10000 == 0:
+            logging.info("Streamed %s rows, %s rollups written", stats["rows"], stats["written"])
+
+    for bucket in open_buckets.values():
+        write(bucket)
+
+    for (device_ip, granularity, bucket_start), late_rows in sorted(late.items(), key=lambda kv: (kv[0][2], kv[0][1])):
+        # Out-of-order rows: rebuild the whole bucket from its own time range,
+        # plus any late rows whose RowKey falls outside that range.
+        end = bucket_end(bucket_start, granularity)
+        lo = int(bucket_start.timestamp()) - skew_seconds
+        hi = int(end.timestamp()) + skew_seconds
+        bucket = new_bucket(device_ip, granularity, bucket_start)
+        seen = set()
+        for row in query_device_rows(source, partition_key, f"RowKey ge '{lo:010d}_' and RowKey lt '{hi:010d}_'", select):
+            ts = parse_timestamp(row.get("timestamp") or row.get("Timestamp"))
+            if ts and bucket_start <= ts < end and (row.get("deviceIp") or partition_key.replace('_', '.')) == device_ip:
+                add_to_bucket(bucket, row)
+                seen.add((row["PartitionKey"], row["RowKey"]))
+        for row in late_rows:
+            if (row["PartitionKey"], row["RowKey"]) not in seen:
+                add_to_bucket(bucket, row)
+        if bucket["count"]:
+            write(bucket)
+
+    logging.info(
+        "Streamed %s rows for partition %s: closed %s rollup buckets (%s late buckets rebuilt), peak open buckets %s",
+        stats["rows"], partition_key, stats["written"], len(late), stats["peakOpen"],
+    )
+    writer.finish(diff_report)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Backfill rollups for a single device partition.")
     parser.add_argument("partition", help="PartitionKey to backfill (e.g., 192_168_1_33)")
+    parser.add_argument("--stream", action="store_true", help="Write each bucket as soon as its window closes instead of holding the whole history in memory.")
+    parser.add_argument("--grace-seconds", type=int, default=0, help="With --stream, keep buckets open this long past their end for slightly out-of-order rows.")
+    parser.add_argument("--dry-run", action="store_true", help="Report which rollups would change without writing.")
+    parser.add_argument("--diff-report", help="Write the new/changed buckets to this JSON file.")
+    parser.add_argument("--timezone", action="append", help="Also build day/month rollups aligned to this IANA zone (repeatable). Default: ROLLUP_TIMEZONES.")
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
     try:
@@ -152,4 +277,8 @@ if __name__ == '__main__':
     except Exception as e:
         logging.error("Missing connection string: %s", e)
         raise SystemExit(1)
-    build_and_write_for_device(conn, args.partition)
+    timezones = tuple(args.timezone if args.timezone is not None else rollup_timezones())
+    if args.stream:
+        stream_and_write_for_device(conn, args.partition, args.grace_seconds, dry_run=args.dry_run, diff_report=args.diff_report, timezones=timezones)
+    else:
+        build_and_write_for_device(conn, args.partition, dry_run=args.dry_run, diff_report=args.diff_report, timezones=timezones)
@@ -1,5 +1,6 @@
 import argparse
 import datetime as dt
+import hashlib
 import json
 import logging
 import os
@@ -7,7 +8,8 @@ import time
 from azure.core.exceptions import ResourceExistsError, HttpResponseError
 from collections import defaultdict
 from pathlib import Path
-from typing import Any, Dict, Iterable, Optional, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from zoneinfo import ZoneInfo
 
 from azure.data.tables import TableServiceClient, UpdateMode
 
@@ -75,7 +77,33 @@ def parse_timestamp(value: Any) -> Optional[dt.datetime]:
         return None
 
 
+def rollup_timezones() -> List[str]:
+    """IANA zones that also get local day/month rollups (ROLLUP_TIMEZONES, comma separated)."""
+    load_local_settings()
+    return [z.strip() for z in os.getenv("ROLLUP_TIMEZONES", "").split(",") if z.strip()]
+
+
+def rollup_granularities(timezones: Iterable[str] = ()) -> List[str]:
+    """UTC tiers plus "day@America~Chicago"-style local tiers, named as in functions/function_app.py."""
+    names = ["hour", "day", "month"]
+    for tz in timezones:
+        ZoneInfo(tz)  # Fail early on a misspelled zone.
+        names += [f"day@{tz.replace('/', '~')}", f"month@{tz.replace('/', '~')}"]
+    return names
+
+
+def split_granularity(granularity: str) -> Tuple[str, Optional[ZoneInfo]]:
+    base, _, zone = granularity.partition("@")
+    return base, ZoneInfo(zone.replace("~", "/")) if zone else None
+
+
 def floor_to_bucket(timestamp: dt.datetime, granularity: str) -> dt.datetime:
+    granularity, zone = split_granularity(granularity)
+    if zone is not None:
+        # Local midnight, returned as the UTC instant it falls on (DST-aware).
+        local = timestamp.astimezone(zone)
+        start = dt.datetime(local.year, local.month, 1 if granularity == "month" else local.day, tzinfo=zone)
+        return start.astimezone(dt.timezone.utc)
     timestamp = timestamp.astimezone(dt.timezone.utc).replace(microsecond=0)
     if granularity == "hour":
         return timestamp.replace(minute=0, second=0)
@@ -109,18 +137,35 @@ def get_device_ip(row: Dict[str, Any]) -> str:
     device_ip = row.get("deviceIp")
     if device_ip:
         return str(device_ip)
-    partition = str(row.get("PartitionKey") or "unknown")
+    # Sharded partitions are "<device>|<period>"; the device is the prefix.
+    partition = str(row.get("PartitionKey") or "unknown").split("|", 1)[0]
     return partition.replace("_", ".")
 
 
+def device_partition_filters(device_key: str) -> List[str]:
+    """Filters that together match every SensorData partition of one device:
+    the legacy per-device partition, then its time shards ("<device>|2024-05"),
+    which sort in time order. They are separate queries because Table Storage
+    serves an OR across PartitionKey ranges as a full table scan."""
+    return [f"PartitionKey eq '{device_key}'", f"PartitionKey ge '{device_key}|' and PartitionKey lt '{device_key}}}'"]
+
+
+def query_device_rows(client, device_key: str, extra_filter: str = "", select: Optional[List[str]] = None) -> Iterable[Dict[str, Any]]:
+    """Rows of every partition of one device, legacy partition first."""
+    for partition_filter in device_partition_filters(device_key):
+        query = f"{partition_filter} and {extra_filter}" if extra_filter else partition_filter
+        yield from client.query_entities(query_filter=query, select=select)
+
+
 def iter_source_rows(client) -> Iterable[Dict[str, Any]]:
     query = ""
     select = ["PartitionKey", "RowKey", "timestamp", "deviceIp", *NUMERIC_FIELDS, "Timestamp"]
     return client.query_entities(query_filter=query, select=select)
 
 
-def build_rollups(source_rows: Iterable[Dict[str, Any]]) -> Dict[Tuple[str, str, str], Dict[str, Any]]:
+def build_rollups(source_rows: Iterable[Dict[str, Any]], timezones: Iterable[str] = ()) -> Dict[Tuple[str, str, str], Dict[str, Any]]:
     buckets: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+    granularities = rollup_granularities(timezones)
 
     for index, row in enumerate(source_rows, start=1):
         timestamp = parse_timestamp(row.get("timestamp") or row.get("Timestamp"))
@@ -128,7 +173,7 @@ def build_rollups(source_rows: Iterable[Dict[str, Any]]) -> Dict[Tuple[str, str,
             continue
 
         device_ip = get_device_ip(row)
-        for granularity in ("hour", "day", "month"):
+        for granularity in granularities:
             bucket_start = floor_to_bucket(timestamp, granularity)
             bucket_id = (device_ip, granularity, rollup_row_key(bucket_start))
             bucket = buckets.get(bucket_id)
@@ -164,7 +209,75 @@ def average_from_bucket(bucket: Dict[str, Any], field: str) -> Optional[float]:
     return round(bucket["sums"][field] / count, 2)
 
 
-def write_rollups(table_client, buckets: Dict[Tuple[str, str, str], Dict[str, Any]]) -> None:
+def rollup_content_hash(entity: Dict[str, Any]) -> str:
+    """Hash of a rollup's count and aggregates; bookkeeping fields such as
+    lastUpdated are left out so an unchanged bucket hashes the same."""
+    values = [entity.get("count")] + [entity.get(field) for field in NUMERIC_FIELDS]
+    normalized = [None if v is None else round(float(v), 2) for v in values]
+    return hashlib.sha1(json.dumps(normalized).encode("utf-8")).hexdigest()
+
+
+def load_existing_rollups(table_client, partition_keys: Iterable[str]) -> Dict[Tuple[str, str], Dict[str, Any]]:
+    """Read the stored rollups of the given partitions, one query per partition."""
+    existing: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    select = ["PartitionKey", "RowKey", "count", *NUMERIC_FIELDS]
+    for partition_key in sorted(set(partition_keys)):
+        for entity in table_client.query_entities(query_filter=f"PartitionKey eq '{partition_key}'", select=select):
+            existing[(entity["PartitionKey"], entity["RowKey"])] = dict(entity)
+    return existing
+
+
+class RollupWriter:
+    """Upserts rollup entities only when their content hash differs from the
+    stored row. With dry_run nothing is written; with keep_diff every new or
+    changed bucket is recorded for the diff report."""
+
+    def __init__(self, table_client, existing: Dict[Tuple[str, str], Dict[str, Any]], dry_run: bool = False, keep_diff: bool = False):
+        self.table_client = table_client
+        self.existing = existing
+        self.dry_run = dry_run
+        self.keep_diff = keep_diff or dry_run
+        self.stats = {"new": 0, "changed": 0, "unchanged": 0, "failed": 0}
+        self.diff: list = []
+
+    def write(self, entity: Dict[str, Any]) -> None:
+        key = (entity["PartitionKey"], entity["RowKey"])
+        before = self.existing.get(key)
+        if before is not None and rollup_content_hash(before) == rollup_content_hash(entity):
+            self.stats["unchanged"] += 1
+            return
+        kind = "new" if before is None else "changed"
+        if self.keep_diff:
+            fields = [f for f in ("count", *NUMERIC_FIELDS) if before is None or before.get(f) != entity.get(f)]
+            self.diff.append({
+                "partitionKey": key[0],
+                "rowKey": key[1],
+                "change": kind,
+                "before": {f: before.get(f) for f in fields} if before else None,
+                "after": {f: entity.get(f) for f in fields},
+            })
+        if not self.dry_run:
+            try:
+                self.table_client.upsert_entity(mode=UpdateMode.REPLACE, entity=entity)
+            except Exception as ex:
+                logging.warning("Failed to upsert rollup %s/%s: %s", key[0], key[1], ex)
+                self.stats["failed"] += 1
+                return
+        self.stats[kind] += 1
+
+    def finish(self, report_path: Optional[str] = None) -> None:
+        logging.info("Rollups %s: %s", "that would change" if self.dry_run else "written", self.stats)
+        if self.dry_run:
+            for item in self.diff[:20]:
+                logging.info("  %s %s/%s %s -> %s", item["change"], item["partitionKey"], item["rowKey"], item["before"], item["after"])
+            if len(self.diff) > 20:
+                logging.info("  ... %s more", len(self.diff) - 20)
+        if report_path:
+            Path(report_path).write_text(json.dumps({"dryRun": self.dry_run, "summary": self.stats, "buckets": self.diff}, indent=2), encoding="utf-8")
+            logging.info("Diff report written to %s", report_path)
+
+
+def write_rollups(table_client, buckets: Dict[Tuple[str, str, str], Dict[str, Any]], writer: Optional[RollupWriter] = None) -> None:
     now = now_iso()
     for index, bucket in enumerate(buckets.values(), start=1):
         bucket_start = bucket["bucket_start"]
@@ -183,17 +296,24 @@ def write_rollups(table_client, buckets: Dict[Tuple[str, str, str], Dict[str, An
             "light": average_from_bucket(bucket, "light"),
             "lastUpdated": now,
         }
-        table_client.upsert_entity(mode=UpdateMode.REPLACE, entity=entity)
+        if writer:
+            writer.write(entity)
+        else:
+            table_client.upsert_entity(mode=UpdateMode.REPLACE, entity=entity)
         if index % 1000 == 0:
-            logging.info("Wrote %s rollup rows", index)
+            logging.info("Processed %s rollup rows", index)
 
 
 def main() -> int:
     parser = argparse.ArgumentParser(description="Backfill SensorHistoryRollups from SensorData.")
     parser.add_argument("--keep-existing", action="store_true", help="Do not delete the existing rollup table before rebuilding.")
+    parser.add_argument("--dry-run", action="store_true", help="Compare against stored rollups and report what would change; writes nothing (implies --keep-existing).")
+    parser.add_argument("--diff-report", help="Write the new/changed buckets to this JSON file.")
+    parser.add_argument("--timezone", action="append", help="Also build day/month rollups aligned to this IANA zone (repeatable). Default: ROLLUP_TIMEZONES.")
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    timezones = args.timezone if args.timezone is not None else rollup_timezones()
 
     conn_str = get_connection_string()
     service = TableServiceClient.from_connection_string(conn_str)
@@ -221,7 +341,7 @@ def main() -> int:
         if last_exc:
             raise last_exc
 
-    if not args.keep_existing:
+    if not args.keep_existing and not args.dry_run:
         try:
             service.delete_table(ROLLUP_TABLE_NAME)
             logging.info("Deleted existing %s table", ROLLUP_TABLE_NAME)
@@ -231,9 +351,15 @@ def main() -> int:
         rollup_client = service.get_table_client(ROLLUP_TABLE_NAME)
 
     source_rows = iter_source_rows(source_client)
-    buckets = build_rollups(source_rows)
+    buckets = build_rollups(source_rows, timezones)
     logging.info("Built %s rollup buckets", len(buckets))
-    write_rollups(rollup_client, buckets)
+    existing = {}
+    if args.keep_existing or args.dry_run:
+        existing = load_existing_rollups(rollup_client, (rollup_bucket_key(b["deviceIp"], b["granularity"]) for b in buckets.values()))
+        logging.info("Loaded %s stored rollups for comparison", len(existing))
+    writer = RollupWriter(rollup_client, existing, dry_run=args.dry_run, keep_diff=bool(args.diff_report))
+    write_rollups(rollup_client, buckets, writer)
+    writer.finish(args.diff_report)
     logging.info("Backfill complete")
     return 0
 
@@ -0,0 +1,320 @@
+# Run from repo root: python scripts/load_test.py --devices 200 --viewers 10 --duration 120
+#
+# Fleet load generator for a local Functions host (`func start` in functions/).
+# Virtual devices post readings on the MCU cadence and poll /control; virtual
+# dashboard viewers refresh /sensor-data history. Reports throughput,
+# p50/p95/p99 latency and error rates per endpoint, and can save or compare
+# JSON baselines.
+#
+# For load runs the host can be pointed at Azurite as a throwaway storage
+# stand-in (STORAGE_CONNECTION_STRING=UseDevelopmentStorage=true); it is not
+# a supported backend for anything else.
+import argparse
+import datetime as dt
+import heapq
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.parse import urlencode, urlsplit
+
+# Matches SAMPLE_INTERVAL_MS in microcontroller/mcu.ino.example.
+DEFAULT_POST_INTERVAL = 60.0
+DEFAULT_POLL_INTERVAL = 30.0
+DEFAULT_VIEWER_INTERVAL = 15.0
+DEFAULT_TIMESCALES = "1h,1d,1m,1y,all"
+
+
+def load_local_settings():
+    script_dir = Path(__file__).resolve().parent
+    settings_path = script_dir / "local.settings.json"
+    if not settings_path.exists():
+        settings_path = script_dir.parent / "functions" / "local.settings.json"
+    if not settings_path.exists():
+        return
+    try:
+        payload = json.loads(settings_path.read_text(encoding="utf-8"))
+    except Exception:
+        return
+    values = payload.get("Values") or {}
+    for key, value in values.items():
+        if not os.getenv(key) and isinstance(value, str) and value and not value.startswith("<"):
+            os.environ[key] = value
+
+
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+class Client:
+    """One keep-alive connection per worker thread, like an MCU or browser would hold."""
+
+    def __init__(self, base_url: str, function_key: Optional[str], timeout: float):
+        parts = urlsplit(base_url.rstrip("/"))
+        self.scheme = parts.scheme or "http"
+        self.host = parts.netloc
+        self.prefix = parts.path
+        self.timeout = timeout
+        self.headers = {"x-functions-key": function_key} if function_key else {}
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+            conn = cls(self.host, timeout=self.timeout)
+            self.local.conn = conn
+        return conn
+
+    def request(self, method: str, path: str, params: Optional[dict] = None, body: Optional[bytes] = None, content_type: str = "application/json"):
+        url = self.prefix + path + ("?" + urlencode(params) if params else "")
+        headers = dict(self.headers)
+        if body is not None:
+            headers["Content-Type"] = content_type
+        for attempt in (0, 1):
+            conn = self.connection()
+            try:
+                conn.request(method, url, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                return response.status
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # Stale keep-alive connection; reconnect once before counting an error.
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    raise
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.lag: List[float] = []
+
+    def record(self, endpoint: str, seconds: float, status: str, lag: float):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            self.statuses[endpoint][status] += 1
+            self.lag.append(lag)
+
+    def summary(self, elapsed: float, config: dict) -> dict:
+        endpoints = {}
+        for endpoint, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            statuses = dict(self.statuses[endpoint])
+            errors = sum(n for s, n in statuses.items() if not s.isdigit() or int(s) >= 400)
+            endpoints[endpoint] = {
+                "requests": len(values),
+                "throughput": round(len(values) / elapsed, 3) if elapsed else 0.0,
+                "p50Ms": round(percentile(values, 50) * 1000, 1),
+                "p95Ms": round(percentile(values, 95) * 1000, 1),
+                "p99Ms": round(percentile(values, 99) * 1000, 1),
+                "maxMs": round(values[-1] * 1000, 1),
+                "errorRate": round(errors / len(values), 4),
+                "statuses": statuses,
+            }
+        lag = sorted(self.lag)
+        return {
+            "recordedAt": dt.datetime.now(dt.timezone.utc).isoformat(),
+            "elapsedSeconds": round(elapsed, 1),
+            "config": config,
+            "endpoints": endpoints,
+            # Scheduling lag shows when the generator itself could not keep up.
+            "schedulerLagP99Ms": round((percentile(lag, 99) or 0.0) * 1000, 1),
+        }
+
+
+def device_ip(prefix: str, index: int) -> str:
+    return f"{prefix}{index // 250}.{index % 250 + 1}"
+
+
+def build_payload(ip: str, line_protocol: bool):
+    temperature = round(random.uniform(18.0, 28.0), 2)
+    humidity = round(random.uniform(30.0, 70.0), 2)
+    battery = round(random.uniform(3.5, 4.2), 3)
+    if line_protocol:
+        # timestamp,moisture,temperature,humidity,battery,ph,light with an empty "now" timestamp.
+        body = f"@{ip},load-{ip}\n,,{temperature},{humidity},{battery},,\n"
+        return body.encode("ascii"), "text/x-sensor-lines"
+    payload = {
+        "deviceId": f"load-{ip}",
+        "deviceIp": ip,
+        "temperature": temperature,
+        "humidity": humidity,
+        "battery": battery,
+        "timestamp": int(time.time() * 1000),
+    }
+    return json.dumps(payload).encode("utf-8"), "application/json"
+
+
+def run(args) -> dict:
+    client = Client(args.base_url, args.function_key, args.timeout)
+    recorder = Recorder()
+    speedup = max(args.speedup, 0.001)
+    post_interval = args.post_interval / speedup
+    poll_interval = args.poll_interval / speedup
+    viewer_interval = args.viewer_interval / speedup
+    timescales = [t.strip() for t in args.timescales.split(",") if t.strip()]
+    ips = [device_ip(args.ip_prefix, i) for i in range(args.devices)]
+    start = time.monotonic()
+    stop_at = start + args.duration
+
+    def jittered(interval: float) -> float:
+        return max(0.0, interval * (1.0 + random.uniform(-args.jitter, args.jitter)))
+
+    def execute(kind: str, actor: int, due: float):
+        lag = max(0.0, time.monotonic() - due)
+        if kind == "post":
+            ip = ips[actor]
+            body, content_type = build_payload(ip, args.line_protocol)
+            call = ("POST /sensor-data", lambda: client.request("POST", "/sensor-data", body=body, content_type=content_type))
+        elif kind == "poll":
+            params = {"deviceIp": ips[actor]}
+            if args.poll_wait:
+                params["wait"] = args.poll_wait
+            call = ("GET /control", lambda: client.request("GET", "/control", params=params))
+        else:
+            params = {"history": "true", "timescale": random.choice(timescales)}
+            if args.devices and random.random() < args.viewer_device_share:
+                params["deviceIp"] = random.choice(ips)
+            call = ("GET /sensor-data", lambda: client.request("GET", "/sensor-data", params=params))
+        endpoint, send = call
+        t0 = time.perf_counter()
+        try:
+            status = str(send())
+        except Exception as ex:
+            status = type(ex).__name__
+        recorder.record(endpoint, time.perf_counter() - t0, status, lag)
+
+    # Stagger first events across one interval so the fleet does not post in lockstep.
+    schedule = []
+    for i in range(args.devices):
+        heapq.heappush(schedule, (start + random.uniform(0, post_interval), "post", i))
+        if args.poll_interval > 0:
+            heapq.heappush(schedule, (start + random.uniform(0, poll_interval), "poll", i))
+    for v in range(args.viewers):
+        heapq.heappush(schedule, (start + random.uniform(0, viewer_interval), "view", v))
+    intervals = {"post": post_interval, "poll": poll_interval, "view": viewer_interval}
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        while schedule:
+            due, kind, actor = heapq.heappop(schedule)
+            if due >= stop_at:
+                break
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(execute, kind, actor, due)
+            heapq.heappush(schedule, (due + jittered(intervals[kind]), kind, actor))
+    elapsed = time.monotonic() - start
+
+    config = {
+        "baseUrl": args.base_url,
+        "devices": args.devices,
+        "viewers": args.viewers,
+        "durationSeconds": args.duration,
+        "postInterval": args.post_interval,
+        "pollInterval": args.poll_interval,
+        "pollWait": args.poll_wait,
+        "viewerInterval": args.viewer_interval,
+        "jitter": args.jitter,
+        "speedup": args.speedup,
+        "lineProtocol": args.line_protocol,
+    }
+    return recorder.summary(elapsed, config)
+
+
+def print_summary(summary: dict):
+    print(f"Elapsed {summary['elapsedSeconds']}s, scheduler lag p99 {summary['schedulerLagP99Ms']}ms")
+    print(f"{'endpoint':<20}{'reqs':>8}{'req/s':>9}{'p50ms':>9}{'p95ms':>9}{'p99ms':>9}{'err%':>8}  statuses")
+    for endpoint, s in summary["endpoints"].items():
+        print(
+            f"{endpoint:<20}{s['requests']:>8}{s['throughput']:>9}{s['p50Ms']:>9}{s['p95Ms']:>9}{s['p99Ms']:>9}"
+            f"{s['errorRate'] * 100:>8.2f}  {s['statuses']}"
+        )
+
+
+def compare(summary: dict, baseline: dict, max_regression: float) -> bool:
+    """Print per-endpoint deltas against a saved baseline; return False on regression."""
+    ok = True
+    print(f"\nCompared with baseline recorded {baseline.get('recordedAt')}:")
+    for endpoint, s in summary["endpoints"].items():
+        b = baseline.get("endpoints", {}).get(endpoint)
+        if not b:
+            print(f"  {endpoint}: not in baseline")
+            continue
+        parts = []
+        for key in ("p50Ms", "p95Ms", "p99Ms"):
+            delta = (s[key] - b[key]) / b[key] * 100 if b[key] else 0.0
+            flag = ""
+            if key != "p50Ms" and delta > max_regression:
+                flag = " !"
+                ok = False
+            parts.append(f"{key} {b[key]}->{s[key]} ({delta:+.0f}%){flag}")
+        error_delta = s["errorRate"] - b["errorRate"]
+        if error_delta > 0.01:
+            ok = False
+        parts.append(f"errors {b['errorRate'] * 100:.2f}%->{s['errorRate'] * 100:.2f}%")
+        print(f"  {endpoint}: " + ", ".join(parts))
+    return ok
+
+
+def main():
+    load_local_settings()
+    parser = argparse.ArgumentParser(description="Fleet load test against a local Functions host.")
+    parser.add_argument("--base-url", default=os.getenv("LOAD_TEST_BASE_URL", "http://localhost:7071/api"))
+    parser.add_argument("--function-key", default=os.getenv("FUNCTION_KEY"))
+    parser.add_argument("--devices", type=int, default=50, help="Virtual devices.")
+    parser.add_argument("--viewers", type=int, default=5, help="Virtual dashboard viewers.")
+    parser.add_argument("--duration", type=float, default=60.0, help="Run length in seconds.")
+    parser.add_argument("--post-interval", type=float, default=DEFAULT_POST_INTERVAL, help="Seconds between device uploads.")
+    parser.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL, help="Seconds between control polls (0 disables).")
+    parser.add_argument("--poll-wait", type=float, default=0.0, help="Long-poll wait passed to /control.")
+    parser.add_argument("--viewer-interval", type=float, default=DEFAULT_VIEWER_INTERVAL, help="Seconds between dashboard refreshes.")
+    parser.add_argument("--viewer-device-share", type=float, default=0.5, help="Fraction of viewer requests scoped to one device.")
+    parser.add_argument("--timescales", default=DEFAULT_TIMESCALES)
+    parser.add_argument("--jitter", type=float, default=0.1, help="Relative jitter on every interval (0.1 = +/-10%%).")
+    parser.add_argument("--speedup", type=float, default=1.0, help="Compress all intervals by this factor.")
+    parser.add_argument("--line-protocol", action="store_true", help="Upload with the compact text/x-sensor-lines format.")
+    parser.add_argument("--ip-prefix", default="10.250.", help="Prefix for virtual device IPs.")
+    parser.add_argument("--workers", type=int, default=64, help="Concurrent in-flight requests.")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--save-baseline", help="Write the run summary to this JSON file.")
+    parser.add_argument("--compare", help="Compare against a saved baseline JSON file.")
+    parser.add_argument("--max-regression", type=float, default=20.0, help="Allowed p95/p99 growth in percent before --compare fails.")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    summary = run(args)
+    print_summary(summary)
+
+    ok = True
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        ok = compare(summary, baseline, args.max_regression)
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps(summary, indent=2), encoding="utf-8")
+        print(f"\nSaved baseline to {args.save_baseline}")
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
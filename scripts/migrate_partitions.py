@@ -0,0 +1,112 @@
+# Run from repo root: python scripts/migrate_partitions.py --scheme month
+#
+# Moves raw SensorData rows from the legacy one-partition-per-device layout
+# ("192_168_1_33") into time-sharded partitions ("192_168_1_33|2024-05" or
+# "192_168_1_33|2024-W19"), matching SENSOR_PARTITION_SCHEME in the Function App.
+#
+# The migration is online: switch the app to the new scheme with
+# SENSOR_LEGACY_PARTITION_READS=true first, so reads cover both layouts while
+# rows move, then run this script and turn legacy reads off when it finishes.
+# Each batch is upserted into its shard and then deleted from the legacy
+# partition, so a row is never missing and re-running after an interruption
+# simply continues with what is left.
+import argparse
+import datetime as dt
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from azure.data.tables import TableServiceClient, UpdateMode
+
+from backfill_rollups import SOURCE_TABLE_NAME, get_connection_string
+
+BATCH_SIZE = 100
+
+
+def shard_key(device_key: str, row_key: str, scheme: str) -> str:
+    """Same mapping as sensor_partition_key in functions/function_app.py."""
+    moment = dt.datetime.fromtimestamp(int(row_key.split("_", 1)[0]), dt.timezone.utc)
+    if scheme == "week":
+        year, week, _ = moment.isocalendar()
+        return f"{device_key}|{year}-W{week:02d}"
+    return f"{device_key}|{moment.year}-{moment.month:02d}"
+
+
+def move_batch(client, rows: List[Dict[str, Any]], target: str, keep_source: bool) -> None:
+    copies = []
+    for row in rows:
+        entity = dict(row)
+        entity["PartitionKey"] = target
+        copies.append(("upsert", entity, {"mode": UpdateMode.REPLACE}))
+    client.submit_transaction(copies)
+    if not keep_source:
+        client.submit_transaction([("delete", {"PartitionKey": r["PartitionKey"], "RowKey": r["RowKey"]}) for r in rows])
+
+
+def migrate_device(service, device_key: str, args) -> int:
+    client = service.get_table_client(SOURCE_TABLE_NAME)
+    moved = 0
+    batch: List[Dict[str, Any]] = []
+    target = None
+
+    def flush():
+        nonlocal moved
+        if not batch:
+            return
+        if not args.dry_run:
+            move_batch(client, batch, target, args.keep_source)
+            time.sleep(args.pause)
+        moved += len(batch)
+        batch.clear()
+
+    # Rows arrive in RowKey (time) order, so each shard's rows are contiguous.
+    for row in client.query_entities(query_filter=f"PartitionKey eq '{device_key}'"):
+        key = shard_key(device_key, row["RowKey"], args.scheme)
+        if key != target or len(batch) >= BATCH_SIZE:
+            flush()
+            target = key
+        batch.append(row)
+        if moved and moved % 10000 == 0 and len(batch) == 1:
+            logging.info("%s: %d rows moved so far", device_key, moved)
+    flush()
+    logging.info("%s: %s %d rows", device_key, "would move" if args.dry_run else "moved", moved)
+    return moved
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Move SensorData rows into time-sharded partitions.")
+    parser.add_argument("--scheme", choices=("month", "week"), required=True, help="Must match SENSOR_PARTITION_SCHEME.")
+    parser.add_argument("--device", action="append", help="Device IP or partition key to migrate (repeatable). Default: every registered device.")
+    parser.add_argument("--workers", type=int, default=4, help="Devices migrated in parallel.")
+    parser.add_argument("--pause", type=float, default=0.05, help="Seconds to sleep between batches to stay clear of throttling.")
+    parser.add_argument("--keep-source", action="store_true", help="Copy only; leave the legacy partition in place.")
+    parser.add_argument("--dry-run", action="store_true", help="Count rows per device without writing.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    service = TableServiceClient.from_connection_string(get_connection_string())
+
+    if args.device:
+        devices = [d.replace(".", "_") for d in args.device]
+    else:
+        rows = service.get_table_client("Devices").query_entities(query_filter="PartitionKey eq 'Device'", select=["RowKey"])
+        devices = [r["RowKey"] for r in rows if r.get("RowKey")]
+
+    total = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = {d: pool.submit(migrate_device, service, d, args) for d in devices}
+        for device_key, future in futures.items():
+            try:
+                total += future.result()
+            except Exception as ex:
+                logging.error("Migration failed for %s (re-run to resume): %s", device_key, ex)
+                failed.append(device_key)
+
+    logging.info("Done: %d rows across %d devices; failed: %s", total, len(devices), failed or "none")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
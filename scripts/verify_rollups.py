@@ -0,0 +1,229 @@
+# Run from repo root: python scripts/verify_rollups.py --samples 20
+#
+# Recomputes a sample of rollup buckets from raw SensorData and compares them
+# with SensorHistoryRollups. Each bucket is checked with one RowKey-range
+# query on its device partition, so nothing scans a whole table. Devices are
+# checked in parallel. --repair rewrites only the buckets that drifted.
+import argparse
+import calendar
+import datetime as dt
+import json
+import logging
+import random
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.data.tables import TableServiceClient, UpdateMode
+
+from backfill_rollups import (
+    NUMERIC_FIELDS,
+    ROLLUP_TABLE_NAME,
+    SOURCE_TABLE_NAME,
+    average_from_bucket,
+    build_rollups,
+    floor_to_bucket,
+    get_connection_string,
+    now_iso,
+    parse_timestamp,
+    query_device_rows,
+    rollup_bucket_key,
+    rollup_granularities,
+    rollup_row_key,
+    rollup_timezones,
+    split_granularity,
+)
+
+RETENTION_TABLE_NAME = "RetentionState"
+
+
+def bucket_end(start: dt.datetime, granularity: str) -> dt.datetime:
+    granularity, zone = split_granularity(granularity)
+    if zone is not None:
+        local = start.astimezone(zone).date()
+        following = local + dt.timedelta(days=1) if granularity == "day" else (local.replace(day=28) + dt.timedelta(days=4)).replace(day=1)
+        return dt.datetime(following.year, following.month, following.day, tzinfo=zone).astimezone(dt.timezone.utc)
+    if granularity == "hour":
+        return start + dt.timedelta(hours=1)
+    if granularity == "day":
+        return start + dt.timedelta(days=1)
+    return start + dt.timedelta(days=calendar.monthrange(start.year, start.month)[1])
+
+
+def retention_cursor(service, partition_key: str) -> Optional[dt.datetime]:
+    """Raw rows before this point may have been deleted by the retention job."""
+    try:
+        state = service.get_table_client(RETENTION_TABLE_NAME).get_entity(partition_key="Retention", row_key=partition_key)
+    except Exception:
+        return None
+    cursor = str(state.get("cursor") or "").split("_", 1)[0]
+    return dt.datetime.fromtimestamp(int(cursor), dt.timezone.utc) if cursor.isdigit() else None
+
+
+def sample_buckets(args, rng: random.Random) -> List[tuple]:
+    """(granularity, bucket_start) pairs: the targeted --bucket, or random picks in the window."""
+    granularities = [args.granularity] if args.granularity else rollup_granularities(args.timezones)
+    if args.bucket:
+        start = parse_timestamp(args.bucket)
+        if not start:
+            raise SystemExit(f"Invalid --bucket timestamp: {args.bucket}")
+        return [(g, floor_to_bucket(start, g)) for g in granularities]
+
+    now = dt.datetime.now(dt.timezone.utc)
+    window = args.days * 86400
+    picks = set()
+    for _ in range(args.samples * 4):
+        if len(picks) >= args.samples:
+            break
+        g = rng.choice(granularities)
+        picks.add((g, floor_to_bucket(now - dt.timedelta(seconds=rng.uniform(0, window)), g)))
+    return sorted(picks)
+
+
+def compare_bucket(expected: Optional[Dict[str, Any]], stored: Optional[Dict[str, Any]], tolerance: float) -> List[str]:
+    """Differences between the recomputed and stored bucket; empty when they agree."""
+    if expected is None and stored is None:
+        return []
+    if expected is None:
+        return ["orphan: rollup exists but no raw rows"]
+    if stored is None:
+        return [f"missing: {expected['count']} raw rows have no rollup"]
+    problems = []
+    if int(stored.get("count") or 0) != expected["count"]:
+        problems.append(f"count {stored.get('count')} != {expected['count']}")
+    for field in NUMERIC_FIELDS:
+        want = average_from_bucket(expected, field)
+        have = stored.get(field)
+        if want is None and have is None:
+            continue
+        if want is None or have is None or abs(float(have) - want) > tolerance:
+            problems.append(f"{field} {have} != {want}")
+    return problems
+
+
+def rollup_entity(bucket: Dict[str, Any]) -> Dict[str, Any]:
+    entity = {
+        "PartitionKey": rollup_bucket_key(bucket["deviceIp"], bucket["granularity"]),
+        "RowKey": rollup_row_key(bucket["bucket_start"]),
+        "deviceIp": bucket["deviceIp"],
+        "granularity": bucket["granularity"],
+        "timestamp": rollup_row_key(bucket["bucket_start"]),
+        "count": bucket["count"],
+        "lastUpdated": now_iso(),
+    }
+    for field in NUMERIC_FIELDS:
+        entity[field] = average_from_bucket(bucket, field)
+    return entity
+
+
+def verify_device(service, partition_key: str, buckets: List[tuple], args) -> List[Dict[str, Any]]:
+    source = service.get_table_client(SOURCE_TABLE_NAME)
+    rollups = service.get_table_client(ROLLUP_TABLE_NAME)
+    pruned_before = retention_cursor(service, partition_key)
+    device_ip = partition_key.replace("_", ".")
+    select = ["PartitionKey", "RowKey", "timestamp", "deviceIp", *NUMERIC_FIELDS, "Timestamp"]
+    results = []
+
+    for granularity, start in buckets:
+        end = bucket_end(start, granularity)
+        result = {"partition": partition_key, "granularity": granularity, "bucket": rollup_row_key(start)}
+        if pruned_before and start < pruned_before:
+            results.append({**result, "status": "skipped", "problems": ["raw rows pruned by retention"]})
+            continue
+
+        # build_sensor_entry keys rows by the same second it stores in
+        # `timestamp` (the device time when it parses, else the receive time),
+        # so current rows fall inside the bucket's own RowKey range. The skew
+        # widens the range for rows whose key and `timestamp` disagree: rows
+        # keyed by receive time by older ingest code or copied in by tools,
+        # and rows without `timestamp` that are bucketed by the service
+        # Timestamp. Rows are then filtered by their timestamp.
+        lo = int(start.timestamp()) - args.skew_seconds
+        hi = int(end.timestamp()) + args.skew_seconds
+        rows = []
+        for row in query_device_rows(source, partition_key, f"RowKey ge '{lo:010d}_' and RowKey lt '{hi:010d}_'", select):
+            ts = parse_timestamp(row.get("timestamp") or row.get("Timestamp"))
+            if ts and start <= ts < end:
+                rows.append(row)
+        expected = None
+        if rows:
+            built = build_rollups(rows, args.timezones)
+            expected = built.get((rows[0].get("deviceIp") or device_ip, granularity, rollup_row_key(start)))
+
+        try:
+            stored = rollups.get_entity(partition_key=rollup_bucket_key(device_ip, granularity), row_key=rollup_row_key(start))
+        except ResourceNotFoundError:
+            stored = None
+
+        problems = compare_bucket(expected, stored, args.tolerance)
+        status = "ok" if not problems else "drift"
+        if problems and args.repair:
+            if expected is None:
+                rollups.delete_entity(partition_key=stored["PartitionKey"], row_key=stored["RowKey"])
+            else:
+                rollups.upsert_entity(mode=UpdateMode.REPLACE, entity=rollup_entity(expected))
+            status = "repaired"
+        if status != "ok" or args.verbose:
+            logging.info("%s %s %s: %s %s", partition_key, granularity, result["bucket"], status, "; ".join(problems))
+        results.append({**result, "status": status, "rawRows": len(rows), "problems": problems})
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Verify a sample of rollup buckets against raw SensorData.")
+    parser.add_argument("--device", action="append", help="Device IP or partition key to check (repeatable). Default: every registered device.")
+    parser.add_argument("--granularity", help="Only check this rollup granularity (hour, day, month, or a local tier such as day@America~Chicago).")
+    parser.add_argument("--timezone", action="append", help="Also sample local day/month rollups for this IANA zone (repeatable). Default: ROLLUP_TIMEZONES.")
+    parser.add_argument("--bucket", help="Check the bucket containing this ISO timestamp instead of random samples.")
+    parser.add_argument("--samples", type=int, default=10, help="Random buckets per device.")
+    parser.add_argument("--days", type=float, default=90, help="Sample buckets from the last N days.")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="Allowed absolute difference for averaged fields.")
+    parser.add_argument("--skew-seconds", type=int, default=3600, help="Widen each bucket's RowKey range by this much to catch rows whose RowKey time differs from their timestamp (older or imported rows); 0 when all rows come from the current ingest path.")
+    parser.add_argument("--workers", type=int, default=8, help="Devices verified in parallel.")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--repair", action="store_true", help="Rewrite (or delete) only the buckets that drifted.")
+    parser.add_argument("--report", help="Write the full drift report to this JSON file.")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    args.timezones = args.timezone if args.timezone is not None else rollup_timezones()
+    if args.granularity and args.granularity not in rollup_granularities(args.timezones):
+        raise SystemExit(f"Unknown --granularity {args.granularity}; expected one of {rollup_granularities(args.timezones)}")
+    service = TableServiceClient.from_connection_string(get_connection_string())
+    rng = random.Random(args.seed)
+
+    if args.device:
+        partitions = [d.replace(".", "_") for d in args.device]
+    else:
+        devices = service.get_table_client("Devices").query_entities(query_filter="PartitionKey eq 'Device'", select=["RowKey"])
+        partitions = [d["RowKey"] for d in devices if d.get("RowKey")]
+    plan = {pk: sample_buckets(args, rng) for pk in partitions}
+    logging.info("Verifying %d buckets across %d devices", sum(len(b) for b in plan.values()), len(plan))
+
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = {pk: pool.submit(verify_device, service, pk, buckets, args) for pk, buckets in plan.items()}
+        results = []
+        for pk, future in futures.items():
+            try:
+                results.extend(future.result())
+            except Exception as ex:
+                logging.error("Verification failed for %s: %s", pk, ex)
+                results.append({"partition": pk, "status": "error", "problems": [str(ex)]})
+
+    summary: Dict[str, int] = {}
+    for r in results:
+        summary[r["status"]] = summary.get(r["status"], 0) + 1
+    drifted = sorted({r["partition"] for r in results if r["status"] in ("drift", "repaired")})
+    print("Bucket status:", summary)
+    print("Devices with drift:", drifted)
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as fh:
+            json.dump({"checkedAt": now_iso(), "summary": summary, "devicesWithDrift": drifted, "buckets": results}, fh, indent=2)
+        print("Report written to", args.report)
+    return 1 if summary.get("drift") or summary.get("error") else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -57,6 +57,36 @@ resource "azurerm_storage_table" "devices" {
   storage_account_name = azurerm_storage_account.main.name
 }
 
+# Storage Table for queued device control commands
+resource "azurerm_storage_table" "control_commands" {
+  name                 = "ControlCommands"
+  storage_account_name = azurerm_storage_account.main.name
+}
+
+# Storage Table indexing devices by offline deadline for the health check
+resource "azurerm_storage_table" "device_liveness" {
+  name                 = "DeviceLiveness"
+  storage_account_name = azurerm_storage_account.main.name
+}
+
+# Storage Table for hour-packed raw readings (SENSOR_STORAGE_MODE=dual)
+resource "azurerm_storage_table" "sensor_chunks" {
+  name                 = "SensorChunks"
+  storage_account_name = azurerm_storage_account.main.name
+}
+
+# Storage Table for precomputed dashboard history series
+resource "azurerm_storage_table" "dashboard_series" {
+  name                 = "DashboardSeries"
+  storage_account_name = azurerm_storage_account.main.name
+}
+
+# Storage Table for raw retention progress (per-device cursors)
+resource "azurerm_storage_table" "retention_state" {
+  name                 = "RetentionState"
+  storage_account_name = azurerm_storage_account.main.name
+}
+
 # App Service Plan for Azure Functions (Linux Consumption)
 resource "azurerm_service_plan" "main" {
   name                = "${var.project_name}-asp-${var.environment}"
@@ -179,6 +209,17 @@ resource "azurerm_api_management_api_operation" "post_control" {
   url_template        = "/control"
 }
 
+resource "azurerm_api_management_api_operation" "delete_control" {
+  operation_id        = "delete-control"
+  api_name            = azurerm_api_management_api.main.name
+  api_management_name = azurerm_api_management.main.name
+  resource_group_name = azurerm_api_management_api.main.resource_group_name
+  display_name        = "Cancel Control Commands"
+  method              = "DELETE"
+  url_template        = "/control"
+  description         = "Cancel one queued command (id) or clear a device's queue"
+}
+
 resource "azurerm_api_management_api_operation" "health" {
   operation_id        = "health-check"
   api_name            = azurerm_api_management_api.main.name
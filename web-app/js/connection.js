@@ -22,16 +22,40 @@ function setChartLoadingOverlay(visible) {
 
 export function getApiBaseUrl() { return state.useProd ? PROD_API_URL : LOCAL_API_URL; }
 
-async function fetchHistoryByTimescale(baseUrl, params, fetchOptions, timescale, rawHistory = false) {
+// Merge a delta response into cached rows: replace by timestamp+device, drop
+// rows that fell out of the window, keep chronological order.
+function mergeHistoryRows(cached, rows, windowStart) {
+  const keyOf = (r) => `${r?.timestamp}|${r?.deviceIp ?? ''}`;
+  const merged = new Map((cached || []).map((r) => [keyOf(r), r]));
+  rows.forEach((r) => merged.set(keyOf(r), r));
+  const floor = windowStart ? Date.parse(windowStart) : null;
+  return [...merged.values()]
+    .filter((r) => r && r.timestamp && (!floor || Date.parse(r.timestamp) >= floor))
+    .sort((a, b) => Date.parse(a.timestamp) - Date.parse(b.timestamp));
+}
+
+async function fetchHistoryByTimescale(baseUrl, params, fetchOptions, timescale, rawHistory = false, incremental = false, fresh = false) {
   const historyParams = new URLSearchParams(params);
   historyParams.append('history', 'true');
   historyParams.append('timescale', timescale);
   if (rawHistory) historyParams.append('raw', 'true');
+  // A manual refresh skips the server's precomputed series snapshot.
+  if (fresh) historyParams.append('fresh', 'true');
+  // Refresh only what changed since the last response when the cache holds
+  // unaggregated rows that can be merged point by point.
+  const cached = state.historyCache[timescale];
+  const cursor = state.historyCursors[timescale];
+  const useDelta = incremental && cursor?.raw === rawHistory && Array.isArray(cached) && !cached.some((r) => r?.isAggregated);
+  if (useDelta) historyParams.append('since', cursor.value);
   const base = getApiBaseUrl();
   const response = await fetch(`${base.replace(/\/$/, '')}/sensor-data?${historyParams.toString()}`, fetchOptions);
   if (!response.ok) throw new Error(`History fetch failed for ${timescale}`);
   const body = await response.json();
-  const rows = Array.isArray(body?.history) ? body.history : [];
+  const received = Array.isArray(body?.history) ? body.history : [];
+  const rows = useDelta ? mergeHistoryRows(cached, received, body?.windowStart) : received;
+  if (body?.cursor) state.historyCursors[timescale] = { value: body.cursor, raw: rawHistory };
+  else delete state.historyCursors[timescale];
+  if (useDelta) addLogEntry(`Delta sync for ${timescale}: ${received.length} new or changed rows`);
   try {
     const humCount = rows.filter(r => r && r.humidity !== null && r.humidity !== undefined).length;
     const tempCount = rows.filter(r => r && r.temperature !== null && r.temperature !== undefined && r.temperature !== '').length;
@@ -203,7 +227,8 @@ export async function refreshData(showLoading = false, isAuto = false) {
           return [];
         });
     } else if (shouldRefreshHistory) {
-      selectedHistoryPromise = fetchHistoryByTimescale(baseUrl, historyParams, fetchOptions, selectedTimescale, rawHistoryRequested)
+      const incremental = !showLoading && !isInitialHistoryLoad && state.lastTimescale === selectedTimescale;
+      selectedHistoryPromise = fetchHistoryByTimescale(baseUrl, historyParams, fetchOptions, selectedTimescale, rawHistoryRequested, incremental, showLoading)
         .catch((error) => {
           historyFetchError = error;
           return [];
@@ -427,6 +452,7 @@ export function toggleApiSource() {
   state.useProd = document.getElementById('apiSourceToggle').checked; 
   localStorage.setItem('useProd', state.useProd); 
   addLogEntry(`Switched to ${state.useProd ? 'Production' : 'Local'} API`); 
+  state.historyCursors = {};
   if (state.isConnected) refreshData(); 
 }
 
@@ -8,6 +8,7 @@ export const state = {
   latestData: null,
   historyData: null,
   historyCache: {},
+  historyCursors: {},
   lastTimescale: '1h',
   refreshInProgress: false,
   visibleOrder: [],